@@ -3,7 +3,8 @@
 #
 
 import logging
-from typing import Dict, List, Optional, Any, Callable
+import collections
+from typing import Dict, List, Optional, Any, Callable, Set
 import asyncio
 from nio import AsyncClient  # or wherever AsyncClient is actually imported from
 import time
@@ -30,18 +31,20 @@ LUNA_USERNAME="lunabot"
 LUNA_PASSWORD="12345"
 LUNA_CLIENT:AsyncClient = None
 PERSONALITIES_FILE="data/luna_personalities.json"
-BOT_START_TIME = time.time() * 1000
+BOT_START_TIME = int(time.time() * 1000)  # ms, int like event.server_timestamp
 OPENAI_API_KEY: str = ""
 LLM: ChatOpenAI = None
 SHOULD_SHUT_DOWN: bool = False
 LOGGER: logging.Logger = None
 BOTS: Dict[str, AsyncClient] = {} # A dict mapping localpart (str) -> AsyncClient for each bot
-BOT_TASKS: List[asyncio.Task] = [] # A list of asyncio.Tasks for each bot’s sync loop
+BOT_TASKS: Set[asyncio.Task] = set() # The asyncio.Tasks for each bot’s sync loop (each removes itself when done)
 MAIN_LOOP: Optional[asyncio.AbstractEventLoop] = None # The main event loop (None until it’s assigned)
 GLOBAL_PARAMS: Dict[str, str] = {} # A dictionary of global parameters for the bot
 LUNA_LOCK_FILE = "/tmp/luna.pid"
-# Store processed event IDs globally (or in a cache with TTL)
-PROCESSED_EVENTS: set = set()
+# Recently processed event IDs, oldest first; bounded to PROCESSED_EVENTS_MAX
+# entries (the oldest is evicted on insert) so memory can't grow without limit.
+PROCESSED_EVENTS: "collections.OrderedDict[str, None]" = collections.OrderedDict()
+PROCESSED_EVENTS_MAX: int = 4096
 # Example global registry of atomic node functions
 
 NODE_REGISTRY: Dict[str, Callable] = {} #  Each entry is: "node_name": some_function
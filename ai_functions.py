@@ -7,14 +7,28 @@ context input, response output, and timings.
 """
 
 import os
+import asyncio
 import logging
 import openai
 import time
-from nio import AsyncClient, UploadResponse
-import requests
+import json
+import hashlib
+import collections
+from nio import AsyncClient
+import aiohttp
+import httpx
 from dotenv import load_dotenv
 from openai import AsyncOpenAI
 
+from luna import context_helper
+
+from luna.luna_command_extensions.image_helpers import (
+    get_http_session,
+    download_to_file,
+    direct_upload_image,
+    ensure_images_dir,
+)
+
 logger = logging.getLogger(__name__)
 # You can adjust to DEBUG or more granular if you prefer:
 logger.setLevel(logging.DEBUG)
@@ -31,23 +45,52 @@ openai.api_key = OPENAI_API_KEY
 if not OPENAI_API_KEY:
     logger.warning("[ai_functions] No OPENAI_API_KEY found in env variables.")
 
-# We typically create an AsyncOpenAI client if using the async approach:
+# We typically create an AsyncOpenAI client if using the async approach.
+# Every GPT caller shares this one client, so its keep-alive pool is sized for
+# several rooms talking at once.
 try:
-    client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    client = AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+        ),
+    )
 except Exception as e:
     logger.exception("[ai_functions] Could not instantiate AsyncOpenAI client => %s", e)
     client = None
 
+# Fallback replies returned by get_gpt_response on failure (never cached).
+_BACKEND_UNAVAILABLE_REPLY = "I'm sorry, but my AI backend is not available right now."
+_GPT_ERROR_REPLY = (
+    "I'm sorry, something went wrong on my end. "
+    "Could you try again later?"
+)
+
+# Short-lived LRU of recent GPT replies, keyed by a hash of the full request
+# (model, sampling params and the entire context chain).
+_GPT_CACHE_MAX = 256
+_GPT_CACHE_TTL = 30.0  # seconds
+_gpt_cache = collections.OrderedDict()  # key -> (stored_at, reply)
+_gpt_inflight = {}  # key -> asyncio.Task, so identical concurrent requests share one call
+
+# Cache policy for call_gpt_for_room: only near-deterministic sampling is worth
+# caching; at role-play temperatures a cached answer just repeats itself.
+GPT_CACHE_ENABLED = True
+GPT_CACHE_MAX_TEMPERATURE = 0.3
+
 
 async def get_gpt_response(
     messages: list,
     model: str = "gpt-4o", # @TODO: make this a configuration based parameter, settable in luna-element command console
     temperature: float = 0.7,
-    max_tokens: int = 1000
+    max_tokens: int = 1000,
+    response_format: dict = None
 ) -> str:
     """
     Sends `messages` (a conversation array) to GPT and returns the text
-    from the first choice. We log everything at DEBUG level:
+    from the first choice. Pass response_format={"type": "json_object"} to
+    have the API guarantee a parseable JSON object. We log everything at DEBUG level:
       - The final messages array
       - The model, temperature, max_tokens
       - Any errors or exceptions
@@ -61,7 +104,11 @@ async def get_gpt_response(
     if not client:
         err_msg = "[get_gpt_response] No AsyncOpenAI client is available!"
         logger.error(err_msg)
-        return "I'm sorry, but my AI backend is not available right now."
+        return _BACKEND_UNAVAILABLE_REPLY
+
+    extra_args = {}
+    if response_format is not None:
+        extra_args["response_format"] = response_format
 
     t0 = time.time()
     try:
@@ -70,6 +117,7 @@ async def get_gpt_response(
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens,
+            **extra_args,
         )
         elapsed = time.time() - t0
 
@@ -85,10 +133,214 @@ async def get_gpt_response(
     except Exception as e:
         # This catches any other error type
         logger.exception("[get_gpt_response] Unhandled exception calling GPT => %s", e)
-        return (
-            "I'm sorry, something went wrong on my end. "
-            "Could you try again later?"
-        )
+        return _GPT_ERROR_REPLY
+
+async def stream_gpt_response(
+    messages: list,
+    model: str = "gpt-4o",
+    temperature: float = 0.7,
+    max_tokens: int = 1000,
+    response_format: dict = None
+):
+    """
+    Streaming flavour of get_gpt_response: an async generator that yields the
+    reply text piece by piece as GPT produces it. Unlike get_gpt_response,
+    errors are raised rather than turned into a fallback reply, because the
+    caller may already have acted on part of the stream.
+    """
+    logger.debug("[stream_gpt_response] model=%s, temperature=%.2f, max_tokens=%d, messages=%d",
+                 model, temperature, max_tokens, len(messages))
+
+    if not client:
+        raise RuntimeError("No AsyncOpenAI client is available!")
+
+    extra_args = {}
+    if response_format is not None:
+        extra_args["response_format"] = response_format
+
+    t0 = time.time()
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=True,
+        **extra_args,
+    )
+    async for chunk in stream:
+        if chunk.choices:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    logger.debug("[stream_gpt_response] Stream finished (%.3fs).", time.time() - t0)
+
+async def stream_json_array_elements(chunks):
+    """
+    Tiny bracket counter over a streamed JSON array (e.g. stream_gpt_response's
+    chunks): yields the raw text of each complete element of the first array
+    as soon as its closing brace arrives, without waiting for the rest of the
+    array. Anything before the opening '[' (a stray code fence, or the
+    '{"key":' of a JSON-mode object wrapping the array) is ignored.
+    Raises ValueError if the stream never contains a JSON array.
+    """
+    started = False
+    finished = False
+    depth = 0
+    in_string = False
+    escaped = False
+    buf = []
+
+    async for text in chunks:
+        if finished:
+            continue
+        for ch in text:
+            if not started:
+                if ch == "[":
+                    started = True
+                    depth = 1
+                continue
+            if in_string:
+                buf.append(ch)
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+                continue
+            if ch == '"':
+                in_string = True
+                buf.append(ch)
+            elif ch in "[{":
+                depth += 1
+                buf.append(ch)
+            elif ch in "]}":
+                depth -= 1
+                if depth == 0:
+                    finished = True
+                else:
+                    buf.append(ch)
+            elif ch == "," and depth == 1:
+                element = "".join(buf).strip()
+                buf.clear()
+                if element:
+                    yield element
+            else:
+                buf.append(ch)
+
+            if finished:
+                element = "".join(buf).strip()
+                buf.clear()
+                if element:
+                    yield element
+                break
+
+    if not started:
+        raise ValueError("GPT returned something that's not a JSON array.")
+
+async def get_gpt_response_cached(
+    messages: list,
+    model: str = "gpt-4o",
+    temperature: float = 0.7,
+    max_tokens: int = 1000
+) -> str:
+    """
+    Same as get_gpt_response, but serves an identical request (same model,
+    temperature, max_tokens and messages) from a short-TTL LRU cache. Meant for
+    chat replies, where several mentions in quick succession often build the
+    exact same context. Error fallbacks are not cached.
+
+    The key hashes the whole messages array, not just the latest user line, so
+    a follow-up like "make it red" only hits when the conversation leading up
+    to it matches too. Any looser (e.g. embedding-based) lookup added here must
+    keep that context check, or short follow-ups will get other rooms' answers.
+    """
+    key = hashlib.blake2b(
+        json.dumps([model, temperature, max_tokens, messages], sort_keys=True).encode(),
+        digest_size=16,
+    ).hexdigest()
+
+    now = time.monotonic()
+    cached = _gpt_cache.get(key)
+    if cached is not None:
+        stored_at, reply = cached
+        if now - stored_at <= _GPT_CACHE_TTL:
+            _gpt_cache.move_to_end(key)
+            logger.debug("[get_gpt_response_cached] Cache hit for key=%s", key)
+            return reply
+        del _gpt_cache[key]
+
+    # Same request already on the wire => wait for that one instead.
+    task = _gpt_inflight.get(key)
+    if task is not None:
+        logger.debug("[get_gpt_response_cached] Joining in-flight call for key=%s", key)
+        return await asyncio.shield(task)
+
+    task = asyncio.ensure_future(get_gpt_response(
+        messages=messages,
+        model=model,
+        temperature=temperature,
+        max_tokens=max_tokens,
+    ))
+    _gpt_inflight[key] = task
+    try:
+        reply = await asyncio.shield(task)
+    finally:
+        if task.done():
+            _gpt_inflight.pop(key, None)
+        else:
+            task.add_done_callback(lambda _t: _gpt_inflight.pop(key, None))
+
+    if reply not in (_BACKEND_UNAVAILABLE_REPLY, _GPT_ERROR_REPLY):
+        _gpt_cache[key] = (time.monotonic(), reply)
+        if len(_gpt_cache) > _GPT_CACHE_MAX:
+            _gpt_cache.popitem(last=False)
+    return reply
+
+def select_gpt_fn(temperature: float, use_cache: bool = None):
+    """
+    Returns get_gpt_response_cached or get_gpt_response for a call at
+    `temperature`, applying the cache policy above. `use_cache` forces the
+    choice; by default only temperature <= GPT_CACHE_MAX_TEMPERATURE is cached.
+    """
+    if use_cache is None:
+        use_cache = temperature <= GPT_CACHE_MAX_TEMPERATURE
+    return get_gpt_response_cached if (GPT_CACHE_ENABLED and use_cache) else get_gpt_response
+
+async def call_gpt_for_room(
+    bot_localpart: str,
+    room_id: str,
+    user_message: str,
+    model: str = "gpt-4o",
+    temperature: float = 0.7,
+    max_tokens: int = 2000,
+    max_history: int = 10,
+    use_cache: bool = None,
+    event_id: str = None
+) -> str:
+    """
+    Builds the bot's context for `room_id`, appends `user_message` and asks GPT
+    for a reply. `use_cache` forces the response cache on or off; by default it
+    is used only when temperature <= GPT_CACHE_MAX_TEMPERATURE.
+
+    Pass the event_id `user_message` came from if it has already been handed to
+    the message store, so it isn't also picked up from the history.
+    """
+    gpt_context = await asyncio.to_thread(
+        context_helper.build_context, bot_localpart, room_id, {"max_history": max_history},
+        exclude_event_id=event_id
+    )
+    gpt_context.append({"role": "user", "content": user_message.strip()})
+    logger.debug("[call_gpt_for_room] GPT context => %s", gpt_context)
+
+    gpt_fn = select_gpt_fn(temperature, use_cache)
+
+    return await gpt_fn(
+        messages=gpt_context,
+        model=model,
+        temperature=temperature,
+        max_tokens=max_tokens,
+    )
     
 async def generate_image(prompt: str, size: str = "1024x1024") -> str:
     """
@@ -123,9 +375,10 @@ async def generate_image(prompt: str, size: str = "1024x1024") -> str:
         }
 
         logger.debug("Sending request to OpenAI: %s", data)
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        image_url = response.json()["data"][0]["url"]
+        async with get_http_session().post(url, headers=headers, json=data) as response:
+            response.raise_for_status()
+            response_data = await response.json()
+        image_url = response_data["data"][0]["url"]
         logger.info("Generated image URL: %s", image_url)
         return image_url
     except Exception as e:
@@ -174,10 +427,10 @@ async def generate_image_save_and_post(
             "size": size
         }
 
-        # Make the request to OpenAI
-        resp = requests.post(url, headers=headers, json=data)
-        resp.raise_for_status()      # Raises an HTTPError if the request failed
-        response_data = resp.json()
+        # Make the request to OpenAI (over the shared, pooled session)
+        async with get_http_session().post(url, headers=headers, json=data) as resp:
+            resp.raise_for_status()      # Raises ClientResponseError if the request failed
+            response_data = await resp.json()
 
         # Extract the URL for the generated image
         image_url = response_data["data"][0]["url"]
@@ -188,30 +441,23 @@ async def generate_image_save_and_post(
 
     # 2) Save image to disk
     try:
-        os.makedirs("data/images", exist_ok=True)
+        await ensure_images_dir()
         timestamp = int(time.time())
         filename = f"data/images/image_{timestamp}.jpg"
-        dl_resp = requests.get(image_url)
-        if dl_resp.status_code == 200:
-            with open(filename, "wb") as file:
-                file.write(dl_resp.content)
-            logger.info("Image saved to %s", filename)
-        else:
-            logger.error("Failed to download image from %s (HTTP %d)",
-                         image_url, dl_resp.status_code)
-            return
+        file_size = await download_to_file(image_url, filename)
+        logger.info("Image saved to %s", filename)
+    except aiohttp.ClientResponseError as e:
+        logger.error("Failed to download image from %s (HTTP %d)",
+                     image_url, e.status)
+        return
     except Exception as e:
         logger.exception("Error saving image to disk: %s", e)
         return
 
     # 3) Upload image to Matrix
     try:
-        with open(filename, "rb") as file:
-            upload_resp = await client.upload(file, content_type="image/jpeg")
-            if not isinstance(upload_resp, UploadResponse):
-                logger.error("Error uploading image to Matrix: %s", upload_resp)
-                return
-            mxc_uri = upload_resp.content_uri
+        # Streams the file in chunks read off the event loop
+        mxc_uri = await direct_upload_image(client, filename, "image/jpeg")
     except Exception as e:
         logger.exception("Error uploading image to Matrix: %s", e)
         return
@@ -223,7 +469,7 @@ async def generate_image_save_and_post(
         "url": mxc_uri,
         "info": {
             "mimetype": "image/jpeg",
-            "size": os.path.getsize(filename),
+            "size": file_size,
         },
     }
 
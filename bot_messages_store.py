@@ -9,6 +9,11 @@ We keep the same 4 main functions:
     save_messages()
     append_message(bot_localpart, room_id, event_id, sender, timestamp, body)
     get_messages_for_bot(bot_localpart)
+plus has_event(bot_localpart, event_id) for cheap duplicate checks,
+append_messages(rows) for writing several rows in one transaction,
+get_recent_messages(bot_localpart, room_id, limit) for bounded history reads (served
+from a per-room in-memory ring buffer once warm), and
+enqueue_messages(rows) / run_writer() for batched writes off the event loop.
 
 Internally, we rely on a table named "bot_messages" with columns:
     id          INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -27,15 +32,38 @@ Notes:
 """
 
 import os
+import asyncio
 import logging
 import sqlite3
-from typing import List, Dict
+import threading
+from collections import deque
+from typing import List, Dict, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
 # Adjust if desired
 BOT_MESSAGES_DB = "data/bot_messages.db"
 
+# Insert statement shared by append_message() / append_messages().
+_INSERT_SQL = """
+INSERT INTO bot_messages (bot_localpart, room_id, event_id, sender, timestamp, body)
+VALUES (:bot_localpart, :room_id, :event_id, :sender, :timestamp, :body)
+"""
+
+# Rows waiting for the background writer (see run_writer). None while the
+# writer isn't running, in which case enqueue_messages() writes directly.
+_WRITE_BATCH_MAX = 64
+_write_queue: Optional[asyncio.Queue] = None
+
+# Per-(bot_localpart, room_id) ring buffer of the newest rows, so building GPT
+# context every turn doesn't re-query SQLite. A room's buffer is filled from the
+# DB on its first read; after that append_messages() just pushes new rows on.
+# The lock also covers the insert itself, so a row can't land in the DB and in
+# a buffer being warmed from that same DB twice.
+_RECENT_ROWS_MAX = 64
+_recent_rows: Dict[Tuple[str, str], deque] = {}
+_recent_lock = threading.Lock()
+
 # In-memory cache (optional, to mimic the old JSON approach).
 # If you prefer to query the DB on each call, you can skip this.
 _in_memory_list: List[Dict] = []
@@ -63,10 +91,22 @@ def load_messages() -> None:
         timestamp INTEGER,
         body TEXT
     )"""
+    # Lets has_event() answer from the index instead of scanning the table.
+    index_sql = """
+    CREATE INDEX IF NOT EXISTS idx_bot_messages_bot_event
+    ON bot_messages (bot_localpart, event_id)"""
+    # Lets get_recent_messages() read the newest N rows of a room directly.
+    room_index_sql = """
+    CREATE INDEX IF NOT EXISTS idx_bot_messages_bot_room_ts
+    ON bot_messages (bot_localpart, room_id, timestamp)"""
     try:
         conn = sqlite3.connect(BOT_MESSAGES_DB)
         c = conn.cursor()
+        # WAL is persistent on the DB file; readers no longer block the writer.
+        c.execute("PRAGMA journal_mode=WAL")
         c.execute(create_sql)
+        c.execute(index_sql)
+        c.execute(room_index_sql)
         conn.commit()
         # 2) Load all messages into _in_memory_list
         rows = c.execute("SELECT bot_localpart, room_id, event_id, sender, timestamp, body FROM bot_messages").fetchall()
@@ -118,33 +158,82 @@ def append_message(
     :param timestamp: e.g. 1736651234567
     :param body: message text
     """
+    append_messages([{
+        "bot_localpart": bot_localpart,
+        "room_id": room_id,
+        "event_id": event_id,
+        "sender": sender,
+        "timestamp": timestamp,
+        "body": body
+    }])
+
+
+def append_messages(rows: List[Dict]) -> None:
+    """
+    Inserts several rows (dicts with the same keys as append_message's
+    parameters) using a single executemany() in one transaction, and keeps the
+    in-memory list in sync.
+    """
     global _in_memory_list
+    if not rows:
+        return
     try:
-        conn = sqlite3.connect(BOT_MESSAGES_DB)
-        c = conn.cursor()
+        with _recent_lock:
+            conn = sqlite3.connect(BOT_MESSAGES_DB)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.executemany(_INSERT_SQL, rows)
+            conn.close()
 
-        insert_sql = """
-        INSERT INTO bot_messages (bot_localpart, room_id, event_id, sender, timestamp, body)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """
-        c.execute(insert_sql, (bot_localpart, room_id, event_id, sender, timestamp, body))
-        conn.commit()
-        conn.close()
+            # Keep any warm per-room buffers current
+            for row in rows:
+                buf = _recent_rows.get((row["bot_localpart"], row["room_id"]))
+                if buf is not None:
+                    buf.append(dict(row))
 
         # Optionally keep our in-memory list in sync
-        record = {
-            "bot_localpart": bot_localpart,
-            "room_id": room_id,
-            "event_id": event_id,
-            "sender": sender,
-            "timestamp": timestamp,
-            "body": body
-        }
-        _in_memory_list.append(record)
-
-        logger.info(f"Inserted event_id={event_id} for bot={bot_localpart} into DB.")
+        _in_memory_list.extend(dict(row) for row in rows)
+
+        logger.info(
+            f"Inserted {len(rows)} row(s) for bot={rows[0]['bot_localpart']} into DB."
+        )
     except Exception as e:
-        logger.exception(f"Error inserting message => {e}")
+        logger.exception(f"Error inserting messages => {e}")
+
+
+def enqueue_messages(rows: List[Dict]) -> None:
+    """
+    Hands rows to the background writer without blocking the caller. Falls
+    back to a direct append_messages() when the writer isn't running.
+    """
+    if _write_queue is None:
+        append_messages(rows)
+        return
+    for row in rows:
+        _write_queue.put_nowait(row)
+
+
+async def run_writer() -> None:
+    """
+    Long-running task that drains the write queue: waits for one row, takes
+    whatever else has piled up (up to _WRITE_BATCH_MAX), and commits the batch
+    in a worker thread. On cancellation, anything still queued is written
+    before the task exits.
+    """
+    global _write_queue
+    queue = _write_queue = asyncio.Queue()
+    try:
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < _WRITE_BATCH_MAX and not queue.empty():
+                batch.append(queue.get_nowait())
+            await asyncio.to_thread(append_messages, batch)
+    finally:
+        _write_queue = None
+        leftover = []
+        while not queue.empty():
+            leftover.append(queue.get_nowait())
+        append_messages(leftover)
 
 
 def get_messages_for_bot(bot_localpart: str) -> List[Dict]:
@@ -188,3 +277,123 @@ def get_messages_for_bot(bot_localpart: str) -> List[Dict]:
         logger.exception(f"Error selecting messages => {e}")
         return []
 
+
+
+def get_recent_messages(
+    bot_localpart: str,
+    room_id: str,
+    limit: int,
+    skip_commands: bool = False
+) -> List[Dict]:
+    """
+    Returns at most `limit` of the newest messages for (bot_localpart, room_id),
+    oldest first (ties broken by insertion order, so the same rows always come
+    back in the same order). With skip_commands=True, rows whose body starts
+    with '!' or carries the SYSTEM RESPONSE context cue are excluded before the
+    limit is applied.
+
+    Served from the room's in-memory ring buffer when it holds enough rows;
+    only the first read for a room, or a filter that leaves too few buffered
+    rows, goes to SQLite.
+    """
+    key = (bot_localpart, room_id)
+    with _recent_lock:
+        buf = _recent_rows.get(key)
+        if buf is None:
+            warm_rows = _select_recent_messages(bot_localpart, room_id, _RECENT_ROWS_MAX, False)
+            if warm_rows is None:
+                return []
+            buf = _recent_rows[key] = deque(warm_rows, maxlen=_RECENT_ROWS_MAX)
+        rows = [row for row in buf if not (skip_commands and _is_command_or_system(row["body"]))]
+        # A buffer that isn't full holds the room's whole history.
+        complete = len(buf) < _RECENT_ROWS_MAX
+
+    if len(rows) >= limit or complete:
+        results = [dict(row) for row in rows[-limit:]] if limit > 0 else []
+        logger.debug(f"Served {len(results)} recent messages for '{bot_localpart}' in {room_id} from memory.")
+        return results
+
+    return _select_recent_messages(bot_localpart, room_id, limit, skip_commands) or []
+
+
+def _is_command_or_system(body: Optional[str]) -> bool:
+    """
+    Python twin of the skip_commands SQL filter in _select_recent_messages().
+    """
+    if body is None:
+        return True  # NULL never passes the SQL filter either
+    return body.startswith("!") or 'context_cue": "SYSTEM RESPONSE' in body
+
+
+def _select_recent_messages(
+    bot_localpart: str,
+    room_id: str,
+    limit: int,
+    skip_commands: bool
+) -> Optional[List[Dict]]:
+    """
+    The SQLite query behind get_recent_messages(). Returns None if the query
+    fails, so a failed read never gets cached as an empty room.
+    """
+    filter_sql = ""
+    if skip_commands:
+        filter_sql = """
+        AND body NOT LIKE '!%'
+        AND instr(body, 'context_cue": "SYSTEM RESPONSE') = 0
+        """
+
+    try:
+        conn = sqlite3.connect(BOT_MESSAGES_DB)
+        c = conn.cursor()
+        select_sql = f"""
+        SELECT bot_localpart, room_id, event_id, sender, timestamp, body
+        FROM bot_messages
+        WHERE bot_localpart = ? AND room_id = ?
+        {filter_sql}
+        ORDER BY timestamp DESC, id DESC
+        LIMIT ?
+        """
+        rows = c.execute(select_sql, (bot_localpart, room_id, limit)).fetchall()
+        conn.close()
+
+        results = [
+            {
+                "bot_localpart": row[0],
+                "room_id": row[1],
+                "event_id": row[2],
+                "sender": row[3],
+                "timestamp": row[4],
+                "body": row[5],
+            }
+            for row in reversed(rows)
+        ]
+
+        logger.info(f"Found {len(results)} recent messages for '{bot_localpart}' in {room_id}.")
+        return results
+
+    except Exception as e:
+        logger.exception(f"Error selecting recent messages => {e}")
+        return None
+
+
+def has_event(bot_localpart: str, event_id: str) -> bool:
+    """
+    Returns True if the given event_id is already stored for this bot.
+    Uses the (bot_localpart, event_id) index, so it stays O(1)-ish no matter
+    how much history the bot has accumulated.
+    """
+    try:
+        conn = sqlite3.connect(BOT_MESSAGES_DB)
+        c = conn.cursor()
+        select_sql = """
+        SELECT 1 FROM bot_messages
+        WHERE bot_localpart = ? AND event_id = ?
+        LIMIT 1
+        """
+        row = c.execute(select_sql, (bot_localpart, event_id)).fetchone()
+        conn.close()
+        return row is not None
+
+    except Exception as e:
+        logger.exception(f"Error checking for event => {e}")
+        return False
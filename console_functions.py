@@ -16,7 +16,7 @@ from luna import luna_functions
 from nio.api import RoomVisibility
 from luna.luna_functions import DIRECTOR_CLIENT
 import asyncio
-from luna.luna_command_extensions.create_room import create_room
+from luna.luna_command_extensions.create_room import create_room_return_id
 from luna.luna_command_extensions.cmd_remove_room import cmd_remove_room
 from luna.luna_personas import get_system_prompt_by_localpart, set_system_prompt_by_localpart
 from luna.luna_command_extensions.cmd_shutdown import request_shutdown
@@ -443,18 +443,15 @@ def _print_rooms_table(rooms_info: list[dict]):
     """
     # Build a header line with fixed-width columns
     header = f"{'NAME':30} | {'ROOM ID':35} | {'COUNT':5} | PARTICIPANTS"
-    print(header)
-    print("-" * 105)  # or 90, depending on how wide you like
 
-    for room in rooms_info:
-        name = (room['name'] or "(unnamed)")[:30]
-        room_id = room['room_id']
-        count = room['joined_members_count']
-        participants_str = ", ".join(room['participants'])
-
-        # Format each row to match the header widths
-        row = f"{name:30} | {room_id:35} | {count:5} | {participants_str}"
-        print(row)
+    # Format each row to match the header widths, then emit the whole table
+    # with a single print instead of one write per row.
+    rows = (
+        f"{(room['name'] or '(unnamed)')[:30]:30} | {room['room_id']:35} | "
+        f"{room['joined_members_count']:5} | {', '.join(room['participants'])}"
+        for room in rooms_info
+    )
+    print("\n".join([header, "-" * 105, *rows]))  # or 90, depending on how wide you like
 
 def cmd_list_users(args, loop):
     """
@@ -493,17 +490,15 @@ def _print_users_table(users_info: list[dict]):
       USER ID (up to ~25 chars) | ADMIN | DEACT | DISPLAYNAME
     """
     header = f"{'USER ID':25} | {'ADMIN':5} | {'DEACT'} | DISPLAYNAME"
-    print(header)
-    print("-" * 70)
-
-    for user in users_info:
-        user_id = (user['user_id'] or "")[:25]
-        admin_str = "Yes" if user.get("admin") else "No"
-        deact_str = "Yes" if user.get("deactivated") else "No"
-        display = user.get("displayname") or ""
 
-        row = f"{user_id:25} | {admin_str:5} | {deact_str:5} | {display}"
-        print(row)
+    rows = (
+        f"{(user['user_id'] or '')[:25]:25} | "
+        f"{'Yes' if user.get('admin') else 'No':5} | "
+        f"{'Yes' if user.get('deactivated') else 'No':5} | "
+        f"{user.get('displayname') or ''}"
+        for user in users_info
+    )
+    print("\n".join([header, "-" * 70, *rows]))
 
 def cmd_invite_user(args, loop):
     """
@@ -527,6 +522,21 @@ def cmd_invite_user(args, loop):
     user_id = parts[0]
     room_id_or_alias = parts[1]
 
+    # Block until the invite actually comes back.
+    future = asyncio.run_coroutine_threadsafe(
+        do_invite_user(user_id, room_id_or_alias),
+        loop
+    )
+
+    try:
+        result_msg = future.result()
+    except Exception as e:
+        print(f"SYSTEM: Error inviting user => {e}")
+        return None
+
+    print(f"SYSTEM: {result_msg}")
+    return result_msg
+
 import logging
 import asyncio
 import aiohttp
@@ -550,12 +560,9 @@ async def do_invite_user(user: str, room: str) -> str:
 
     # 1) Force a short sync so our client state is up-to-date:
     try:
-        # Run a blocking sync in the current thread
-        sync_future = asyncio.run_coroutine_threadsafe(
-            client.sync(timeout=1000),  # 1-second sync
-            luna_functions.MAIN_LOOP  # or your existing loop reference
-        )
-        sync_future.result()
+        # We're already running on the event loop, so await the sync directly
+        # (blocking on a future scheduled onto this same loop would deadlock).
+        await client.sync(timeout=1000)  # 1-second sync
         logger.debug("[do_invite_user] Sync completed before invite.")
     except Exception as sync_e:
         logger.exception("Sync error before inviting user:")
@@ -643,21 +650,23 @@ def cmd_create_room(args, loop):
 
     We'll pass the entire 'args' to create_room(...) so it can parse
     out the room name and flags with shlex.
+
+    Blocks until the room is created and returns its room ID (None on failure).
     """
 
     future = asyncio.run_coroutine_threadsafe(
-        create_room(args),  # <== note: just 'args'
+        create_room_return_id(args),  # <== note: just 'args'
         loop
     )
 
-    def on_done(fut):
-        try:
-            result_msg = fut.result()
-            print(f"SYSTEM: {result_msg}")
-        except Exception as e:
-            print(f"SYSTEM: Error creating room => {e}")
+    try:
+        room_id, result_msg = future.result()
+    except Exception as e:
+        print(f"SYSTEM: Error creating room => {e}")
+        return None
 
-    future.add_done_callback(on_done)
+    print(f"SYSTEM: {result_msg}")
+    return room_id
 
 def cmd_get_bot_system_prompt(args, loop):
     """
@@ -834,7 +843,9 @@ def cmd_run_json_script(args, loop):
     print(f"SYSTEM: Executing script from '{script_file}'...")
     logger.debug("[cmd_run_json_script] Invoking parse_and_execute(...)")
     try:
-        parse_and_execute(script_str, loop)
+        # The script runs on the bot's loop; the console just waits for it.
+        future = asyncio.run_coroutine_threadsafe(parse_and_execute(script_str), loop)
+        future.result()
         logger.debug("[cmd_run_json_script] parse_and_execute completed.")
     except Exception as e:
         logger.exception("[cmd_run_json_script] parse_and_execute threw an exception: %s", e)
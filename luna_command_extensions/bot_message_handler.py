@@ -3,6 +3,8 @@
 import logging
 import time
 import re
+import asyncio
+import collections
 # import urllib.parse  # We won’t use URL-encoding for now
 from nio import RoomMessageText, RoomSendResponse
 
@@ -10,12 +12,43 @@ from nio import RoomMessageText, RoomSendResponse
 from luna import bot_messages_store         # or wherever you store your messages
 import luna.context_helper as context_helper # your GPT context builder
 from luna import ai_functions                # your GPT API logic
+import luna.GLOBALS as g
 
 logger = logging.getLogger(__name__)
-BOT_START_TIME = time.time() * 1000
 # Regex to capture Matrix-style user mentions like "@username:domain"
 MENTION_REGEX = re.compile(r"(@[A-Za-z0-9_\-\.]+:[A-Za-z0-9_\-\.]+)")
 
+# LRU of recently handled (bot_localpart, event_id) pairs, checked before
+# falling through to the DB.
+_SEEN_EVENTS_MAX = 4096
+_SEEN_EVENTS = collections.OrderedDict()
+
+def _already_seen(bot_localpart: str, event_id: str) -> bool:
+    """
+    True if this bot has already stored the event. Checks the in-process LRU
+    first, then the message store.
+    """
+    key = (bot_localpart, event_id)
+    if key in _SEEN_EVENTS:
+        _SEEN_EVENTS.move_to_end(key)
+        return True
+    return bot_messages_store.has_event(bot_localpart, event_id)
+
+def _mark_seen(bot_localpart: str, event_id: str) -> None:
+    """
+    Record a handled event in the LRU, evicting the oldest entry when full.
+    """
+    _SEEN_EVENTS[(bot_localpart, event_id)] = None
+    _SEEN_EVENTS.move_to_end((bot_localpart, event_id))
+    if len(_SEEN_EVENTS) > _SEEN_EVENTS_MAX:
+        _SEEN_EVENTS.popitem(last=False)
+
+async def _start_typing(bot_client, room_id: str) -> None:
+    try:
+        await bot_client.room_typing(room_id, True, timeout=30000)
+    except Exception as e:
+        logger.warning(f"Could not send 'typing start' indicator => {e}")
+
 def build_mention_content(original_text: str) -> dict:
     """
     Scans the GPT reply for mentions like '@helpfulharry:localhost' and
@@ -25,24 +58,18 @@ def build_mention_content(original_text: str) -> dict:
     We are NOT URL-encoding @ or underscores here—just a simple replacement.
     """
 
-    # Find all mention strings (user IDs)
-    matches = MENTION_REGEX.findall(original_text)
-    html_text = original_text
-
-    # We'll collect user IDs for 'm.mentions' here
-    user_ids = []
+    # Single pass over the text: wrap each mention in a matrix.to link and
+    # collect the user IDs (deduplicated, in order of first appearance).
+    # Example mention: "@helpful_harry:localhost"
+    # => <a href="https://matrix.to/#/@helpful_harry:localhost">@helpful_harry:localhost</a>
+    user_ids = {}
 
-    for mention in matches:
-        user_ids.append(mention)
-        # Example mention: "@helpful_harry:localhost"
-        # We'll make a link like: <a href="https://matrix.to/#/@helpful_harry:localhost">@helpful_harry:localhost</a>
-        url = f"https://matrix.to/#/{mention}"
+    def _link_mention(match):
+        mention = match.group(1)
+        user_ids[mention] = None
+        return f'<a href="https://matrix.to/#/{mention}">{mention}</a>'
 
-        # The link text remains the original mention (with '@')
-        html_link = f'<a href="{url}">{mention}</a>'
-
-        # Replace plain mention with the linked mention in the HTML text
-        html_text = html_text.replace(mention, html_link)
+    html_text = MENTION_REGEX.sub(_link_mention, original_text)
 
     # Construct the final content dict
     content = {
@@ -54,7 +81,7 @@ def build_mention_content(original_text: str) -> dict:
 
     # If we found any mentions, add them to 'm.mentions'
     if user_ids:
-        content["m.mentions"] = {"user_ids": user_ids}
+        content["m.mentions"] = {"user_ids": list(user_ids)}
 
     return content
 
@@ -63,7 +90,7 @@ async def handle_bot_room_message(bot_client, bot_localpart, room, event):
     A “mention or DM” style message handler with GPT-based replies + message store.
     """
     # do not respond to messages from the past, under any circumstances
-    if event.server_timestamp < BOT_START_TIME:
+    if event.server_timestamp < g.BOT_START_TIME:
         logger.debug("Skipping old event => %s", event.event_id)
         return
 
@@ -76,26 +103,41 @@ async def handle_bot_room_message(bot_client, bot_localpart, room, event):
         return
 
     # 2) Check for duplicates by event_id
-    existing_msgs = bot_messages_store.get_messages_for_bot(bot_localpart)
-    if any(m["event_id"] == event.event_id for m in existing_msgs):
+    if _already_seen(bot_localpart, event.event_id):
         logger.info(
             f"[handle_bot_room_message] Bot '{bot_localpart}' sees event_id={event.event_id} "
             "already stored => skipping."
         )
         return
 
-    # 3) Store the inbound text message
-    bot_messages_store.append_message(
-        bot_localpart=bot_localpart,
-        room_id=room.room_id,
-        event_id=event.event_id,
-        sender=event.sender,
-        timestamp=event.server_timestamp,
-        body=event.body or ""
-    )
-    logger.debug(
-        f"[handle_bot_room_message] Bot '{bot_localpart}' stored inbound event_id={event.event_id}."
-    )
+    # 3) Buffer the inbound text message; it is written together with our
+    #    reply (if any) in a single batch once we're done.
+    _mark_seen(bot_localpart, event.event_id)
+    pending_rows = [{
+        "bot_localpart": bot_localpart,
+        "room_id": room.room_id,
+        "event_id": event.event_id,
+        "sender": event.sender,
+        "timestamp": event.server_timestamp,
+        "body": event.body or "",
+    }]
+    try:
+        outbound_row = await _reply_if_addressed(bot_client, bot_localpart, room, event)
+        if outbound_row:
+            pending_rows.append(outbound_row)
+    finally:
+        bot_messages_store.enqueue_messages(pending_rows)
+        logger.debug(
+            f"[handle_bot_room_message] Bot '{bot_localpart}' stored {len(pending_rows)} row(s) "
+            f"for event_id={event.event_id}."
+        )
+
+async def _reply_if_addressed(bot_client, bot_localpart, room, event):
+    """
+    Sends a GPT reply if the message is a DM or mentions the bot.
+    Returns the outbound message row to store, or None if we didn't post.
+    """
+    bot_full_id = bot_client.user
 
     # 4) Determine if we should respond (DM => always, group => only if mentioned)
     participant_count = len(room.users)
@@ -116,20 +158,26 @@ async def handle_bot_room_message(bot_client, bot_localpart, room, event):
         logger.debug(
             f"Bot '{bot_localpart}' ignoring group message with no mention. (room={room.room_id})"
         )
-        return
+        return None
 
     # -- BOT INDICATES TYPING START --
-    try:
-        await bot_client.room_typing(room.room_id, True, timeout=30000)
-    except Exception as e:
-        logger.warning(f"Could not send 'typing start' indicator => {e}")
-
-    # 5) Build GPT context (the last N messages, plus a system prompt if you want)
+    # 5) Build GPT context (the last N messages, plus a system prompt if you want).
+    #    The typing notification and the DB read are independent, so run them
+    #    side by side. The inbound message isn't in the store yet, so add it
+    #    here, applying the same '!' command filter build_context uses for
+    #    non-luna bots.
     config = {"max_history": 20}  # adjust as needed
-    gpt_context = context_helper.build_context(bot_localpart, room.room_id, config)
+    _, gpt_context = await asyncio.gather(
+        _start_typing(bot_client, room.room_id),
+        asyncio.to_thread(context_helper.build_context, bot_localpart, room.room_id, config),
+    )
+    inbound_body = (event.body or "").strip()
+    if bot_localpart == "lunabot" or not inbound_body.startswith("!"):
+        gpt_context.append({"role": "user", "content": inbound_body})
 
-    # 6) Call GPT
-    gpt_reply = await ai_functions.get_gpt_response(
+    # 6) Call GPT (cached only if the shared temperature policy allows it)
+    gpt_fn = ai_functions.select_gpt_fn(0.7)
+    gpt_reply = await gpt_fn(
         messages=gpt_context,
         model="gpt-4",
         temperature=0.7
@@ -151,21 +199,22 @@ async def handle_bot_room_message(bot_client, bot_localpart, room, event):
     except Exception as e:
         logger.warning(f"Could not send 'typing stop' indicator => {e}")
 
-    # 9) Store outbound
+    # 9) Return outbound row for the caller to store
     if isinstance(resp, RoomSendResponse) and resp.event_id:
         outbound_eid = resp.event_id
         logger.info(
             f"Bot '{bot_localpart}' posted a GPT reply event_id={outbound_eid} in {room.room_id}."
         )
-        bot_messages_store.append_message(
-            bot_localpart=bot_localpart,
-            room_id=room.room_id,
-            event_id=outbound_eid,
-            sender=bot_full_id,
-            timestamp=int(time.time() * 1000),
-            body=gpt_reply
-        )
-    else:
-        logger.warning(
-            f"Bot '{bot_localpart}' posted GPT reply but got no official event_id (room={room.room_id})."
-        )
+        return {
+            "bot_localpart": bot_localpart,
+            "room_id": room.room_id,
+            "event_id": outbound_eid,
+            "sender": bot_full_id,
+            "timestamp": int(time.time() * 1000),
+            "body": gpt_reply,
+        }
+
+    logger.warning(
+        f"Bot '{bot_localpart}' posted GPT reply but got no official event_id (room={room.room_id})."
+    )
+    return None
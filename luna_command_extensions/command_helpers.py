@@ -3,8 +3,12 @@
 import logging
 import re
 import asyncio
+import hashlib
+import collections
 from nio import AsyncClient, RoomSendResponse
 
+from luna import bot_messages_store
+
 logger = logging.getLogger(__name__)
 
 async def _post_in_thread(
@@ -59,11 +63,75 @@ async def _post_in_thread(
         logger.exception(f"[command_helpers] Error posting in-thread => {e}")
 
 
+_HTML_TAG_RE = re.compile(r"<[^>]*>")
+
 def _strip_html_tags(text: str) -> str:
     """
     Removes all HTML tags from the given text string.
     """
-    return re.sub(r"<[^>]*>", "", text or "").strip()
+    if not text or "<" not in text:
+        return (text or "").strip()
+    return _HTML_TAG_RE.sub("", text).strip()
+
+
+# Per-bot Bloom filters over recently handled event IDs. Each bot keeps two
+# fixed-size generations: once the current one has taken _BLOOM_GEN_SIZE
+# inserts it becomes the previous one and a fresh array starts, so memory stays
+# flat (2 x 32 KiB per bot) and old IDs age out. At 4096 IDs per generation the
+# false-positive rate is around 1e-5. A Bloom hit is only a "maybe": it is
+# confirmed against a small exact LRU of the newest IDs and then the message
+# store before an event is dropped, so a false positive costs a lookup rather
+# than a lost message.
+_BLOOM_BITS = 1 << 18
+_BLOOM_HASHES = 4
+_BLOOM_GEN_SIZE = 4096
+_RECENT_EXACT_MAX = 1024
+_bloom_filters = {}  # bot_localpart -> [current, previous, inserted, recent OrderedDict]
+
+def _bloom_positions(event_id: str) -> list:
+    digest = hashlib.blake2b(event_id.encode(), digest_size=8).digest()
+    h1 = int.from_bytes(digest[:4], "little")
+    h2 = int.from_bytes(digest[4:], "little") | 1
+    return [(h1 + i * h2) & (_BLOOM_BITS - 1) for i in range(_BLOOM_HASHES)]
+
+def _bloom_contains(bits: bytearray, positions: list) -> bool:
+    return all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+def _check_and_mark_seen(bot_localpart: str, event_id: str) -> bool:
+    """
+    Returns True if this bot has handled event_id before. Otherwise records it
+    and returns False.
+    """
+    state = _bloom_filters.get(bot_localpart)
+    if state is None:
+        state = [bytearray(_BLOOM_BITS // 8), bytearray(_BLOOM_BITS // 8), 0, collections.OrderedDict()]
+        _bloom_filters[bot_localpart] = state
+    recent = state[3]
+
+    positions = _bloom_positions(event_id)
+    if _bloom_contains(state[0], positions) or _bloom_contains(state[1], positions):
+        # The exact LRU also covers rows still queued for the store's writer.
+        if event_id in recent:
+            recent.move_to_end(event_id)
+            return True
+        if bot_messages_store.has_event(bot_localpart, event_id):
+            return True
+        logger.debug("Bloom false positive for %s (%s); handling it.", event_id, bot_localpart)
+
+    if state[2] >= _BLOOM_GEN_SIZE:
+        state[1] = state[0]
+        state[0] = bytearray(_BLOOM_BITS // 8)
+        state[2] = 0
+
+    current = state[0]
+    for p in positions:
+        current[p >> 3] |= 1 << (p & 7)
+    state[2] += 1
+
+    recent[event_id] = None
+    if len(recent) > _RECENT_EXACT_MAX:
+        recent.popitem(last=False)
+    return False
 
 
 async def _keep_typing(bot_client: AsyncClient, room_id: str, refresh_interval=3):
@@ -14,13 +14,12 @@ import inspect
 import shlex
 import os
 import time
-import requests
 from nio import AsyncClient, RoomSendResponse
 import yaml
 import os
 
 from luna.luna_command_extensions.cmd_summarize import cmd_summarize
-from luna.luna_command_extensions.image_helpers import direct_upload_image
+from luna.luna_command_extensions.image_helpers import direct_upload_image, download_to_file, ensure_images_dir
 from luna.luna_command_extensions.spawn_persona import cmd_spawn
 from luna.luna_command_extensions.create_room2 import create_room2_command
 from luna.luna_command_extensions.spawn_ensemble import spawn_ensemble_command
@@ -123,27 +122,18 @@ async def list_rooms(bot_client: AsyncClient) -> str:
     Return a list of rooms the bot is currently in, formatted as an HTML table,
     with columns in the order: (Name, Alias, Room ID).
     """
-    # Collect info in a list of (room_id, alias, name)
-    room_info = []
-    for room_id, room_obj in bot_client.rooms.items():
-        alias = getattr(room_obj, "canonical_alias", None) or ""
-        name = room_obj.name or ""
-        room_info.append((room_id, alias, name))
-
-    if not room_info:
+    if not bot_client.rooms:
         return "<p>No rooms found.</p>"
 
     # Build a table with columns: Name, Alias, Room ID
-    rows = []
-    for r_id, r_alias, r_name in room_info:
-        row_html = (
-            "<tr>"
-            f"<td>{r_name}</td>"    # Name
-            f"<td>{r_alias}</td>"   # Alias
-            f"<td>{r_id}</td>"      # Room ID
-            "</tr>"
-        )
-        rows.append(row_html)
+    rows = (
+        "<tr>"
+        f"<td>{room_obj.name or ''}</td>"                                # Name
+        f"<td>{getattr(room_obj, 'canonical_alias', None) or ''}</td>"   # Alias
+        f"<td>{room_id}</td>"                                            # Room ID
+        "</tr>"
+        for room_id, room_obj in bot_client.rooms.items()
+    )
 
     # Combine rows into a table
     table_html = (
@@ -188,15 +178,11 @@ async def draw_command(bot_client: AsyncClient, room_id: str, user_prompt: str)
     # -----------------------------------------------------------------
     try:
         logger.debug("[draw_command] Downloading image from %s", image_url)
-        os.makedirs("data/images", exist_ok=True)
+        await ensure_images_dir()
         timestamp = int(time.time())
         filename = f"data/images/generated_image_{timestamp}.jpg"
 
-        dl_resp = requests.get(image_url)
-        dl_resp.raise_for_status()
-
-        with open(filename, "wb") as f:
-            f.write(dl_resp.content)
+        file_size = await download_to_file(image_url, filename)
 
         logger.debug("[draw_command] Image saved to %s", filename)
     except Exception as e:
@@ -219,7 +205,6 @@ async def draw_command(bot_client: AsyncClient, room_id: str, user_prompt: str)
     # 5) Send the m.image event to the room
     # -----------------------------------------------------------------
     try:
-        file_size = os.path.getsize(filename)
         image_content = {
             "msgtype": "m.image",
             "body": os.path.basename(filename),
@@ -259,7 +244,7 @@ def get_param(param_name: str) -> str:
         return str(GLOBAL_PARAMS[param_name])
 
     # Otherwise, load from config
-    cfg = load_config()
+    cfg = get_cached_config()
     globals_section = cfg.get("globals", {})
     val = globals_section.get(param_name)
     if val is not None:
@@ -335,7 +320,8 @@ async def luna_gpt(bot_client: AsyncClient, room_id: str, raw_args: str) -> str:
       !luna <prompt>
 
     Sends the user's prompt through GPT with a full context build for Luna,
-    using `context_helper.build_context`. Returns GPT's plain-text response.
+    via `ai_functions.call_gpt_for_room` (context built off the event loop,
+    shared cache policy). Returns GPT's plain-text response.
 
     Handles both quoted and non-quoted inputs by stripping leading/trailing quotes.
     Examples:
@@ -349,22 +335,18 @@ async def luna_gpt(bot_client: AsyncClient, room_id: str, raw_args: str) -> str:
     if not prompt:
         return "Usage: !luna <prompt>"
 
-    from luna.context_helper import build_context  # Ensure correct import path
-    from luna.ai_functions import get_gpt_response  # Ensure correct import path
+    from luna.ai_functions import call_gpt_for_room  # Ensure correct import path
 
-    # 2) Build Luna’s GPT context for this room
+    # 2) Build Luna’s GPT context for this room and call GPT with the user’s prompt
     try:
-        context_config = {"max_history": 20}
-        gpt_context = build_context("lunabot", room_id, context_config)
-        gpt_context.append({"role": "user", "content": prompt})
-
-        logger.debug("[luna_gpt] GPT context built: %s", gpt_context)
-
-        # 3) Call GPT with the context and user’s final prompt
-        gpt_response = await get_gpt_response(
-            messages=gpt_context,
+        gpt_response = await call_gpt_for_room(
+            "lunabot",
+            room_id,
+            prompt,
             model="chatgpt-4o-latest",
-            temperature=0.7
+            temperature=0.7,
+            max_tokens=1000,
+            max_history=20
         )
         logger.debug("[luna_gpt] GPT response: %s", gpt_response)
 
@@ -440,6 +422,18 @@ def parse_command_doc(func) -> tuple[str, str]:
 # -------------------------------------------------------------
 # COMMAND DISPATCHER
 # -------------------------------------------------------------
+_SHLEX_SPECIAL_CHARS = frozenset("\"'\\")
+
+def _split_command_line(cmd_line: str) -> list[str]:
+    """
+    Tokenize a command line. Most commands have no quoting at all, and for
+    those a plain whitespace split gives the same tokens as shlex; only fall
+    back to the (pure-Python) shlex tokenizer when quotes or escapes appear.
+    """
+    if _SHLEX_SPECIAL_CHARS.isdisjoint(cmd_line):
+        return cmd_line.split()
+    return shlex.split(cmd_line)
+
 async def handle_console_command(bot_client: AsyncClient, room_id: str, message_body: str, sender: str, event: any) -> str:
     """
     Parse the message (which starts with '!'), extract command name & args,
@@ -449,7 +443,7 @@ async def handle_console_command(bot_client: AsyncClient, room_id: str, message_
     cmd_line = message_body[1:].strip()
 
     try:
-        parts = shlex.split(cmd_line)
+        parts = _split_command_line(cmd_line)
     except ValueError as e:
         return f"SYSTEM: Error parsing command => {e}"
 
@@ -464,175 +458,170 @@ async def handle_console_command(bot_client: AsyncClient, room_id: str, message_
 
     command_func = COMMAND_ROUTER[command_name]
 
-    # Dispatch to the correct function
-    if command_name == "create_room":
-        if not args:
-            return "Usage: !create_room <localpart> [topic=\"...\"] [public|private]"
-        localpart = args[0]
-        topic = None
-        is_public = True
-
-        for extra in args[1:]:
-            if extra.startswith("topic="):
-                topic_val = extra.split("=", 1)[1].strip('"')
-                topic = topic_val
-            elif extra.lower() in ["public", "private"]:
-                is_public = (extra.lower() == "public")
-
-        return await command_func(bot_client, sender, localpart, topic, is_public)
-
-    elif command_name == "create_room2":
-        # We want (bot_client, invoking_room_id, event.event_id, raw_args, sender)
-        if not args:
-            return (
-                "Usage:\n"
-                "!create_room2 --name=<localpart> [--invite=@user1:localhost,@user2:localhost] "
-                "[--set_avatar=true] [--additional_flag='<json>'] \"<prompt>\"\n\n"
-                "Examples:\n"
-                "!create_room2 --name=bridgedeck \"A futuristic starship bridge\"\n"
-                "!create_room2 --name=researchlab --invite=@dr_koratel:localhost --set_avatar=true "
-                "\"A cutting-edge science facility on the frontier\"\n\n"
-                "Details:\n"
-                "  --name=<localpart>     Localpart for the new room alias, e.g. 'bridge' => #bridge:localhost.\n"
-                "  --invite=<list>        Comma-separated user IDs to invite, e.g. @ensignlira:localhost.\n"
-                "  --set_avatar=true      If set to 'true', generate & set a room avatar from the prompt.\n"
-                "  --additional_flag='<json>'  JSON object with extra style or metadata, e.g. {\"genre\":\"starfleet\"}.\n"
-                "  \"<prompt>\"           The final positional argument describing the room’s theme/context.\n"
-            )
-        raw_args_str = " ".join(args)
-        await command_func(bot_client, room_id, event.event_id, raw_args_str, sender)
-        return None
-    
-    elif command_name == "spawn_ensemble":
-        # This command wants (bot_client, room_id, event_id, raw_args, sender).
-        # If user didn't provide any leftover tokens, show usage:
-        if not args:
-            return (
-                "Usage: !spawn_ensemble \"<high-level group instructions>\"\n\n"
-                "Example:\n"
-                "!spawn_ensemble \"We need 3 cunning Orion Syndicate spies, each with a unique codename.\""
-            )
-        # Rejoin leftover tokens into one string. 
-        raw_args_str = " ".join(args)
-        # Call the ensemble function. It returns None (all output is in-thread).
-        await command_func(bot_client, room_id, event.event_id, raw_args_str, sender)
-        return None
-
-    elif command_name == "assemble":
-        # If user typed just "!assemble" with no leftover tokens, show usage.
-        if not args:
-            return (
-                "Usage: !assemble \"<description>\"\n\n"
-                "Example:\n"
-                "!assemble \"A crack squad of assassins, bring them to my headquarters\"\n"
-                "GPT will generate: roomLocalpart, roomPrompt, 1-3 persona descriptors.\n"
-            )
-        raw_args_str = " ".join(args)
-        await command_func(bot_client, room_id, event.event_id, raw_args_str, sender)
-        return None
-
-    elif command_name == "set_avatar":
-        # We expect exactly two arguments: <localpart> and <mxc_uri_or_mediaID>
-        if len(args) < 2:
-            return "Usage: !set_avatar <localpart> <mxc_uri_or_mediaID>"
-        
-        localpart = args[0]
-        mxc_or_media_id = args[1]
-
-        # Pass both arguments as a single string to cmd_set_avatar
-        args_string = f"{localpart} {mxc_or_media_id}"
-        return await command_func(args_string)
-
-
-    elif command_name == "invite_user":
-        if len(args) < 2:
-            return "Usage: !invite_user <user_id> <room_localpart>"
-        user_id = args[0]
-        localpart = args[1]
-        return await command_func(bot_client, user_id, localpart)
-
-    elif command_name == "list_params":
-        # No arguments expected
-        if args:
-            return "Usage: !list_params  (no arguments needed)"
-        return command_func()
+    # Dispatch to the correct function via its argument adapter
+    dispatch = _COMMAND_DISPATCH.get(command_name)
+    if dispatch is None:
+        # fallback if no adapter is registered
+        return f"SYSTEM: Command '{command_name}' is recognized but not handled."
+    return await dispatch(command_func, bot_client, room_id, args, sender, event)
 
-    elif command_name == "luna":
-        if not args:
-            return "Usage: !luna <prompt>"
-        prompt = " ".join(args)
-        return await command_func(bot_client, room_id, prompt)
-
-    elif command_name == "summarize":
-
-        if not args:
-            return "Usage: !summarize <prompt>"
-
-        user_prompt = " ".join(args)
-        # We'll call run_summarize_pipeline(...) but not return anything; 
-        # it posts results directly in the thread.
-
-        # Because handle_console_command is an async function, we can do:
-        from luna.luna_command_extensions.summarize_pipeline import run_summarize_pipeline
-
-        # We do not "return" the summary, because we want to post partial/final messages 
-        # in the same thread. So we just schedule it.
-        await run_summarize_pipeline(
-            bot_client, 
-            room_id,
-            event.event_id,  # or pass in if you have it
-            user_prompt,
-            bot_localpart="lunabot"
+# -------------------------------------------------------------
+# ARGUMENT ADAPTERS
+# Each adapter receives (command_func, bot_client, room_id, args, sender, event)
+# and calls command_func with the arguments that command expects.
+# -------------------------------------------------------------
+async def _dispatch_create_room(command_func, bot_client, room_id, args, sender, event):
+    if not args:
+        return "Usage: !create_room <localpart> [topic=\"...\"] [public|private]"
+    localpart = args[0]
+    topic = None
+    is_public = True
+
+    for extra in args[1:]:
+        if extra.startswith("topic="):
+            topic_val = extra.split("=", 1)[1].strip('"')
+            topic = topic_val
+        elif extra.lower() in ["public", "private"]:
+            is_public = (extra.lower() == "public")
+
+    return await command_func(bot_client, sender, localpart, topic, is_public)
+
+async def _dispatch_create_room2(command_func, bot_client, room_id, args, sender, event):
+    # We want (bot_client, invoking_room_id, event.event_id, raw_args, sender)
+    if not args:
+        return (
+            "Usage:\n"
+            "!create_room2 --name=<localpart> [--invite=@user1:localhost,@user2:localhost] "
+            "[--set_avatar=true] [--additional_flag='<json>'] \"<prompt>\"\n\n"
+            "Examples:\n"
+            "!create_room2 --name=bridgedeck \"A futuristic starship bridge\"\n"
+            "!create_room2 --name=researchlab --invite=@dr_koratel:localhost --set_avatar=true "
+            "\"A cutting-edge science facility on the frontier\"\n\n"
+            "Details:\n"
+            "  --name=<localpart>     Localpart for the new room alias, e.g. 'bridge' => #bridge:localhost.\n"
+            "  --invite=<list>        Comma-separated user IDs to invite, e.g. @ensignlira:localhost.\n"
+            "  --set_avatar=true      If set to 'true', generate & set a room avatar from the prompt.\n"
+            "  --additional_flag='<json>'  JSON object with extra style or metadata, e.g. {\"genre\":\"starfleet\"}.\n"
+            "  \"<prompt>\"           The final positional argument describing the room’s theme/context.\n"
+        )
+    raw_args_str = " ".join(args)
+    await command_func(bot_client, room_id, event.event_id, raw_args_str, sender)
+    return None
+
+async def _dispatch_spawn_ensemble(command_func, bot_client, room_id, args, sender, event):
+    # This command wants (bot_client, room_id, event_id, raw_args, sender).
+    # If user didn't provide any leftover tokens, show usage:
+    if not args:
+        return (
+            "Usage: !spawn_ensemble \"<high-level group instructions>\"\n\n"
+            "Example:\n"
+            "!spawn_ensemble \"We need 3 cunning Orion Syndicate spies, each with a unique codename.\""
+        )
+    # Rejoin leftover tokens into one string.
+    raw_args_str = " ".join(args)
+    # Call the ensemble function. It returns None (all output is in-thread).
+    await command_func(bot_client, room_id, event.event_id, raw_args_str, sender)
+    return None
+
+async def _dispatch_assemble(command_func, bot_client, room_id, args, sender, event):
+    # If user typed just "!assemble" with no leftover tokens, show usage.
+    if not args:
+        return (
+            "Usage: !assemble \"<description>\"\n\n"
+            "Example:\n"
+            "!assemble \"A crack squad of assassins, bring them to my headquarters\"\n"
+            "GPT will generate: roomLocalpart, roomPrompt, 1-3 persona descriptors.\n"
         )
+    raw_args_str = " ".join(args)
+    await command_func(bot_client, room_id, event.event_id, raw_args_str, sender)
+    return None
+
+async def _dispatch_set_avatar(command_func, bot_client, room_id, args, sender, event):
+    # We expect exactly two arguments: <localpart> and <mxc_uri_or_mediaID>
+    if len(args) < 2:
+        return "Usage: !set_avatar <localpart> <mxc_uri_or_mediaID>"
+
+    localpart = args[0]
+    mxc_or_media_id = args[1]
+
+    # Pass both arguments as a single string to cmd_set_avatar
+    args_string = f"{localpart} {mxc_or_media_id}"
+    return await command_func(args_string)
+
+async def _dispatch_invite_user(command_func, bot_client, room_id, args, sender, event):
+    if len(args) < 2:
+        return "Usage: !invite_user <user_id> <room_localpart>"
+    user_id = args[0]
+    localpart = args[1]
+    return await command_func(bot_client, user_id, localpart)
+
+async def _dispatch_list_params(command_func, bot_client, room_id, args, sender, event):
+    # No arguments expected
+    if args:
+        return "Usage: !list_params  (no arguments needed)"
+    return command_func()
+
+async def _dispatch_luna(command_func, bot_client, room_id, args, sender, event):
+    if not args:
+        return "Usage: !luna <prompt>"
+    prompt = " ".join(args)
+    return await command_func(bot_client, room_id, prompt)
+
+async def _dispatch_summarize(command_func, bot_client, room_id, args, sender, event):
+    if not args:
+        return "Usage: !summarize <prompt>"
+
+    user_prompt = " ".join(args)
+    # We'll call run_summarize_pipeline(...) but not return anything;
+    # it posts results directly in the thread.
+
+    # Imported here because summarize_pipeline imports from this module.
+    from luna.luna_command_extensions.summarize_pipeline import run_summarize_pipeline
+
+    # We do not "return" the summary, because we want to post partial/final messages
+    # in the same thread. So we just schedule it.
+    await run_summarize_pipeline(
+        bot_client,
+        room_id,
+        event.event_id,  # or pass in if you have it
+        user_prompt,
+        bot_localpart="lunabot"
+    )
 
-        # Possibly return a short "Sure, summarizing now..." or just empty
-        return None  # The user will see the actual summary in-thread
-
-    elif command_name == "summarize_depreciated":
-        # If user typed just "!summarize" with no leftover tokens, show usage
-        if not args:
-            return "Usage: !summarize <prompt>"
-
-        # Otherwise, join all leftover tokens into one string
-        prompt_str = " ".join(args)
-
-        # Call the summarize function, passing bot_client, room_id, and the joined prompt
-        return await command_func(bot_client, room_id, prompt_str)
-    
-    elif command_name == "draw":
-        # Now pass in the 'room_id' so we can post the image there
-        if not args:
-            return "Usage: !draw <prompt>"
-        prompt = " ".join(args)
-        return await command_func(bot_client, room_id, prompt)
-
-    elif command_name == "list_rooms":
-        return await command_func(bot_client)
-
-    elif command_name == "spawn":
-        if not args:
-            return "Usage: !spawn <descriptor>"
-        descriptor = " ".join(args)
-        return await command_func(bot_client, descriptor)
-
-    elif command_name == "help":
-        return await command_func()
-
-    elif command_name == "set_param":
-        if len(args) < 2:
-            return "Usage: !set_param <param_name> <value>"
-        param_name = args[0]
-        value = " ".join(args[1:])
-        return command_func(param_name, value)
-
-    elif command_name == "get_param":
-        if len(args) < 1:
-            return "Usage: !get_param <param_name>"
-        param_name = args[0]
-        return command_func(param_name)
-
-    # fallback if not handled above
-    return f"SYSTEM: Command '{command_name}' is recognized but not handled."
+    # Possibly return a short "Sure, summarizing now..." or just empty
+    return None  # The user will see the actual summary in-thread
+
+async def _dispatch_draw(command_func, bot_client, room_id, args, sender, event):
+    # Now pass in the 'room_id' so we can post the image there
+    if not args:
+        return "Usage: !draw <prompt>"
+    prompt = " ".join(args)
+    return await command_func(bot_client, room_id, prompt)
+
+async def _dispatch_list_rooms(command_func, bot_client, room_id, args, sender, event):
+    return await command_func(bot_client)
+
+async def _dispatch_spawn(command_func, bot_client, room_id, args, sender, event):
+    if not args:
+        return "Usage: !spawn [--fresh] <descriptor>"
+    descriptor = " ".join(args)
+    return await command_func(bot_client, descriptor)
+
+async def _dispatch_help(command_func, bot_client, room_id, args, sender, event):
+    return await command_func()
+
+async def _dispatch_set_param(command_func, bot_client, room_id, args, sender, event):
+    if len(args) < 2:
+        return "Usage: !set_param <param_name> <value>"
+    param_name = args[0]
+    value = " ".join(args[1:])
+    return command_func(param_name, value)
+
+async def _dispatch_get_param(command_func, bot_client, room_id, args, sender, event):
+    if len(args) < 1:
+        return "Usage: !get_param <param_name>"
+    param_name = args[0]
+    return command_func(param_name)
 
 def load_config() -> dict:
     """
@@ -644,13 +633,35 @@ def load_config() -> dict:
     with open(CONFIG_PATH, "r", encoding="utf-8") as f:
         return yaml.safe_load(f) or {}
 
+# (mtime_ns, size, parsed config) of the last get_cached_config() read
+_config_cache = None
+
+def get_cached_config() -> dict:
+    """
+    Same as load_config(), but only re-reads config.yaml when the file's
+    mtime or size has changed since the last call. The returned dict is
+    shared, so treat it as read-only; use load_config() to edit + save.
+    """
+    global _config_cache
+    try:
+        st = os.stat(CONFIG_PATH)
+    except OSError:
+        return {}
+
+    stamp = (st.st_mtime_ns, st.st_size)
+    if _config_cache is None or _config_cache[:2] != stamp:
+        _config_cache = stamp + (load_config(),)
+    return _config_cache[2]
+
 def save_config(config_data: dict) -> None:
     """
     Writes the config_data dict back to config.yaml, overwriting existing content.
     """
+    global _config_cache
     os.makedirs(os.path.dirname(CONFIG_PATH), exist_ok=True)
     with open(CONFIG_PATH, "w", encoding="utf-8") as f:
         yaml.safe_dump(config_data, f)
+    _config_cache = None
 
 async def cmd_set_avatar(args: str) -> str:
     """
@@ -742,4 +753,23 @@ COMMAND_ROUTER = {
     "set_avatar":  cmd_set_avatar,
     "assemble":     assemble_command,
     "summarize":   cmd_summarize
-}
\ No newline at end of file
+}
+
+# Maps each command name to the adapter that unpacks its arguments.
+_COMMAND_DISPATCH = {
+    "create_room":    _dispatch_create_room,
+    "create_room2":   _dispatch_create_room2,
+    "spawn_ensemble": _dispatch_spawn_ensemble,
+    "assemble":       _dispatch_assemble,
+    "set_avatar":     _dispatch_set_avatar,
+    "invite_user":    _dispatch_invite_user,
+    "list_params":    _dispatch_list_params,
+    "luna":           _dispatch_luna,
+    "summarize":      _dispatch_summarize,
+    "draw":           _dispatch_draw,
+    "list_rooms":     _dispatch_list_rooms,
+    "spawn":          _dispatch_spawn,
+    "help":           _dispatch_help,
+    "set_param":      _dispatch_set_param,
+    "get_param":      _dispatch_get_param,
+}
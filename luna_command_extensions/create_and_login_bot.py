@@ -11,6 +11,7 @@ import asyncio
 import re
 import json
 import secrets  # for fallback random localpart (if needed)
+import collections
 import aiohttp
 
 from nio import RoomMessageText, InviteMemberEvent, RoomMemberEvent, AsyncClient, LoginResponse
@@ -18,11 +19,43 @@ from nio import RoomMessageText, InviteMemberEvent, RoomMemberEvent, AsyncClient
 # Adjust these imports to match your new layout:
 import luna.GLOBALS as g
 import luna.luna_personas
+# Event handlers registered on every new bot (none of these import this module back)
+from luna.luna_command_extensions.bot_message_handler import handle_bot_room_message
+from luna.luna_command_extensions.bot_invite_handler import handle_bot_invite
+from luna.luna_command_extensions.bot_member_event_handler import handle_bot_member_event
+from luna.luna_command_extensions.image_helpers import get_http_session
 
 # Regex that matches valid characters for localparts in Matrix user IDs:
 # (Synapse typically allows `[a-z0-9._=/-]+` by default).
 VALID_LOCALPART_REGEX = re.compile(r'[a-z0-9._=\-/]+')
 
+# Localparts whose persona + Synapse account were created recently in this process.
+# A repeat create for one of these skips straight to login (no persona write, no 409 round-trip).
+_RECENT_CREATES_MAX = 256
+_RECENT_CREATES: "collections.OrderedDict[str, str]" = collections.OrderedDict()
+
+def _remember_create(localpart: str, bot_id: str) -> None:
+    """
+    Records `localpart` as recently created, evicting the least recently used entry.
+    """
+    _RECENT_CREATES[localpart] = bot_id
+    _RECENT_CREATES.move_to_end(localpart)
+    if len(_RECENT_CREATES) > _RECENT_CREATES_MAX:
+        _RECENT_CREATES.popitem(last=False)
+
+def _forget_bot(localpart: str, bot_client: AsyncClient, task: asyncio.Task) -> None:
+    """
+    Done-callback for a bot's sync task: drops the task from g.BOT_TASKS and the
+    client from g.BOTS (unless a newer client has since taken that localpart).
+    On shutdown the client is left in place so _shutdown_all_bots can log it out.
+    """
+    g.BOT_TASKS.discard(task)
+    if g.SHOULD_SHUT_DOWN:
+        return
+    if g.BOTS.get(localpart) is bot_client:
+        g.BOTS.pop(localpart, None)
+    g.LOGGER.debug("[create_and_login_bot] Bot '%s' sync loop finished => removed from BOTS.", localpart)
+
 async def run_bot_sync(bot_client: AsyncClient, localpart: str):
     """
     Simple sync loop for each bot, runs until SHOULD_SHUT_DOWN is True.
@@ -32,7 +65,7 @@ async def run_bot_sync(bot_client: AsyncClient, localpart: str):
             await bot_client.sync(timeout=5000)
         except Exception as e:
             g.LOGGER.exception(
-                f"[run_bot_sync] Bot '{localpart}' had sync error: {e}"
+                "[run_bot_sync] Bot '%s' had sync error: %s", localpart, e
             )
             await asyncio.sleep(2)  # brief backoff
         else:
@@ -97,44 +130,80 @@ async def create_and_login_bot(
     g.LOGGER.debug("Final bot_id => %r", new_bot_id)
     bot_id = new_bot_id
 
-    # 3) Create persona in personalities.json
-    try:
-        g.LOGGER.debug("Creating persona in personalities.json => %r", bot_id)
-        luna.luna_personas.create_bot(
-            bot_id=bot_id,
-            password=password,
-            displayname=displayname,
-            creator_user_id=creator_user_id,
-            system_prompt=system_prompt,
-            traits=traits
-        )
-        g.LOGGER.info("[create_and_login_bot] Persona created for %s.", bot_id)
-    except Exception as e:
-        msg = f"[create_and_login_bot] Could not create persona => {e}"
-        g.LOGGER.exception(msg)
+    # 2a) Luna's own account already has its inbound handler (the router);
+    #     a second session with the bot handler would make her reply twice.
+    if sanitized == g.LUNA_USERNAME and g.LUNA_CLIENT is not None:
+        msg = f"Bot {bot_id} is Luna's own account"
+        g.LOGGER.info("[create_and_login_bot] %s => not starting a second session.", msg)
         return {
-            "ok": False,
-            "bot_id": None,
-            "client": None,
+            "ok": True,
+            "bot_id": bot_id,
+            "client": g.LUNA_CLIENT,
             "html": f"<p>{msg}</p>",
-            "error": str(e)
+            "error": None
         }
 
-    # 4) Create the user in Synapse
-    matrix_localpart = sanitized
-    g.LOGGER.debug("Attempting create_user(localpart=%r)", matrix_localpart)
-    creation_msg = await create_user(matrix_localpart, password, is_admin=is_admin)
-    if not creation_msg.startswith("Created user"):
-        err = f"[create_and_login_bot] Synapse user creation failed => {creation_msg}"
-        g.LOGGER.error(err)
+    # 2b) Already running in this process? Hand back the live client.
+    if sanitized in g.BOTS:
+        msg = f"Bot {bot_id} already active"
+        g.LOGGER.info("[create_and_login_bot] %s => skipping create.", msg)
         return {
-            "ok": False,
-            "bot_id": None,
-            "client": None,
-            "html": f"<p>{err}</p>",
-            "error": creation_msg
+            "ok": True,
+            "bot_id": bot_id,
+            "client": g.BOTS[sanitized],
+            "html": f"<p>{msg}</p>",
+            "error": None
         }
 
+    # 2c) Created recently but not active => persona + account exist, just log in.
+    already_created = sanitized in _RECENT_CREATES
+    if already_created:
+        _RECENT_CREATES.move_to_end(sanitized)
+        g.LOGGER.debug("Localpart %r was created recently => skipping persona + Synapse create.", sanitized)
+
+    # 3) Create persona in personalities.json
+    if not already_created:
+        try:
+            g.LOGGER.debug("Creating persona in personalities.json => %r", bot_id)
+            luna.luna_personas.create_bot(
+                bot_id=bot_id,
+                password=password,
+                displayname=displayname,
+                creator_user_id=creator_user_id,
+                system_prompt=system_prompt,
+                traits=traits
+            )
+            g.LOGGER.info("[create_and_login_bot] Persona created for %s.", bot_id)
+        except Exception as e:
+            msg = f"[create_and_login_bot] Could not create persona => {e}"
+            g.LOGGER.exception(msg)
+            return {
+                "ok": False,
+                "bot_id": None,
+                "client": None,
+                "html": f"<p>{msg}</p>",
+                "error": str(e)
+            }
+
+    # 4) Create the user in Synapse (a 409 means the account already exists => just log in)
+    if not already_created:
+        matrix_localpart = sanitized
+        g.LOGGER.debug("Attempting create_user(localpart=%r)", matrix_localpart)
+        creation_msg = await create_user(matrix_localpart, password, is_admin=is_admin)
+        if creation_msg.startswith("HTTP 409"):
+            g.LOGGER.info("[create_and_login_bot] User %s already exists => going straight to login.", bot_id)
+        elif not creation_msg.startswith("Created user"):
+            err = f"[create_and_login_bot] Synapse user creation failed => {creation_msg}"
+            g.LOGGER.error(err)
+            return {
+                "ok": False,
+                "bot_id": None,
+                "client": None,
+                "html": f"<p>{err}</p>",
+                "error": creation_msg
+            }
+        _remember_create(sanitized, bot_id)
+
     # 5) Ephemeral login
     try:
         g.LOGGER.debug("Attempting ephemeral login => bot_id=%r", bot_id)
@@ -157,10 +226,6 @@ async def create_and_login_bot(
         }
 
     # 6) Register event callbacks
-    from luna.luna_command_extensions.bot_message_handler import handle_bot_room_message  # new advanced version
-    from luna.luna_command_extensions.bot_invite_handler import handle_bot_invite  # new advanced version
-    from luna.luna_command_extensions.bot_message_handler import handle_bot_room_message  # new advanced version
-    from luna.luna_command_extensions.bot_member_event_handler import handle_bot_member_event  # new advanced version
     try:
             client.add_event_callback(
                 lambda room, evt: handle_bot_room_message(client, sanitized, room, evt),
@@ -186,10 +251,15 @@ async def create_and_login_bot(
             "error": str(e)
         }
 
-    # 7) Start the sync loop & store references
+    # 7) Start the sync loop & store references.
+    #    When the loop exits (shutdown, logout, crash) the task drops both entries,
+    #    so BOTS/BOT_TASKS don't keep dead clients around for the life of the process.
     g.BOTS[sanitized] = client
     sync_task = asyncio.create_task(run_bot_sync(client, sanitized))
-    g.BOT_TASKS.append(sync_task)
+    g.BOT_TASKS.add(sync_task)
+    sync_task.add_done_callback(
+        lambda t, key=sanitized, bot=client: _forget_bot(key, bot, t)
+    )
     g.LOGGER.info("[create_and_login_bot] Bot '%s' sync loop started.", sanitized)
 
     # 8) Final success
@@ -261,7 +331,7 @@ async def load_or_login_client_v2(
     #       user_id = f"@{user_id}:localhost"
     # But that depends on your usage.
 
-    g.LOGGER.info(f"[load_or_login_client_v2] [{user_id}] Attempting password login...")
+    g.LOGGER.info("[load_or_login_client_v2] [%s] Attempting password login...", user_id)
 
     # 1) Construct the client
     client = AsyncClient(homeserver=homeserver_url, user=user_id)
@@ -271,10 +341,10 @@ async def load_or_login_client_v2(
 
     # 3) Check result
     if isinstance(resp, LoginResponse):
-        g.LOGGER.info(f"[{user_id}] Password login succeeded. user_id={client.user_id}")
+        g.LOGGER.info("[%s] Password login succeeded. user_id=%s", user_id, client.user_id)
         return client
     else:
-        g.LOGGER.error(f"[{user_id}] Password login failed => {resp}")
+        g.LOGGER.error("[%s] Password login failed => %s", user_id, resp)
         raise Exception(f"Password login failed for {user_id}: {resp}")
 
 # ──────────────────────────────────────────────────────────
@@ -302,21 +372,21 @@ async def add_user_via_admin_api(
         "Authorization": f"Bearer {admin_token}"
     }
 
-    g.LOGGER.info(f"Creating user {user_id}, admin={is_admin} via {url}")
+    g.LOGGER.info("Creating user %s, admin=%s via %s", user_id, is_admin, url)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.request("PUT", url, headers=headers, json=body) as resp:
-                if resp.status in (200, 201):
-                    g.LOGGER.info(f"Created user {user_id} (HTTP {resp.status})")
-                    return f"Created user {user_id} (admin={is_admin})."
-                else:
-                    text = await resp.text()
-                    g.LOGGER.error(f"Error creating user {user_id}: {resp.status} => {text}")
-                    return f"HTTP {resp.status}: {text}"
+        # Shared, pooled session: spawning several personas reuses one connection
+        async with get_http_session().request("PUT", url, headers=headers, json=body) as resp:
+            if resp.status in (200, 201):
+                g.LOGGER.info("Created user %s (HTTP %d)", user_id, resp.status)
+                return f"Created user {user_id} (admin={is_admin})."
+            else:
+                text = await resp.text()
+                g.LOGGER.error("Error creating user %s: %d => %s", user_id, resp.status, text)
+                return f"HTTP {resp.status}: {text}"
 
     except aiohttp.ClientError as e:
-        g.LOGGER.exception(f"Network error creating user {user_id}")
+        g.LOGGER.exception("Network error creating user %s", user_id)
         return f"Network error: {e}"
     except Exception as e:
         g.LOGGER.exception("Unexpected error.")
@@ -1,5 +1,6 @@
 import logging
 import shlex  # <-- We’ll use this to parse user arguments correctly
+from typing import Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -20,16 +21,27 @@ async def create_room(args_string: str) -> str:
                        contain quoted text or flags.
     :return: A result message describing success or failure.
     """
+    _, message = await create_room_return_id(args_string)
+    return message
+
+
+async def create_room_return_id(args_string: str) -> Tuple[Optional[str], str]:
+    """
+    Same as create_room(), but also hands back the new room's ID so callers
+    don't have to parse it out of the message.
+
+    :return: (room_id or None on failure, result message)
+    """
 
     # 1) Parse the raw string with shlex to allow quoted words
     try:
         tokens = shlex.split(args_string)
     except ValueError as e:
         logger.exception("Error parsing arguments with shlex:")
-        return f"Error parsing arguments: {e}"
+        return None, f"Error parsing arguments: {e}"
 
     if not tokens:
-        return "Usage: create_room <roomName> [--private]"
+        return None, "Usage: create_room <roomName> [--private]"
 
     # 2) Extract room name from the first token, check for optional "--private"
     room_name = tokens[0]
@@ -42,7 +54,7 @@ async def create_room(args_string: str) -> str:
 
     client = getClient()
     if not client:
-        return "Error: No DIRECTOR_CLIENT set."
+        return None, "Error: No DIRECTOR_CLIENT set."
 
     # 3) Convert is_public => the appropriate room visibility
     room_visibility = RoomVisibility.public if is_public else RoomVisibility.private
@@ -55,11 +67,11 @@ async def create_room(args_string: str) -> str:
         )
 
         if isinstance(response, RoomCreateResponse):
-            return f"Created room '{room_name}' => {response.room_id}"
+            return response.room_id, f"Created room '{room_name}' => {response.room_id}"
         else:
             # Possibly an ErrorResponse or something else
-            return f"Error creating room => {response}"
+            return None, f"Error creating room => {response}"
 
     except Exception as e:
         logger.exception("Caught an exception while creating room %r:", room_name)
-        return f"Exception while creating room => {e}"
+        return None, f"Exception while creating room => {e}"
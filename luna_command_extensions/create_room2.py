@@ -7,11 +7,17 @@ import logging
 import shlex
 import os
 import time
-import requests
+import aiohttp
 from typing import Optional, Dict, Any
 
+try:
+    import orjson as _json  # faster parse for --additional_flag
+except ImportError:
+    _json = json
+
 from nio import AsyncClient, RoomSendResponse
 from nio.api import RoomVisibility
+from nio.exceptions import ProtocolError
 from nio.responses import (
     RoomCreateResponse,
     RoomCreateError,
@@ -25,10 +31,56 @@ from luna.luna_command_extensions.command_helpers import (
     _set_power_level
 )
 from luna.ai_functions import generate_image  # or generate_image_save_and_post
-from luna.luna_command_extensions.image_helpers import direct_upload_image
+from luna.luna_command_extensions.image_helpers import direct_upload_image, download_to_file, ensure_images_dir
 
 logger = logging.getLogger(__name__)
 
+# Failures we expect from homeserver calls. These are reported in-thread without a
+# traceback; anything else is a bug and propagates out of create_room2_command.
+_HOMESERVER_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ProtocolError)
+
+# Final in-thread summary, filled in with a single .format() call.
+_SUMMARY_TEMPLATE = (
+    "<p><strong>Done!</strong> Here’s the outcome:</p><ul>\n"
+    "<li>{parse_args}</li>\n"
+    "<li>{room_created}</li>\n"
+    "{set_topic}"
+    "<li>{avatar}</li>\n"
+    "<li>{invites}</li>\n"
+    "</ul>"
+)
+
+def _flag_invite(flags: Dict[str, Any], val: str) -> None:
+    # e.g. --invite=@user1:localhost,@user2:localhost
+    val = val.strip()
+    if val:
+        flags["invites"] = [u.strip() for u in val.split(",") if u.strip()]
+
+
+def _flag_set_avatar(flags: Dict[str, Any], val: str) -> None:
+    flags["set_avatar"] = (val.strip().lower() == "true")
+
+
+def _flag_additional(flags: Dict[str, Any], val: str) -> None:
+    try:
+        flags["additional"] = _json.loads(val.strip())
+    except json.JSONDecodeError as je:
+        logger.warning("Could not parse additional_flag JSON => %s", je)
+        flags["additional"] = {}
+
+
+def _flag_name(flags: Dict[str, Any], val: str) -> None:
+    flags["name"] = val.strip()
+
+
+# --flag=value handlers, keyed on the text before the first '='
+_FLAG_HANDLERS = {
+    "--invite": _flag_invite,
+    "--set_avatar": _flag_set_avatar,
+    "--additional_flag": _flag_additional,
+    "--name": _flag_name,
+}
+
 async def create_room2_command(
     bot_client: AsyncClient,
     invoking_room_id: str,
@@ -55,7 +107,30 @@ async def create_room2_command(
     All messages are posted in the same thread as 'parent_event_id'.
     """
 
-    logger.info ("Entered create_room2_command...")
+    logger.info("Entered create_room2_command...")
+
+    # 1) Start a keep-typing background task (stopped in the finally, even if a step raises)
+    typing_task = asyncio.create_task(_keep_typing(bot_client, invoking_room_id))
+    try:
+        return await _create_room2_steps(
+            bot_client, invoking_room_id, parent_event_id, raw_args, sender, typing_task
+        )
+    finally:
+        typing_task.cancel()
+
+
+async def _create_room2_steps(
+    bot_client: AsyncClient,
+    invoking_room_id: str,
+    parent_event_id: str,
+    raw_args: str,
+    sender: str,
+    typing_task: asyncio.Task
+) -> Optional[str]:
+    """
+    Runs steps 2-7 of create_room2_command and returns the new room ID (or None).
+    Expected failures are posted in-thread; unexpected exceptions propagate.
+    """
     steps_status = {
         "parse_args": None,
         "room_created": None,
@@ -64,9 +139,6 @@ async def create_room2_command(
         "invites_sent": None
     }
 
-    # 1) Start a keep-typing background task
-    typing_task = asyncio.create_task(_keep_typing(bot_client, invoking_room_id))
-
     # Post initial status
     await _post_in_thread(
         bot_client,
@@ -95,37 +167,21 @@ async def create_room2_command(
         typing_task.cancel()
         return
 
-    invite_list = []
-    set_avatar_flag = False
-    additional_data = {}
-    name_localpart: Optional[str] = None
-    user_prompt = ""
-
+    flags = {"name": None, "invites": [], "set_avatar": False, "additional": {}}
     remainder = []
-    idx = 0
-    while idx < len(args):
-        token = args[idx]
-        if token.startswith("--invite="):
-            # e.g. --invite=@user1:localhost,@user2:localhost
-            val = token.split("=", 1)[1].strip()
-            if val:
-                invite_list = [u.strip() for u in val.split(",") if u.strip()]
-        elif token.startswith("--set_avatar="):
-            val = token.split("=", 1)[1].strip().lower()
-            set_avatar_flag = (val == "true")
-        elif token.startswith("--additional_flag="):
-            raw_json = token.split("=", 1)[1].strip()
-            try:
-                additional_data = json.loads(raw_json)
-            except json.JSONDecodeError as je:
-                logger.warning(f"Could not parse additional_flag JSON => {je}")
-                additional_data = {}
-        elif token.startswith("--name="):
-            name_localpart = token.split("=", 1)[1].strip()
+    for token in args:
+        # One hash lookup on the part before '=' instead of a startswith() per flag
+        key, sep, val = token.partition("=")
+        handler = _FLAG_HANDLERS.get(key) if sep else None
+        if handler:
+            handler(flags, val)
         else:
             remainder.append(token)
-        idx += 1
 
+    invite_list = flags["invites"]
+    set_avatar_flag = flags["set_avatar"]
+    additional_data = flags["additional"]
+    name_localpart: Optional[str] = flags["name"]
     user_prompt = " ".join(remainder).strip()
 
     # Mark parse_args success or fail
@@ -159,7 +215,7 @@ async def create_room2_command(
         is_html=False
     )
 
-    g.LOGGER.info(f"Creating a public room with alias `#{name_localpart}:localhost`...")
+    g.LOGGER.info("Creating a public room with alias `#%s:localhost`...", name_localpart)
     new_room_id = None
     alias = name_localpart
     try:
@@ -214,10 +270,10 @@ async def create_room2_command(
             typing_task.cancel()
             return
 
-    except Exception as e:
+    except _HOMESERVER_ERRORS as e:
         steps_status["room_created"] = False
         err = f"Exception while creating room => {e}"
-        logger.exception(err)
+        logger.error(err)
         await _post_in_thread(
             bot_client,
             invoking_room_id,
@@ -247,9 +303,9 @@ async def create_room2_command(
                 "Topic set to your provided prompt.",
                 is_html=False
             )
-        except Exception as e:
+        except _HOMESERVER_ERRORS as e:
             steps_status["set_topic"] = False
-            logger.warning(f"Could not set topic => {e}")
+            logger.warning("Could not set topic => %s", e)
             await _post_in_thread(
                 bot_client,
                 invoking_room_id,
@@ -284,15 +340,12 @@ async def create_room2_command(
             )
 
             image_url = await generate_image(final_prompt, size="1024x1024")
-            logger.info(f"[create_room2] Received image_url => {image_url}")
+            logger.info("[create_room2] Received image_url => %s", image_url)
 
             filename = f"data/images/room_avatar_{int(time.time())}.jpg"
-            os.makedirs("data/images", exist_ok=True)
+            await ensure_images_dir()
 
-            dl_resp = requests.get(image_url)
-            dl_resp.raise_for_status()
-            with open(filename, "wb") as f:
-                f.write(dl_resp.content)
+            await download_to_file(image_url, filename)
 
             mxc_url = await direct_upload_image(bot_client, filename, "image/jpeg")
 
@@ -311,8 +364,10 @@ async def create_room2_command(
                 "Avatar generated and set successfully!",
                 is_html=False
             )
-        except Exception as e:
-            logger.exception(f"Avatar generation failed => {e}")
+        except (*_HOMESERVER_ERRORS, OSError, RuntimeError, ValueError, KeyError) as e:
+            # generate_image / download => aiohttp/ValueError/KeyError, file write => OSError,
+            # direct_upload_image => RuntimeError on a non-200 upload
+            logger.warning("Avatar generation failed => %s", e)
             await _post_in_thread(
                 bot_client,
                 invoking_room_id,
@@ -332,7 +387,7 @@ async def create_room2_command(
             # Invite the command sender
             inv_resp = await bot_client.room_invite(new_room_id, sender)
             if not (inv_resp and inv_resp.transport_response and inv_resp.transport_response.ok):
-                logger.warning(f"Could not invite the command sender {sender} => {inv_resp}")
+                logger.warning("Could not invite the command sender %s => %s", sender, inv_resp)
 
             # Elevate them to PL100
             await _set_power_level(bot_client, new_room_id, sender, 100)
@@ -342,9 +397,9 @@ async def create_room2_command(
                 try:
                     iresp = await bot_client.room_invite(new_room_id, user_id)
                     if not (iresp and iresp.transport_response and iresp.transport_response.ok):
-                        logger.warning(f"Could not invite {user_id} => {iresp}")
-                except Exception as e:
-                    logger.warning(f"Invite failed for {user_id} => {e}")
+                        logger.warning("Could not invite %s => %s", user_id, iresp)
+                except _HOMESERVER_ERRORS as e:
+                    logger.warning("Invite failed for %s => %s", user_id, e)
 
             await _post_in_thread(
                 bot_client,
@@ -353,9 +408,9 @@ async def create_room2_command(
                 f"Invited {len(invite_list)+1} users. Promoted {sender} to PL100.",
                 is_html=False
             )
-        except Exception as e:
+        except _HOMESERVER_ERRORS as e:
             steps_status["invites_sent"] = False
-            logger.exception(f"Error inviting or promoting => {e}")
+            logger.error("Error inviting or promoting => %s", e)
             await _post_in_thread(
                 bot_client,
                 invoking_room_id,
@@ -370,46 +425,39 @@ async def create_room2_command(
     # ----------------------------------------------------------------
     # 7) Final summary in-thread
     # ----------------------------------------------------------------
-    summary_lines = []
-    summary_lines.append("<p><strong>Done!</strong> Here’s the outcome:</p><ul>")
-
-    def li(msg): return f"<li>{msg}</li>"
-
-    # parse_args
-    if steps_status["parse_args"] is False:
-        summary_lines.append(li("Argument parsing => **FAILED**."))
-    else:
-        summary_lines.append(li("Argument parsing => Success."))
-
-    # room_created
-    if steps_status["room_created"]:
-        summary_lines.append(li(f"Room created => `#{name_localpart}:localhost`"))
-    else:
-        summary_lines.append(li("Room creation => **FAILED**."))
-
-    # set_topic
     if steps_status["set_topic"] is True:
-        summary_lines.append(li("Topic set => OK."))
+        set_topic_line = "<li>Topic set => OK.</li>\n"
     elif steps_status["set_topic"] is False:
-        summary_lines.append(li("Topic => **FAILED**."))
+        set_topic_line = "<li>Topic => **FAILED**.</li>\n"
+    else:
+        set_topic_line = ""
 
-    # avatar_generated
     if steps_status["avatar_generated"] is True:
-        summary_lines.append(li("Room avatar => generated successfully."))
+        avatar_line = "Room avatar => generated successfully."
     elif steps_status["avatar_generated"] is False:
-        summary_lines.append(li("Room avatar => attempted, but **FAILED**."))
-    elif steps_status["avatar_generated"] is None:
-        summary_lines.append(li("Room avatar => not requested."))
-
-    # invites_sent
-    if steps_status["invites_sent"]:
-        summary_lines.append(li("Invites => OK (sender was also promoted to PL100)."))
+        avatar_line = "Room avatar => attempted, but **FAILED**."
     else:
-        summary_lines.append(li("Invites => **FAILED** or partial issues."))
-
-    summary_lines.append("</ul>")
-
-    final_html = "\n".join(summary_lines)
+        avatar_line = "Room avatar => not requested."
+
+    final_html = _SUMMARY_TEMPLATE.format(
+        parse_args=(
+            "Argument parsing => **FAILED**."
+            if steps_status["parse_args"] is False
+            else "Argument parsing => Success."
+        ),
+        room_created=(
+            f"Room created => `#{name_localpart}:localhost`"
+            if steps_status["room_created"]
+            else "Room creation => **FAILED**."
+        ),
+        set_topic=set_topic_line,
+        avatar=avatar_line,
+        invites=(
+            "Invites => OK (sender was also promoted to PL100)."
+            if steps_status["invites_sent"]
+            else "Invites => **FAILED** or partial issues."
+        ),
+    )
 
     await _post_in_thread(
         bot_client,
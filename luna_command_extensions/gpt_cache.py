@@ -0,0 +1,103 @@
+# gpt_cache.py
+"""
+Persistent exact-match cache in front of get_gpt_response.
+
+Meant for calls whose inputs repeat across runs, e.g. re-running !summarize
+with the same instructions over an unchanged transcript. The key hashes the
+whole request (messages + model/sampling kwargs), so any change to the logs,
+the instructions or the model is a miss. Entries live in their own SQLite file
+next to BOT_MESSAGES_DB and expire after GPT_CACHE_TTL_DAYS. Error fallbacks
+from get_gpt_response are never stored.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from luna.bot_messages_store import BOT_MESSAGES_DB
+from luna.ai_functions import (
+    get_gpt_response,
+    _BACKEND_UNAVAILABLE_REPLY,
+    _GPT_ERROR_REPLY,
+)
+
+logger = logging.getLogger(__name__)
+
+GPT_CACHE_DB = os.path.join(os.path.dirname(BOT_MESSAGES_DB), "gpt_cache.db")
+GPT_CACHE_TTL_DAYS = 30
+
+# One shared connection, opened on first use; the lock serialises the worker
+# threads asyncio.to_thread hands it to.
+_conn = None
+_conn_lock = threading.Lock()
+
+
+def _get_conn() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(GPT_CACHE_DB), exist_ok=True)
+        conn = sqlite3.connect(GPT_CACHE_DB, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS gpt_cache ("
+            "key BLOB PRIMARY KEY, response TEXT, ts INTEGER)"
+        )
+        # Expired entries are swept once per process, when the cache is opened.
+        cutoff = int(time.time()) - GPT_CACHE_TTL_DAYS * 86400
+        conn.execute("DELETE FROM gpt_cache WHERE ts < ?", (cutoff,))
+        conn.commit()
+        _conn = conn
+    return _conn
+
+
+def _lookup(key: bytes):
+    cutoff = int(time.time()) - GPT_CACHE_TTL_DAYS * 86400
+    with _conn_lock:
+        row = _get_conn().execute(
+            "SELECT response FROM gpt_cache WHERE key = ? AND ts >= ?", (key, cutoff)
+        ).fetchone()
+    return row[0] if row else None
+
+
+def _store(key: bytes, response: str) -> None:
+    with _conn_lock:
+        conn = _get_conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO gpt_cache (key, response, ts) VALUES (?, ?, ?)",
+            (key, response, int(time.time()))
+        )
+        conn.commit()
+
+
+async def cached_gpt(messages: list, **kwargs) -> str:
+    """
+    Drop-in for get_gpt_response(messages=..., **kwargs) that answers an
+    identical earlier request from disk. Cache failures are logged and fall
+    through to a normal GPT call.
+    """
+    key = hashlib.blake2b(
+        json.dumps({"m": messages, "kw": kwargs}, sort_keys=True).encode(),
+        digest_size=16,
+    ).digest()
+
+    try:
+        cached = await asyncio.to_thread(_lookup, key)
+    except sqlite3.Error as e:
+        logger.warning("[gpt_cache] Lookup failed => %s", e)
+        cached = None
+    if cached is not None:
+        logger.debug("[gpt_cache] Hit for key=%s", key.hex())
+        return cached
+
+    reply = await get_gpt_response(messages=messages, **kwargs)
+    if reply not in (_BACKEND_UNAVAILABLE_REPLY, _GPT_ERROR_REPLY):
+        try:
+            await asyncio.to_thread(_store, key, reply)
+        except sqlite3.Error as e:
+            logger.warning("[gpt_cache] Store failed => %s", e)
+    return reply
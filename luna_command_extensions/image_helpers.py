@@ -1,14 +1,114 @@
 # image_helpers.py
 
 import os
+import asyncio
 import logging
 import urllib.parse
 
+from typing import Optional
+
 import aiohttp
 from nio import AsyncClient
 
 logger = logging.getLogger(__name__)
 
+# Shared HTTP session for image generation / download / upload calls, created
+# lazily on first use so it binds to the running event loop. Pooling keeps
+# connections to Synapse and OpenAI alive between requests.
+_HTTP_SESSION: Optional[aiohttp.ClientSession] = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Return the module-level aiohttp.ClientSession, creating it on first use
+    (or if a previous one was closed).
+    """
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None or _HTTP_SESSION.closed:
+        _HTTP_SESSION = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=120),
+            connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=75, ttl_dns_cache=300),
+        )
+    return _HTTP_SESSION
+
+
+async def close_http_session() -> None:
+    """
+    Close the shared session at shutdown, if one was ever opened.
+    """
+    global _HTTP_SESSION
+    if _HTTP_SESSION is not None and not _HTTP_SESSION.closed:
+        await _HTTP_SESSION.close()
+    _HTTP_SESSION = None
+
+# Where generated / downloaded images are written. The directory is created
+# once per process by ensure_images_dir().
+IMAGES_DIR = "data/images"
+_images_dir_ready = False
+
+
+async def ensure_images_dir() -> None:
+    """
+    Create IMAGES_DIR on first use (in a worker thread); later calls return
+    immediately without touching the filesystem.
+    """
+    global _images_dir_ready
+    if not _images_dir_ready:
+        await asyncio.to_thread(os.makedirs, IMAGES_DIR, exist_ok=True)
+        _images_dir_ready = True
+
+async def download_to_file(
+    url: str,
+    file_path: str,
+    timeout: float = 30,
+    chunk_size: int = 65536
+) -> int:
+    """
+    Stream `url` straight into `file_path` in fixed-size chunks, so the whole
+    image never sits in memory at once. File open/write calls run in a worker
+    thread. Returns the number of bytes written; raises on a non-2xx response.
+    """
+    written = 0
+    session = get_http_session()
+    async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+        resp.raise_for_status()
+        f = await asyncio.to_thread(open, file_path, "wb")
+        try:
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                await asyncio.to_thread(f.write, chunk)
+                written += len(chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+    return written
+
+
+async def download_bytes(url: str, timeout: float = 30) -> bytes:
+    """
+    Fetch `url` into memory with the shared session. Meant for images that
+    only get re-uploaded (no local copy needed); raises on a non-2xx response.
+    """
+    session = get_http_session()
+    async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+        resp.raise_for_status()
+        return await resp.read()
+
+
+async def _iter_file_chunks(file_path: str, chunk_size: int = 262144):
+    """
+    Async generator yielding the file in `chunk_size` pieces, with each read
+    done in a worker thread so the event loop never blocks on disk.
+    """
+    f = await asyncio.to_thread(open, file_path, "rb")
+    try:
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        f.close()
+
+
 async def direct_upload_image(
     client: AsyncClient,
     file_path: str,
@@ -16,39 +116,73 @@ async def direct_upload_image(
 ) -> str:
     """
     Manually upload a file to Synapse's media repository, explicitly setting
-    Content-Length (avoiding chunked requests).
+    Content-Length (avoiding chunked requests). The body is streamed from disk
+    in chunks read off the event loop.
     
     Returns the mxc:// URI if successful, or raises an exception on failure.
     """
+    file_size = await asyncio.to_thread(os.path.getsize, file_path)
+    return await _post_media(
+        client,
+        os.path.basename(file_path),
+        _iter_file_chunks(file_path),
+        file_size,
+        content_type
+    )
+
+
+async def direct_upload_image_bytes(
+    client: AsyncClient,
+    data: bytes,
+    content_type: str = "image/jpeg",
+    filename: str = "image.jpg"
+) -> str:
+    """
+    Same as direct_upload_image, but for an image already in memory (e.g. from
+    download_bytes), so it never has to be written to and read back from disk.
+
+    Returns the mxc:// URI if successful, or raises an exception on failure.
+    """
+    return await _post_media(client, filename, data, len(data), content_type)
+
+
+async def _post_media(
+    client: AsyncClient,
+    filename: str,
+    data,
+    size: int,
+    content_type: str
+) -> str:
+    """
+    POSTs `data` (bytes or an async chunk iterator of `size` bytes) to the
+    media repository and returns the content_uri.
+    """
     if not client.access_token or not client.homeserver:
         raise RuntimeError("AsyncClient has no access_token or homeserver set.")
 
     base_url = client.homeserver.rstrip("/")
-    filename = os.path.basename(file_path)
     encoded_name = urllib.parse.quote(filename)
     upload_url = f"{base_url}/_matrix/media/v3/upload?filename={encoded_name}"
 
-    file_size = os.path.getsize(file_path)
     headers = {
         "Authorization": f"Bearer {client.access_token}",
         "Content-Type": content_type,
-        "Content-Length": str(file_size),
+        "Content-Length": str(size),
     }
 
-    logger.debug("[direct_upload_image] POST to %s, size=%d", upload_url, file_size)
-
-    async with aiohttp.ClientSession() as session:
-        with open(file_path, "rb") as f:
-            async with session.post(upload_url, headers=headers, data=f) as resp:
-                if resp.status == 200:
-                    body = await resp.json()
-                    content_uri = body.get("content_uri")
-                    if not content_uri:
-                        raise RuntimeError("No 'content_uri' in response JSON.")
-                    logger.debug("[direct_upload_image] Uploaded. content_uri=%s", content_uri)
-                    return content_uri
-                else:
-                    err_text = await resp.text()
-                    raise RuntimeError(
-                        f"Upload failed (HTTP {resp.status}): {err_text}"
-                    )
+    logger.debug("[direct_upload_image] POST to %s, size=%d", upload_url, size)
+
+    session = get_http_session()
+    async with session.post(upload_url, headers=headers, data=data) as resp:
+        if resp.status == 200:
+            body = await resp.json()
+            content_uri = body.get("content_uri")
+            if not content_uri:
+                raise RuntimeError("No 'content_uri' in response JSON.")
+            logger.debug("[direct_upload_image] Uploaded. content_uri=%s", content_uri)
+            return content_uri
+        else:
+            err_text = await resp.text()
+            raise RuntimeError(
+                f"Upload failed (HTTP {resp.status}): {err_text}"
+            )
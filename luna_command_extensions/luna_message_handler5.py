@@ -7,74 +7,132 @@ via 'org.matrix.custom.html', so it can render bold/italics/etc. in the client.
 We have updated this version so that role-play channel responses are posted
 in a thread (using "m.relates_to": { "rel_type": "m.thread", ... }). DM behavior
 remains unchanged, posting in the main timeline.
+
+This module also carries the older handler4 behavior (role-play replies in the
+main timeline) as variant="timeline", so both share one set of caches, the
+markdown converter and the senders.
 """
 
-import time
+import re
+import html
+import functools
 import logging
 import random
 import asyncio
-import time
-import logging
-import markdown  # for converting GPT's string to HTML
+import threading
 
 from nio import (
     AsyncClient,
     RoomMessageText,
     RoomSendResponse,
-    RoomCreateResponse
 )
 
 from luna.luna_command_extensions.command_router import handle_console_command
-from luna.context_helper import build_context
-from luna.ai_functions import get_gpt_response
+from luna.luna_command_extensions.command_helpers import _check_and_mark_seen
+from luna.ai_functions import call_gpt_for_room
 from luna import bot_messages_store
+import luna.GLOBALS as g
 
-logger = logging.getLogger(__name__)
-BOT_START_TIME = time.time() * 1000
+try:
+    # Optional C parser for stripping tags from long GPT replies
+    from selectolax.parser import HTMLParser as _SelectolaxParser
+except ImportError:
+    _SelectolaxParser = None
 
-async def handle_luna_message5(bot_client: AsyncClient, bot_localpart: str, room, event: RoomMessageText):
+logger = logging.getLogger(__name__)
+_HTML_TAG_RE = re.compile(r'<[^>]*>')
+_SELECTOLAX_MIN_LEN = 512
+_MARKDOWN_CHARS = frozenset("*_`#[]-+>|\n")
+_ESCAPE_CHARS = frozenset("<>&\"'")
+# Replies longer than this are rendered / tag-stripped in a worker thread so a
+# big reply doesn't stall every other room on the loop; shorter ones are
+# cheaper to do inline than to hand off.
+_OFFLOAD_MIN_LEN = 2048
+# Only inputs up to this length are memoized (canned replies, error messages);
+# caching whole GPT replies would just pin large strings that never repeat.
+_MEMO_MAX_LEN = 512
+# Commands that answer within this many seconds never show a typing notice.
+_TYPING_DELAY = 0.2
+
+
+# GPT fallback settings (cache policy lives in ai_functions.call_gpt_for_room)
+GPT_MODEL = "gpt-4o"
+GPT_TEMPERATURE = 0.7
+
+# Where role-play command replies go, per variant:
+#   "thread"   => threaded reply to the command (handler5)
+#   "timeline" => plain reply in the room (old handler4)
+_ROLEPLAY_THREADED = {
+    "thread": True,
+    "timeline": False,
+}
+
+async def handle_luna_message5(
+    bot_client: AsyncClient,
+    bot_localpart: str,
+    room,
+    event: RoomMessageText,
+    *,
+    variant: str = "thread"
+):
     """
-    1) Ignores old/self messages
+    1) Ignores old messages
     2) Must be text
-    3) Saves inbound
+    3) Saves inbound, then ignores our own messages
     4) If DM (2 participants) => handle commands or GPT
        Else => role-play channel => commands => respond in-thread
+       (or in the main timeline with variant="timeline")
     """
-    message_body = event.body or ""
-    logger.info("handle_luna_message5: room=%s from=%s => %r",
-                room.room_id, event.sender, message_body)
+    threaded = _ROLEPLAY_THREADED[variant]
+    # 1) ignore old events (history replayed by the initial sync)
+    if event.server_timestamp < g.BOT_START_TIME:
+        logger.debug("Ignoring old event => %s", event.event_id)
+        return
 
-    # 3) store inbound
-    bot_messages_store.append_message(
-        bot_localpart=bot_localpart,
-        room_id=room.room_id,
-        event_id=event.event_id,
-        sender=event.sender,
-        timestamp=event.server_timestamp,
-        body=message_body
-    )
+    # 2) Must be text
+    if not isinstance(event, RoomMessageText):
+        logger.debug("Ignoring non-text event => %s", event.type)
+        return
 
-    # 1) ignore old / from self
-    if event.server_timestamp < BOT_START_TIME:
-        logger.debug("Ignoring old event => %s", event.event_id)
+    # drop redelivered events
+    if _check_and_mark_seen(bot_localpart, event.event_id):
+        logger.debug("Ignoring already-seen event => %s", event.event_id)
         return
 
+    message_body = event.body or ""
+    logger.info("handle_luna_message5: room=%s from=%s => %r",
+                room.room_id, event.sender, message_body)
+
+    # 3) store inbound (our own replies too, so they show up in GPT context)
+    bot_messages_store.enqueue_messages([{
+        "bot_localpart": bot_localpart,
+        "room_id": room.room_id,
+        "event_id": event.event_id,
+        "sender": event.sender,
+        "timestamp": event.server_timestamp,
+        "body": message_body,
+    }])
+
+    # ...but never answer ourselves
     bot_full_id = bot_client.user
     if event.sender == bot_full_id:
         logger.debug("Ignoring message from myself: %s", event.sender)
         return
 
-    # 2) Must be text
-    if not isinstance(event, RoomMessageText):
-        logger.debug("Ignoring non-text event => %s", event.type)
-        return
-
     # 4) DM vs. role-play channel
     participant_count = len(room.users)
     if participant_count == 2:
         await _handle_dm_channel(bot_client, bot_localpart, room, event, message_body)
     else:
-        await _handle_roleplay_channel(bot_client, bot_localpart, room, event, message_body)
+        await _handle_roleplay_channel(bot_client, bot_localpart, room, event, message_body, threaded)
+
+
+async def handle_luna_message4(bot_client: AsyncClient, bot_localpart: str, room, event: RoomMessageText):
+    """
+    The former luna_message_handler4 entry point: same flow, but role-play
+    replies are posted in the main timeline instead of a thread.
+    """
+    await handle_luna_message5(bot_client, bot_localpart, room, event, variant="timeline")
 
 
 async def _handle_dm_channel(bot_client, bot_localpart, room, event, message_body):
@@ -84,38 +142,59 @@ async def _handle_dm_channel(bot_client, bot_localpart, room, event, message_bod
       - Else => GPT fallback => interpret as Markdown
       - No thread usage here, unchanged from previous logic.
     """
-    await _start_typing(bot_client, room.room_id)
-
     if message_body.startswith("!"):
-        # commands
-        reply_text = await handle_console_command(bot_client, room.room_id, message_body, event.sender, event)
+        # commands; most finish well before a typing notice would be useful
+        stop_typing = _delayed_typing(bot_client, room.room_id)
+        try:
+            reply_text = await handle_console_command(bot_client, room.room_id, message_body, event.sender, event)
+
+            if "<table" in (reply_text or ""):
+                # Possibly HTML from e.g. !help
+                await send_formatted_text(bot_client, room.room_id, reply_text)
+            else:
+                await send_text(bot_client, room.room_id, reply_text)
+        finally:
+            # Stop typing (or never start it) no matter what
+            await stop_typing()
+        return
 
-        if "<table" in (reply_text or ""):
-            # Possibly HTML from e.g. !help
-            await send_formatted_text(bot_client, room.room_id, reply_text)
-        else:
-            await send_text(bot_client, room.room_id, reply_text)
+    # GPT fallback => interpret as Markdown. Typing start, the GPT call and
+    # the "realism" delay all run at once, so the delay is hidden behind
+    # the GPT latency instead of added to it.
+    _, gpt_reply, _ = await asyncio.gather(
+        _start_typing(bot_client, room.room_id),
+        call_gpt_for_room(
+            bot_localpart,
+            room.room_id,
+            message_body,
+            model=GPT_MODEL,
+            temperature=GPT_TEMPERATURE,
+            # queued above; keep it out of the history whether or not it's flushed yet
+            event_id=event.event_id,
+        ),
+        asyncio.sleep(random.uniform(0.5, 2.0)),
+    )
 
+    # Convert GPT’s string from Markdown => HTML
+    # (If GPT doesn't use markdown, it still renders fine.)
+    if len(gpt_reply) > _OFFLOAD_MIN_LEN:
+        reply_html = await asyncio.to_thread(_render_markdown, gpt_reply)
     else:
-        # GPT fallback => interpret as Markdown
-        await asyncio.sleep(random.uniform(0.5, 2.0))
-        gpt_reply = await _call_gpt(bot_localpart, room.room_id, message_body)
-
-        # Convert GPT’s string from Markdown => HTML
-        # (If GPT doesn't use markdown, it still renders fine.)
-        reply_html = markdown.markdown(gpt_reply, extensions=["extra", "sane_lists"])
-        # Then post it with formatted_text
-        await send_formatted_text(bot_client, room.room_id, reply_html)
-    
-    await bot_client.sync(timeout=500)
-    
-    await _stop_typing(bot_client, room.room_id)
-
-
-async def _handle_roleplay_channel(bot_client, bot_localpart, room, event, message_body):
+        reply_html = _render_markdown(gpt_reply)
+
+    # The reply and the typing-stop are independent homeserver requests, so
+    # issue them together.
+    await asyncio.gather(
+        send_formatted_text(bot_client, room.room_id, reply_html),
+        _stop_typing(bot_client, room.room_id),
+    )
+
+
+async def _handle_roleplay_channel(bot_client, bot_localpart, room, event, message_body, threaded=True):
     """
     If 3+ participants => role-play context:
       - Only respond to commands => respond in a thread referencing the user’s event
+        (or in the main timeline if not `threaded`)
       - Tag each response with context_cue="SYSTEM RESPONSE"
     """
     # 1) If the message does NOT start with '!', ignore
@@ -123,8 +202,8 @@ async def _handle_roleplay_channel(bot_client, bot_localpart, room, event, messa
         logger.debug("Ignoring non-command in role-play channel.")
         return
 
-    # 2) Indicate typing
-    await _start_typing(bot_client, room.room_id)
+    # 2) Indicate typing, unless the command answers first
+    stop_typing = _delayed_typing(bot_client, room.room_id)
 
     try:
         # 3) Handle the console command
@@ -137,29 +216,85 @@ async def _handle_roleplay_channel(bot_client, bot_localpart, room, event, messa
         )
 
         if command_reply is not None:
-            # 4) If the command output includes tables (<table>), we send HTML - in thread
+            parent_event_id = event.event_id if threaded else None
+            # 4) If the command output includes tables (<table>), we send HTML
             if "<table" in command_reply:
-                await send_formatted_text_in_thread(
+                await send_formatted_text(
                     bot_client, 
                     room.room_id, 
-                    event.event_id,           # parent's event_id
                     command_reply,
-                    context_cue="SYSTEM RESPONSE"
+                    context_cue="SYSTEM RESPONSE",
+                    parent_event_id=parent_event_id
                 )
             else:
-                await send_text_in_thread(
+                await send_text(
                     bot_client, 
                     room.room_id, 
-                    event.event_id,
                     command_reply,
-                    context_cue="SYSTEM RESPONSE"
+                    context_cue="SYSTEM RESPONSE",
+                    parent_event_id=parent_event_id
                 )
 
     finally:
-        # 5) Stop typing no matter what
-        await bot_client.sync(timeout=500) 
-        await _stop_typing(bot_client, room.room_id)
+        # 5) Stop typing (or never start it) no matter what
+        await stop_typing()
+
+
+def _maybe_escape(text: str) -> str:
+    """
+    html.escape, skipped when there is nothing to escape (the common case for
+    short plain replies).
+    """
+    if _ESCAPE_CHARS.isdisjoint(text):
+        return text
+    return html.escape(text)
+
+@functools.lru_cache(maxsize=None)
+def _markdown_converter():
+    """
+    Builds the one converter shared by all GPT replies, on first use, so
+    command-only traffic never pays for importing a markdown library.
+    mistune renders GPT markdown several times faster than python-markdown,
+    which is the fallback. Building a python-markdown instance registers every
+    extension from scratch, so we only reset() it between messages; it keeps
+    per-document state, so it's locked (long replies are rendered in worker
+    threads, see _OFFLOAD_MIN_LEN).
+    """
+    try:
+        import mistune
+    except ImportError:
+        mistune = None
+
+    if mistune is not None:
+        return mistune.create_markdown(escape=False, plugins=["table", "strikethrough", "url"])
+
+    import markdown  # for converting GPT's string to HTML
+    md = markdown.Markdown(extensions=["extra", "sane_lists"])
+    md_lock = threading.Lock()
+
+    def convert(text):
+        with md_lock:
+            return md.reset().convert(text)
+    return convert
+
+def _render_markdown(text: str) -> str:
+    """
+    Markdown => HTML using the shared converter. Single-line replies with no
+    markdown syntax at all are just escaped. Short inputs are memoized, since
+    canned replies and error messages repeat verbatim.
+    """
+    if len(text) <= _MEMO_MAX_LEN:
+        return _render_markdown_memo(text)
+    return _render_markdown_uncached(text)
+
+@functools.lru_cache(maxsize=512)
+def _render_markdown_memo(text: str) -> str:
+    return _render_markdown_uncached(text)
 
+def _render_markdown_uncached(text: str) -> str:
+    if _MARKDOWN_CHARS.isdisjoint(text):
+        return _maybe_escape(text)
+    return _markdown_converter()(text)
 
 async def _start_typing(bot_client: AsyncClient, room_id: str):
     try:
@@ -175,27 +310,41 @@ async def _stop_typing(bot_client: AsyncClient, room_id: str):
     except Exception as e:
         logger.warning("Could not send typing stop => %s", e)
 
+def _delayed_typing(bot_client: AsyncClient, room_id: str, delay: float = _TYPING_DELAY):
+    """
+    Schedules a typing notice `delay` seconds from now and returns an async
+    callable that undoes it: if the notice hasn't gone out yet it is simply
+    cancelled (no homeserver requests at all), otherwise typing is stopped.
+    """
+    started = []
 
-async def _call_gpt(bot_localpart: str, room_id: str, user_message: str) -> str:
-    context_config = {"max_history": 10}
-    gpt_context = build_context(bot_localpart, room_id, context_config)
-    gpt_context.append({"role": "user", "content": user_message})
-    logger.debug("GPT context => %s", gpt_context)
+    def _fire():
+        started.append(asyncio.ensure_future(_start_typing(bot_client, room_id)))
+
+    handle = asyncio.get_running_loop().call_later(delay, _fire)
+
+    async def stop():
+        handle.cancel()
+        if started:
+            await started[0]
+            await _stop_typing(bot_client, room_id)
+
+    return stop
 
-    reply = await get_gpt_response(
-        messages=gpt_context,
-        model="gpt-4o",
-        temperature=0.7,
-        max_tokens=2000
-    )
-    return reply
 
 # ---------------------------------------------------------------------
-# Senders for main timeline
+# Senders (main timeline, or threaded when parent_event_id is given)
 # ---------------------------------------------------------------------
-async def send_text(bot_client: AsyncClient, room_id: str, text: str, context_cue: str = None):
+def _thread_relation(parent_event_id: str) -> dict:
+    return {
+        "rel_type": "m.thread",
+        "event_id": parent_event_id
+    }
+
+async def send_text(bot_client: AsyncClient, room_id: str, text: str, context_cue: str = None, parent_event_id: str = None):
     """
-    Sends plain text to the main timeline. If `context_cue` is provided, we add it to the message content.
+    Sends plain text. If `context_cue` is provided, we add it to the message content.
+    If `parent_event_id` is provided, it is sent as a threaded reply to that event.
     """
     if text is None:
         return
@@ -204,109 +353,67 @@ async def send_text(bot_client: AsyncClient, room_id: str, text: str, context_cu
         "msgtype": "m.text",
         "body": text
     }
+    if parent_event_id:
+        content["m.relates_to"] = _thread_relation(parent_event_id)
     if context_cue:
         content["context_cue"] = context_cue  # custom field
 
     resp = await bot_client.room_send(room_id, "m.room.message", content=content)
     if isinstance(resp, RoomSendResponse):
-        logger.info("Sent text => event_id=%s in %s", resp.event_id, room_id)
+        logger.info("Sent text => event_id=%s in %s (parent=%s)",
+                    resp.event_id, room_id, parent_event_id)
     else:
         logger.warning("Failed to send text => %s", resp)
 
 
-async def send_formatted_text(bot_client: AsyncClient, room_id: str, html_content: str, context_cue: str = None):
+async def send_formatted_text(bot_client: AsyncClient, room_id: str, html_content: str, context_cue: str = None, parent_event_id: str = None):
     """
     Sends HTML in 'formatted_body', with a stripped fallback in 'body'.
     This can handle any markdown->html or other markup.
+    If `parent_event_id` is provided, it is sent as a threaded reply to that event.
     """
     if html_content is None:
         return
 
-    fallback_text = remove_html_tags(html_content)
+    if len(html_content) > _OFFLOAD_MIN_LEN:
+        fallback_text = await asyncio.to_thread(remove_html_tags, html_content)
+    else:
+        fallback_text = remove_html_tags(html_content)
     content = {
         "msgtype": "m.text",
         "body": fallback_text,
         "format": "org.matrix.custom.html",
         "formatted_body": html_content
     }
-
+    if parent_event_id:
+        content["m.relates_to"] = _thread_relation(parent_event_id)
     if context_cue:
         content["context_cue"] = context_cue  # custom field
 
     resp = await bot_client.room_send(room_id=room_id, message_type="m.room.message", content=content)
     if isinstance(resp, RoomSendResponse):
-        logger.info("Sent formatted text => event_id=%s in %s", resp.event_id, room_id)
-    else:
-        logger.warning("Failed to send formatted text => %s", resp)
-
-# ---------------------------------------------------------------------
-# Senders for thread
-# ---------------------------------------------------------------------
-async def send_text_in_thread(bot_client: AsyncClient, room_id: str, parent_event_id: str, text: str, context_cue: str = None):
-    """
-    Sends plain text as a threaded reply to parent_event_id.
-    """
-    if text is None:
-        return
-
-    content = {
-        "msgtype": "m.text",
-        "body": text,
-        "m.relates_to": {
-            "rel_type": "m.thread",
-            "event_id": parent_event_id
-        }
-    }
-
-    if context_cue:
-        content["context_cue"] = context_cue  # custom field
-
-    resp = await bot_client.room_send(
-        room_id=room_id,
-        message_type="m.room.message",
-        content=content
-    )
-    if isinstance(resp, RoomSendResponse):
-        logger.info("Sent text in thread => event_id=%s in %s (parent=%s)",
+        logger.info("Sent formatted text => event_id=%s in %s (parent=%s)",
                     resp.event_id, room_id, parent_event_id)
     else:
-        logger.warning("Failed to send text in thread => %s", resp)
-
-
-async def send_formatted_text_in_thread(bot_client: AsyncClient, room_id: str, parent_event_id: str, html_content: str, context_cue: str = None):
-    """
-    Sends HTML as a threaded reply to parent_event_id, with a stripped fallback in 'body'.
-    """
-    if html_content is None:
-        return
-
-    fallback_text = remove_html_tags(html_content)
-    content = {
-        "msgtype": "m.text",
-        "body": fallback_text,
-        "format": "org.matrix.custom.html",
-        "formatted_body": html_content,
-        "m.relates_to": {
-            "rel_type": "m.thread",
-            "event_id": parent_event_id
-        }
-    }
-
-    if context_cue:
-        content["context_cue"] = context_cue  # custom field
-
-    resp = await bot_client.room_send(
-        room_id=room_id,
-        message_type="m.room.message",
-        content=content
-    )
-    if isinstance(resp, RoomSendResponse):
-        logger.info("Sent formatted text in thread => event_id=%s in %s (parent=%s)",
-                    resp.event_id, room_id, parent_event_id)
-    else:
-        logger.warning("Failed to send formatted text in thread => %s", resp)
+        logger.warning("Failed to send formatted text => %s", resp)
 
 
 def remove_html_tags(text: str) -> str:
-    import re
-    return re.sub(r'<[^>]*>', '', text or "").strip()
+    # Short inputs (canned replies) are memoized; long ones are stripped fresh.
+    if text and len(text) <= _MEMO_MAX_LEN:
+        return _remove_html_tags_memo(text)
+    return _remove_html_tags(text)
+
+@functools.lru_cache(maxsize=1024)
+def _remove_html_tags_memo(text: str) -> str:
+    return _remove_html_tags(text)
+
+def _remove_html_tags(text: str) -> str:
+    # Every path decodes entities (&amp; => &), as selectolax's .text() does,
+    # so the plain body doesn't depend on reply length or installed packages.
+    if not text or "<" not in text:
+        return html.unescape(text or "").strip()
+    # Parser setup only pays off on long replies; short ones stay on the regex
+    if _SelectolaxParser is not None and len(text) >= _SELECTOLAX_MIN_LEN:
+        return _SelectolaxParser(text).text(separator="").strip()
+    return html.unescape(_HTML_TAG_RE.sub('', text)).strip()
@@ -1,21 +1,51 @@
 import json
 import logging
 import asyncio
-import re
-import time
+
+try:
+    import orjson as _json  # faster parse for the action script
+except ImportError:
+    _json = json
 
 logger = logging.getLogger(__name__)
 
-def parse_and_execute(script_str, loop):
+# How long to wait for a freshly created room to show up, and how often to look.
+_ROOM_WAIT_SECONDS = 2.0
+_ROOM_POLL_INTERVAL = 0.05
+
+async def _wait_room_ready(room_id, timeout=_ROOM_WAIT_SECONDS):
+    """
+    Polls until the director's client has joined `room_id` with enough power
+    to invite, instead of sleeping for a fixed worst-case delay.
+    Returns True once ready, False if `timeout` runs out first.
+    """
+    from luna.luna_functions import DIRECTOR_CLIENT
+    if DIRECTOR_CLIENT is None:
+        return False
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        room = DIRECTOR_CLIENT.rooms.get(room_id)
+        if (
+            room is not None
+            and DIRECTOR_CLIENT.user_id in room.users
+            and room.power_levels.can_user_invite(DIRECTOR_CLIENT.user_id)
+        ):
+            return True
+        if loop.time() >= deadline:
+            return False
+        await asyncio.sleep(_ROOM_POLL_INTERVAL)
+
+async def parse_and_execute(script_str):
     """
-    A blocking version of parse_and_execute that:
+    Runs a JSON action script on the bot's event loop:
       1) Creates rooms by name (private or public).
-      2) Parses the console output to grab the actual room ID.
+      2) Gets the actual room ID straight back from create_room_return_id.
       3) Stores the (name -> room_id) mapping in a dictionary so that future
          "invite_user" actions can use the real room ID.
-      4) Waits (or optionally does a forced sync) after creation so that
-         the director has fully joined the room with correct power level
-         before sending invites.
+      4) Waits after creation until the director has fully joined the room
+         with correct power level before sending invites.
 
     Example JSON:
     {
@@ -40,7 +70,7 @@ def parse_and_execute(script_str, loop):
     }
     """
     try:
-        data = json.loads(script_str)
+        data = _json.loads(script_str)
     except json.JSONDecodeError as e:
         logger.debug(f"[parse_and_execute] Failed to parse JSON => {e}")
         print(f"SYSTEM: Error parsing JSON => {e}")
@@ -48,7 +78,7 @@ def parse_and_execute(script_str, loop):
 
     script_title = data.get("title", "Untitled")
     logger.debug(f"[parse_and_execute] Beginning script => {script_title}")
-    print(f"SYSTEM: Running script titled '{script_title}' (blocking)...")
+    print(f"SYSTEM: Running script titled '{script_title}'...")
 
     actions = data.get("actions", [])
     if not actions:
@@ -57,19 +87,13 @@ def parse_and_execute(script_str, loop):
         return
 
     # We'll import these on demand to avoid circular references
-    from luna.console_functions import cmd_create_room
-    from luna.console_functions import cmd_invite_user
+    from luna.luna_command_extensions.create_room import create_room_return_id
+    from luna.console_functions import do_invite_user
 
     # 1) We'll keep a small map of "room_name" -> "room_id"
     #    so if user typed "myTreetop", we can transform that into e.g. "!abc123:localhost".
     name_to_id_map = {}
 
-    # Regex to capture something like:
-    # "SYSTEM: Created room 'myTreetop' => !abc123:localhost"
-    room_id_pattern = re.compile(
-        r"Created room '(.+)' => (![A-Za-z0-9]+:[A-Za-z0-9\.\-]+)"
-    )
-
     for i, action_item in enumerate(actions, start=1):
         action_type = action_item.get("type")
         args_dict = action_item.get("args", {})
@@ -87,46 +111,22 @@ def parse_and_execute(script_str, loop):
             else:
                 arg_string = f"\"{room_name}\""
 
-            # We capture the console output by temporarily redirecting stdout,
-            # or we can rely on the user to see "Created room 'X' => !id".
-            # For simplicity, let's just parse the log lines after cmd_create_room finishes.
-            original_stdout_write = None
-            output_lines = []
-
-            def custom_write(s):
-                output_lines.append(s)
-                if original_stdout_write:
-                    original_stdout_write(s)
-
-            import sys
-            if sys.stdout.write != custom_write:  # Only override once
-                original_stdout_write = sys.stdout.write
-                sys.stdout.write = custom_write
-
-            # 1a) Create the room (blocking call)
-            cmd_create_room(arg_string, loop)
-
-            # force a sync here
-            from luna.luna_functions import DIRECTOR_CLIENT
-            future = asyncio.run_coroutine_threadsafe(DIRECTOR_CLIENT.sync(timeout=1000), loop)
-            future.result()
-          
-            # 1b) Restore stdout
-            sys.stdout.write = original_stdout_write
-
-            # 1c) Parse the lines for the created room ID
-            for line in output_lines:
-                match = room_id_pattern.search(line)
-                if match:
-                    captured_name = match.group(1)  # e.g. myTreetop
-                    captured_id = match.group(2)    # e.g. !abc123:localhost
-                    if captured_name == room_name:
-                        name_to_id_map[room_name] = captured_id
-                        print(f"SYSTEM: Mapped '{room_name}' => '{captured_id}'")
-
-            # 1d) Sleep or forced sync to ensure the user is recognized
-            time.sleep(1.0)
-            # Optionally: you could call a forced sync here.
+            # 1a) Create the room; it hands back the new room ID.
+            captured_id, result_msg = await create_room_return_id(arg_string)
+            print(f"SYSTEM: {result_msg}")
+
+            if captured_id:
+                name_to_id_map[room_name] = captured_id
+                print(f"SYSTEM: Mapped '{room_name}' => '{captured_id}'")
+
+                # 1b) Rather than sleeping or forcing a sync, wait (up to
+                #     _ROOM_WAIT_SECONDS) until the director is joined with
+                #     the power to invite.
+                if not await _wait_room_ready(captured_id):
+                    logger.warning(
+                        "[parse_and_execute] Room %s not ready after %.1fs; continuing anyway.",
+                        captured_id, _ROOM_WAIT_SECONDS
+                    )
 
         elif action_type == "invite_user":
             user_id = args_dict.get("user_id")
@@ -138,9 +138,12 @@ def parse_and_execute(script_str, loop):
                 print(f"SYSTEM: Translating '{user_room}' -> '{real_id}' for invitation.")
                 user_room = real_id
 
-            arg_string = f"{user_id} {user_room}"
-            cmd_invite_user(arg_string, loop)
-            time.sleep(2.0)
+            if not user_id or not user_room:
+                print("SYSTEM: Usage: invite_user <user_id> <room_id_or_alias>")
+                continue
+
+            # Returns once the server has answered the invite.
+            print(f"SYSTEM: {await do_invite_user(user_id, user_room)}")
 
         else:
             logger.debug(f"[parse_and_execute] Unknown action type: {action_type}")
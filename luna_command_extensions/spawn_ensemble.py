@@ -4,15 +4,25 @@ import asyncio
 import json
 import logging
 
+try:
+    import orjson as _json  # faster parse for GPT's JSON reply
+except ImportError:
+    _json = json
+
 from nio import AsyncClient
 
 # Helper functions from your codebase
 from luna.luna_command_extensions.command_helpers import _post_in_thread, _keep_typing
 from luna.luna_command_extensions.spawn_persona import spawn_persona
-from luna.ai_functions import get_gpt_response
+from luna.ai_functions import stream_gpt_response, stream_json_array_elements
 
 logger = logging.getLogger(__name__)
 
+# How many personas of one ensemble are spawned at the same time. Each spawn
+# is a GPT call, a registration + login and a DALL·E call, so a large
+# ensemble fired all at once mostly buys rate-limit retries.
+_ENSEMBLE_MAX_CONCURRENCY = 5
+
 async def spawn_ensemble_command(
     bot_client: AsyncClient,
     invoking_room_id: str,
@@ -29,8 +39,8 @@ async def spawn_ensemble_command(
 
     Flow:
       1) Parse user’s entire prompt (raw_args).
-      2) Call GPT to produce a JSON array of objects like [{ "prompt": "Mouse A..." }, ... ].
-      3) For each object in that array, extract .prompt -> call spawn_persona(prompt_str).
+      2) Stream GPT's JSON array of objects like [{ "prompt": "Mouse A..." }, ... ].
+      3) As each object completes, extract .prompt -> start spawn_persona(prompt_str).
       4) Post partial updates in-thread, plus a final summary.
 
     spawn_persona() is expected to take a single text descriptor. 
@@ -61,10 +71,10 @@ async def spawn_ensemble_command(
         return
 
     # NEW IMPORT for config
-    from luna.luna_command_extensions.command_router import load_config
+    from luna.luna_command_extensions.command_router import get_cached_config
 
     # 2) Load config instructions for ensemble spawner, fallback if missing
-    cfg = load_config()
+    cfg = get_cached_config()
     system_instructions = cfg.get("ensemble_flow", {}).get("spawner_instructions", "")
     if not system_instructions:
         system_instructions = (
@@ -81,105 +91,99 @@ async def spawn_ensemble_command(
         {"role": "user",   "content": user_prompt},
     ]
 
-    # 3) Call GPT
+    # 3) Stream GPT's JSON array and kick off each persona's spawn as soon as
+    #    its { "prompt": "..." } object is complete, while GPT keeps generating.
+    spawn_slots = asyncio.Semaphore(_ENSEMBLE_MAX_CONCURRENCY)
+
+    async def _spawn_one(idx, sub_prompt):
+        try:
+            async with spawn_slots:
+                return idx, sub_prompt, await spawn_persona(sub_prompt), None
+        except Exception as e:
+            logger.exception(f"[spawn_ensemble] persona {idx} spawn failed =>")
+            return idx, sub_prompt, None, e
+
+    tasks = []
+    skipped_notes = []
+    total = 0
+    success_count = 0
+    fail_count = 0
+    stream_error = None
+
     try:
-        gpt_response = await get_gpt_response(
+        chunks = stream_gpt_response(
             messages=messages,
             model="gpt-4",
             temperature=0.7,
             max_tokens=1500
         )
+        async for raw_element in stream_json_array_elements(chunks):
+            total += 1
+            try:
+                obj = _json.loads(raw_element)
+            except Exception as e:
+                skipped_notes.append(f"(#{total}) Invalid JSON element from GPT => {e}. Skipping.")
+                fail_count += 1
+                continue
+            prompt = obj.get("prompt") if isinstance(obj, dict) else None
+            sub_prompt = prompt.strip() if isinstance(prompt, str) else ""
+            if not sub_prompt:
+                skipped_notes.append(f"(#{total}) Missing 'prompt' key in GPT output. Skipping.")
+                fail_count += 1
+                continue
+            tasks.append(asyncio.create_task(_spawn_one(total, sub_prompt)))
     except Exception as e:
-        logger.exception("[spawn_ensemble] GPT error =>")
-        await _post_in_thread(
-            bot_client,
-            invoking_room_id,
-            parent_event_id,
-            f"<p><strong>Oops!</strong> GPT error => {e}</p>",
-            is_html=True
-        )
-        typing_task.cancel()
-        return
+        logger.exception("[spawn_ensemble] GPT stream error =>")
+        stream_error = e
 
-    # 4) Parse JSON array of { "prompt": "..." }
-    try:
-        persona_array = json.loads(gpt_response)
-        if not isinstance(persona_array, list):
-            raise ValueError("GPT returned something that's not a JSON array.")
-    except Exception as e:
-        logger.exception("[spawn_ensemble] JSON parse error =>")
+    if stream_error is not None and total == 0:
         await _post_in_thread(
             bot_client,
             invoking_room_id,
             parent_event_id,
-            f"<p><strong>Oops!</strong> Invalid JSON from GPT => {e}</p>",
+            f"<p><strong>Oops!</strong> GPT error => {stream_error}</p>",
             is_html=True
         )
         typing_task.cancel()
         return
+    if stream_error is not None:
+        skipped_notes.append(f"GPT stream broke off after {total} descriptor(s) => {stream_error}")
 
-    total = len(persona_array)
-    success_count = 0
-    fail_count = 0
-
+    # The spawns are already running while this status goes out
     await _post_in_thread(
         bot_client,
         invoking_room_id,
         parent_event_id,
-        f"Received {total} descriptors. Spawning each persona now...",
+        "\n".join([f"Received {total} descriptors. Spawning each persona now..."] + skipped_notes),
         is_html=False
     )
 
-    # 5) For each sub-prompt, call spawn_persona()
     bot_id = None
-    for idx, obj in enumerate(persona_array, start=1):
-        sub_prompt = obj.get("prompt", "").strip()
-        if not sub_prompt:
-            await _post_in_thread(
-                bot_client,
-                invoking_room_id,
-                parent_event_id,
-                f"(#{idx}/{total}) Missing 'prompt' key in GPT output. Skipping.",
-                is_html=False
-            )
+    for next_done in asyncio.as_completed(tasks):
+        idx, sub_prompt, result, error = await next_done
+
+        # spawn_persona returns a plain "SYSTEM: ..." string on GPT/JSON errors
+        if error is None and not isinstance(result, dict):
+            error = result
+
+        # One post per persona: the prompt header plus its card (or the failure)
+        header_html = f"<p><strong>Persona #{idx}/{total}:</strong> Prompt: {sub_prompt}</p>"
+        if error is None:
+            bot_id = result["bot_id"]
+            body_html = result["html"]
+            success_count += 1
+        else:
+            body_html = f"<p>Persona #{idx} spawn failed => {error}</p>"
             fail_count += 1
-            continue
 
-        # Post partial update
         await _post_in_thread(
             bot_client,
             invoking_room_id,
             parent_event_id,
-            f"<p><strong>Persona #{idx}/{total}:</strong> Prompt: {sub_prompt}</p>",
+            header_html + body_html,
             is_html=True
         )
 
-        # Call spawn_persona
-        try:
-            result = await spawn_persona(sub_prompt)
-            card_html = result["html"]
-            bot_id = result["bot_id"]
-
-            # Post the card
-            await _post_in_thread(
-                bot_client,
-                invoking_room_id,
-                parent_event_id,
-                card_html,
-                is_html=True
-            )
-            success_count += 1
-        except Exception as e:
-            logger.exception(f"[spawn_ensemble] persona {idx} spawn failed =>")
-            fail_count += 1
-            await _post_in_thread(
-                bot_client,
-                invoking_room_id,
-                parent_event_id,
-                f"<p>Persona #{idx} spawn failed => {e}</p>",
-                is_html=True
-            )
-
     # 6) Final summary
     final_msg = (
         f"<p><strong>All done!</strong> "
@@ -1,17 +1,93 @@
+import asyncio
+import hashlib
+import html
+import itertools
 import logging
 import json
-import time
 import os
 
-from luna.ai_functions import get_gpt_response, generate_image
+try:
+    import orjson as _json  # faster parse for GPT's persona JSON
+except ImportError:
+    _json = json
+
+from luna.ai_functions import (
+    generate_image,
+    get_gpt_response,
+    stream_gpt_response,
+    stream_json_array_elements,
+)
 from luna.luna_command_extensions.create_and_login_bot import create_and_login_bot
 from luna.luna_personas import update_bot
 from luna.luna_functions import getClient
-from luna.luna_command_extensions.image_helpers import direct_upload_image
+from luna.luna_command_extensions.image_helpers import (
+    direct_upload_image_bytes,
+    download_bytes,
+)
 
 logger = logging.getLogger(__name__)
 
-async def spawn_persona(descriptor: str) -> str:
+# GPT's persona JSON, kept on disk by a hash of the request until that persona
+# has actually been registered. A spawn that fails after the slow GPT step can
+# then be retried with the same descriptor without paying for GPT again. Once
+# registered, the localpart is taken, so the entry is dropped.
+PERSONA_CACHE_DIR = "data/cache/gpt"
+
+# Persona JSON comes back in JSON mode, so a small fast model is enough; a
+# persona is well under 500 tokens.
+PERSONA_GPT_MODEL = "gpt-4o-mini"
+PERSONA_MAX_TOKENS = 1000
+
+_PERSONA_KEYS_INSTRUCTIONS = (
+    "The persona object must have keys: localpart, displayname, biography, backstory, "
+    "system_prompt, password, traits. No other keys. "
+    "The 'traits' key is a JSON object with arbitrary key/values. "
+    "Be sure that the system prompt instructs the bot to behave in character."
+)
+_PERSONA_INSTRUCTIONS = "You generate persona objects as JSON. " + _PERSONA_KEYS_INSTRUCTIONS
+_PERSONA_BATCH_INSTRUCTIONS = (
+    "You generate persona objects as JSON. Return a JSON object with a single key "
+    "'personas': an array holding exactly one persona object per numbered descriptor, "
+    "in the same order. " + _PERSONA_KEYS_INSTRUCTIONS + " "
+    "In this batch only, each persona object additionally starts with an 'index' "
+    "key holding its descriptor's number."
+)
+
+# Persona requests arriving within _PERSONA_BATCH_WINDOW seconds of each other
+# (an ensemble's spawns, or quick repeated !spawn commands) are merged into a
+# single GPT call of up to _PERSONA_BATCH_MAX descriptors, so the shared
+# instructions are sent once instead of once per persona.
+_PERSONA_BATCH_WINDOW = 0.2
+_PERSONA_BATCH_MAX = 5
+_pending_personas = []  # (descriptor, single-persona messages, future)
+_persona_flush_handle = None
+
+# DALL·E's per-minute limit is tight; an ensemble firing every portrait at once
+# just earns 429s. At most this many portrait generations run at a time.
+_PORTRAIT_MAX_CONCURRENCY = 2
+_portrait_slots = asyncio.Semaphore(_PORTRAIT_MAX_CONCURRENCY)
+
+# GPT replies longer than this are parsed on a worker thread; below it the
+# thread hop costs more than json.loads itself.
+_JSON_OFFLOAD_LEN = 4096
+
+# Shape GPT's persona object must have before we try to register it.
+_PERSONA_STR_FIELDS = ("localpart", "password", "displayname", "system_prompt")
+_PERSONA_OPTIONAL_STR_FIELDS = ("biography", "backstory")
+
+# command_router imports this module, so its GLOBAL_PARAMS dict is fetched on
+# first use. set_param/get_param only mutate that dict, never rebind it, so the
+# reference stays current.
+_global_params_ref = None
+
+def _global_params() -> dict:
+    global _global_params_ref
+    if _global_params_ref is None:
+        from luna.luna_command_extensions.command_router import GLOBAL_PARAMS
+        _global_params_ref = GLOBAL_PARAMS
+    return _global_params_ref
+
+async def spawn_persona(descriptor: str, use_cache: bool = True) -> str:
     """
     Creates a new persona, returning one HTML string that includes:
     - A table (the "character card") with:
@@ -19,20 +95,20 @@ async def spawn_persona(descriptor: str) -> str:
        * the EXACT DALL·E prompt used for image creation
        * traits as a nested table
     - Possibly an <img> referencing the final mxc:// URI.
+
+    With use_cache=False, GPT is always asked for a fresh persona.
     """
 
+    # 0) The portrait only depends on the descriptor, so start generating it
+    #    now and let it run alongside the GPT + registration steps below.
+    #    We store the EXACT DALL·E prompt in 'final_prompt'.
+    final_prompt = descriptor.strip()
+    portrait_task = asyncio.create_task(_generate_portrait(final_prompt))
+
     # 1) GPT => persona JSON
-    system_instructions = (
-        "You are an assistant that outputs ONLY valid JSON. "
-        "No markdown, no code fences, no extra commentary. "
-        "Generate a persona object which must have keys: localpart, displayname, biography, backstory, "
-        "system_prompt, password, traits. No other keys. "
-        "The 'traits' key is a JSON object with arbitrary key/values. "
-        "Be sure that the system prompt instructs the bot to behave in character."
-    )
+    system_instructions = _PERSONA_INSTRUCTIONS
     user_message = (
-        f"Create a persona based on:\n{descriptor}\n\n"
-        "Return ONLY valid JSON with required keys."
+        f"Create a persona based on:\n{descriptor}"
     )
 
     messages = [
@@ -40,29 +116,35 @@ async def spawn_persona(descriptor: str) -> str:
         {"role": "user", "content": user_message},
     ]
 
-    logger.info(f"SYSTEM: Attemping to get a character card generated via GPT. System Instruction: {system_instructions}. Prompt: {user_message}")
-    try:
-        gpt_response = await get_gpt_response(
-            messages=messages,
-            model="gpt-4",
-            temperature=0.7,
-            max_tokens=5000
-        )
-    except Exception as e:
-        logger.exception("GPT error =>")
-        return f"SYSTEM: GPT error => {e}"
+    cache_path = _persona_cache_path(messages, PERSONA_GPT_MODEL, 0.7)
+    gpt_response = await asyncio.to_thread(_read_cached_persona, cache_path) if use_cache else None
+    if gpt_response is not None:
+        logger.info("SYSTEM: Reusing cached persona JSON for descriptor => %s", descriptor)
+    else:
+        logger.info(f"SYSTEM: Attemping to get a character card generated via GPT. System Instruction: {system_instructions}. Prompt: {user_message}")
+        try:
+            gpt_response = await _request_persona_json(descriptor, messages)
+        except Exception as e:
+            logger.exception("GPT error =>")
+            portrait_task.cancel()
+            return f"SYSTEM: GPT error => {e}"
 
     # 2) Parse persona JSON
     try:
-        persona_data = json.loads(gpt_response)
+        persona_data = await _loads_gpt_json(gpt_response)
     except json.JSONDecodeError as e:
         logger.exception("JSON parse error =>")
+        portrait_task.cancel()
         return f"SYSTEM: GPT returned invalid JSON => {e}"
 
-    required = ["localpart", "password", "displayname", "system_prompt", "traits"]
-    missing = [f for f in required if f not in persona_data]
-    if missing:
-        return f"SYSTEM: Persona missing fields => {missing}"
+    problems = _persona_problems(persona_data)
+    if problems:
+        portrait_task.cancel()
+        return f"SYSTEM: Persona invalid => {'; '.join(problems)}"
+
+    # Good persona JSON; keep it until the persona is registered
+    if use_cache:
+        await asyncio.to_thread(_write_cached_persona, cache_path, gpt_response)
 
     localpart     = persona_data["localpart"]
     password      = persona_data["password"]
@@ -73,13 +155,17 @@ async def spawn_persona(descriptor: str) -> str:
     backstory     = persona_data.get("backstory", "")
 
     # 3) Register & login the persona
-    bot_result = await create_and_login_bot(
-        bot_id=f"@{localpart}:localhost",
-        password=password,
-        displayname=displayname,
-        system_prompt=system_prompt,
-        traits=traits
-    )
+    try:
+        bot_result = await create_and_login_bot(
+            bot_id=f"@{localpart}:localhost",
+            password=password,
+            displayname=displayname,
+            system_prompt=system_prompt,
+            traits=traits
+        )
+    except BaseException:
+        portrait_task.cancel()
+        raise
     bot_id = bot_result["bot_id"]
     spawn_msg = bot_result["html"]                       # e.g. success/error message in HTML
     ephemeral_bot_client = bot_result["client"]          # the AsyncClient instance
@@ -87,30 +173,37 @@ async def spawn_persona(descriptor: str) -> str:
     if not bot_result["ok"]:
         # Something went wrong. You could return or raise an error, for example:
         error_details = bot_result.get("error", "Unknown error")
+        portrait_task.cancel()
+        # The cached JSON would only hit the same taken localpart (or an account
+        # whose password differs) again, so the next try must ask GPT afresh.
+        if use_cache and _is_identity_collision(bot_result):
+            await asyncio.to_thread(_drop_cached_persona, cache_path)
         raise RuntimeError(f"Persona creation failed: {error_details}")
+
+    if use_cache:
+        await asyncio.to_thread(_drop_cached_persona, cache_path)
    
     if bot_id.startswith('@'):
         bot_id = bot_id[1:]  # Remove the first '@'
     if bot_id.endswith(':localhost'):
         bot_id = bot_id[:-10]  # Remove the last ':localhost'
     
-    # 4) Attempt to generate & upload a portrait
-    #    We'll store the EXACT DALL·E prompt in 'final_prompt'
-    final_prompt = descriptor.strip()  
+    # 4) Collect the portrait started in step 0 & upload it
     portrait_mxc = None
     try:
-        portrait_url = await generate_image(final_prompt, size="1024x1024")
+        portrait_url = await portrait_task
         if portrait_url:
             portrait_mxc = await _download_and_upload_portrait(portrait_url, bot_id, password, system_prompt, traits, ephemeral_bot_client)
     except Exception as e:
         logger.warning("Portrait error => %s", e)
 
     # get the global style prompt appendix
-    from luna.luna_command_extensions.command_router import GLOBAL_PARAMS
-    global_draw_appendix = GLOBAL_PARAMS["global_draw_prompt_appendix"]
+    global_draw_appendix = _global_params().get("global_draw_prompt_appendix", "")
 
     # 5) Build final HTML table (with nested table for `traits`)
-    #    plus an <img> if we have a portrait.
+    #    plus an <img> if we have a portrait. Traits are escaped once here,
+    #    after the portrait step has added portrait_url to them.
+    escaped_traits = [(_esc(k), _esc(v)) for k, v in traits.items()]
     card_html = _build_persona_card(
         localpart=localpart,
         displayname=displayname,
@@ -118,7 +211,7 @@ async def spawn_persona(descriptor: str) -> str:
         backstory=backstory,
         system_prompt=system_prompt,
         dall_e_prompt=final_prompt,   # EXACT final prompt
-        traits=traits,
+        escaped_traits=escaped_traits,
         portrait_mxc=portrait_mxc,
         global_draw_appendix = global_draw_appendix 
     )
@@ -131,12 +224,19 @@ async def spawn_persona(descriptor: str) -> str:
 
 async def cmd_spawn(bot_client, descriptor):
     """
-    Usage: spawn "A cosmic explorer..."
+    Usage: spawn [--fresh] "A cosmic explorer..."
     Returns a single HTML string containing the entire character card
-    (table + optional <img>).
+    (table + optional <img>). --fresh skips the cached persona JSON from an
+    earlier failed attempt and asks GPT for a new persona.
     """
+    tokens = descriptor.split()
+    use_cache = "--fresh" not in tokens
+    if not use_cache:
+        descriptor = " ".join(t for t in tokens if t != "--fresh")
     try:
-        result = await spawn_persona(descriptor)  # now returns a dict {"html": ..., "bot_id": ...}
+        result = await spawn_persona(descriptor, use_cache=use_cache)  # dict {"html": ..., "bot_id": ...}
+        if not isinstance(result, dict):
+            return result                        # "SYSTEM: ..." GPT/JSON error text
         card_html = result["html"]               # extract the HTML portion
         return card_html
     except Exception as e:
@@ -149,6 +249,187 @@ async def cmd_spawn(bot_client, descriptor):
 # Internal helpers
 # ----------------------------------------------------------------------
 
+async def _request_persona_json(descriptor: str, messages: list) -> str:
+    """
+    Queues `descriptor` for the next batched persona call and waits for its
+    persona JSON text. `messages` is the single-persona request, used when the
+    batch holds only this descriptor or the batched reply can't be used.
+    """
+    global _persona_flush_handle
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    _pending_personas.append((descriptor, messages, future))
+
+    if len(_pending_personas) >= _PERSONA_BATCH_MAX:
+        _flush_persona_batch()
+    elif _persona_flush_handle is None:
+        _persona_flush_handle = loop.call_later(_PERSONA_BATCH_WINDOW, _flush_persona_batch)
+    return await future
+
+def _flush_persona_batch() -> None:
+    global _persona_flush_handle
+    if _persona_flush_handle is not None:
+        _persona_flush_handle.cancel()
+        _persona_flush_handle = None
+    batch = _pending_personas[:]
+    _pending_personas.clear()
+    if batch:
+        asyncio.ensure_future(_run_persona_batch(batch))
+
+async def _run_persona_batch(batch: list) -> None:
+    """
+    One GPT call for every descriptor in `batch`, resolving each waiter with
+    its own persona as JSON text. The batched reply is streamed, so a waiter
+    can move on to registration as soon as its persona is complete. Any
+    descriptor the batched reply doesn't cover gets its own call.
+    """
+    try:
+        if len(batch) > 1:
+            await _stream_persona_array(batch)
+            batch = [item for item in batch if not item[2].done()]
+            if batch:
+                logger.warning("[spawn_persona] Batched persona reply missed %d descriptor(s); asking per descriptor.", len(batch))
+
+        replies = await asyncio.gather(
+            *(
+                get_gpt_response(
+                    messages=messages,
+                    model=PERSONA_GPT_MODEL,
+                    temperature=0.7,
+                    max_tokens=PERSONA_MAX_TOKENS,
+                    response_format={"type": "json_object"}
+                )
+                for _, messages, _ in batch
+            ),
+            return_exceptions=True
+        )
+        for (_, _, future), reply in zip(batch, replies):
+            if future.done():
+                continue
+            if isinstance(reply, BaseException):
+                future.set_exception(reply)
+            else:
+                future.set_result(reply)
+    except Exception as e:
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+
+async def _stream_persona_array(batch: list) -> None:
+    """
+    Asks GPT for one persona per descriptor in a single streamed call and
+    resolves each waiter in `batch` as soon as the persona carrying its
+    'index' has arrived. Elements that don't parse, lack a valid index or
+    repeat one are skipped; those waiters are left pending for the caller.
+    """
+    numbered = "\n".join(f"{i}. {d}" for i, (d, _, _) in enumerate(batch, start=1))
+    messages = [
+        {"role": "system", "content": _PERSONA_BATCH_INSTRUCTIONS},
+        {"role": "user", "content": f"Create one persona for each of these descriptors:\n{numbered}"},
+    ]
+    logger.info("SYSTEM: Requesting %d personas from GPT in one streamed call.", len(batch))
+    chunks = stream_gpt_response(
+        messages=messages,
+        model=PERSONA_GPT_MODEL,
+        temperature=0.7,
+        max_tokens=PERSONA_MAX_TOKENS * len(batch),
+        response_format={"type": "json_object"}
+    )
+    try:
+        async for raw_element in stream_json_array_elements(chunks):
+            try:
+                persona = _json.loads(raw_element)
+            except ValueError:
+                continue
+            if not isinstance(persona, dict):
+                continue
+            index = persona.pop("index", None)
+            if not isinstance(index, int) or not 1 <= index <= len(batch):
+                continue
+            future = batch[index - 1][2]
+            if not future.done():
+                future.set_result(json.dumps(persona))
+    except Exception as e:
+        logger.warning("[spawn_persona] Batched persona stream failed => %s", e)
+
+def _persona_problems(persona) -> list:
+    """
+    Checks a decoded persona against the fields spawning relies on, in one
+    pass. Returns a list of human-readable problems (empty if it's usable),
+    catching mistyped fields (e.g. traits sent back as a string) as well as
+    missing ones.
+    """
+    if not isinstance(persona, dict):
+        return [f"expected a JSON object, got {type(persona).__name__}"]
+    problems = []
+    for field in _PERSONA_STR_FIELDS:
+        value = persona.get(field)
+        if value is None:
+            problems.append(f"missing '{field}'")
+        elif not isinstance(value, str) or not value.strip():
+            problems.append(f"'{field}' must be a non-empty string")
+    for field in _PERSONA_OPTIONAL_STR_FIELDS:
+        if not isinstance(persona.get(field, ""), str):
+            problems.append(f"'{field}' must be a string")
+    if "traits" not in persona:
+        problems.append("missing 'traits'")
+    elif not isinstance(persona["traits"], (dict, type(None))):
+        problems.append("'traits' must be a JSON object")
+    return problems
+
+async def _generate_portrait(prompt: str) -> str:
+    async with _portrait_slots:
+        return await generate_image(prompt, size="1024x1024")
+
+async def _loads_gpt_json(text: str):
+    if len(text) > _JSON_OFFLOAD_LEN:
+        return await asyncio.to_thread(_json.loads, text)
+    return _json.loads(text)
+
+def _persona_cache_path(messages: list, model: str, temperature: float) -> str:
+    key = hashlib.sha256(
+        json.dumps([model, temperature, messages], sort_keys=True).encode()
+    ).hexdigest()
+    return os.path.join(PERSONA_CACHE_DIR, f"{key}.json")
+
+def _read_cached_persona(path: str):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.warning("Could not read persona cache %s => %s", path, e)
+        return None
+
+def _write_cached_persona(path: str, gpt_response: str) -> None:
+    try:
+        os.makedirs(PERSONA_CACHE_DIR, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(gpt_response)
+    except OSError as e:
+        logger.warning("Could not write persona cache %s => %s", path, e)
+
+def _is_identity_collision(bot_result: dict) -> bool:
+    """
+    True if create_and_login_bot failed because the persona's identity is
+    already taken: the persona entry exists, or the (pre-existing) account
+    rejected the generated password.
+    """
+    error = str(bot_result.get("error") or "")
+    return "already exists" in error or "Ephemeral login failed" in str(bot_result.get("html") or "")
+
+def _drop_cached_persona(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("Could not remove persona cache %s => %s", path, e)
+
+# Portrait upload names; int(time.time()) gave overlapping spawns the same name.
+_portrait_counter = itertools.count()
+
 async def _download_and_upload_portrait(
     portrait_url: str,
     localpart: str,
@@ -161,18 +442,14 @@ async def _download_and_upload_portrait(
     Download the image from portrait_url, upload to matrix,
     update persona record + set bot avatar. Returns mxc:// URI or None.
     """
-    import requests
-    os.makedirs("data/images", exist_ok=True)
-    filename = f"data/images/portrait_{int(time.time())}.jpg"
-    dl_resp = requests.get(portrait_url)
-    dl_resp.raise_for_status()
-    with open(filename, "wb") as f:
-        f.write(dl_resp.content)
-
     client = getClient()
     if not client:
         return None
-    portrait_mxc = await direct_upload_image(client, filename, "image/jpeg")
+    # Straight from the DALL·E URL into the media repo; no local copy needed.
+    portrait_bytes = await download_bytes(portrait_url)
+    portrait_mxc = await direct_upload_image_bytes(
+        client, portrait_bytes, "image/jpeg", f"portrait_{next(_portrait_counter)}_{os.getpid()}.jpg"
+    )
     # Update persona
     traits["portrait_url"] = portrait_mxc
     update_bot(
@@ -192,6 +469,32 @@ async def _download_and_upload_portrait(
 
     return portrait_mxc
 
+# Static scaffolding for _build_persona_card
+_TRAIT_ROW_TMPL = (
+    "<tr>"
+    "<td style='padding:2px 6px;'><b>{k}</b></td>"
+    "<td style='padding:2px 6px;'>{v}</td>"
+    "</tr>"
+)
+_TRAITS_TABLE_TMPL = (
+    "<table border='1' style='border-collapse:collapse; font-size:0.9em;'>"
+    "<thead><tr><th colspan='2'>Traits</th></tr></thead>"
+    "<tbody>{rows}</tbody>"
+    "</table>"
+)
+_CARD_ROW_TMPL = (
+    "<tr>"
+    "<td style='padding:4px 8px;vertical-align:top;'><b>{label}</b></td>"
+    "<td style='padding:4px 8px;'>{val}</td>"
+    "</tr>"
+)
+
+def _esc(t) -> str:
+    return html.escape(str(t))
+
+def _card_row(label: str, val: str) -> str:
+    return _CARD_ROW_TMPL.format(label=_esc(label), val=val)
+
 def _build_persona_card(
     localpart: str,
     displayname: str,
@@ -200,7 +503,7 @@ def _build_persona_card(
     system_prompt: str,
     dall_e_prompt: str,
     global_draw_appendix: str,
-    traits: dict,
+    escaped_traits: list,
     portrait_mxc: str = None
 ) -> str:
     """
@@ -208,38 +511,20 @@ def _build_persona_card(
     2) Show an italic line beneath the title (e.g. the displayname).
     3) Then the portrait if available.
     4) Then a table with the rest of the details, including version=1.0.
+
+    `escaped_traits` is a list of already HTML-escaped (key, value) pairs.
     """
 
-    import html
-    def esc(t): 
-        return html.escape(str(t))
+    esc = _esc
+    row = _card_row
 
     # -------------------------
     # Sub-table for traits
     # -------------------------
-    trait_rows = []
-    for k, v in traits.items():
-        trait_rows.append(
-            "<tr>"
-            f"<td style='padding:2px 6px;'><b>{esc(k)}</b></td>"
-            f"<td style='padding:2px 6px;'>{esc(v)}</td>"
-            "</tr>"
-        )
-    traits_subtable = (
-        "<table border='1' style='border-collapse:collapse; font-size:0.9em;'>"
-        "<thead><tr><th colspan='2'>Traits</th></tr></thead>"
-        f"<tbody>{''.join(trait_rows)}</tbody>"
-        "</table>"
+    trait_rows = "".join(
+        _TRAIT_ROW_TMPL.format(k=k, v=v) for k, v in escaped_traits
     )
-
-    # A quick helper to build each row
-    def row(label, val):
-        return (
-            "<tr>"
-            f"<td style='padding:4px 8px;vertical-align:top;'><b>{esc(label)}</b></td>"
-            f"<td style='padding:4px 8px;'>{val}</td>"
-            "</tr>"
-        )
+    traits_subtable = _TRAITS_TABLE_TMPL.format(rows=trait_rows)
 
     # -------------------------
     # The portrait HTML (if any)
@@ -2,19 +2,38 @@
 
 import logging
 import json
-from typing import Optional
+import os
+import sqlite3
+import threading
+from typing import AsyncIterator, Optional, Union
+from urllib.request import pathname2url
 import re
 import asyncio
 from nio import AsyncClient, RoomSendResponse
 
 # Import from your codebase
 from luna.bot_messages_store import BOT_MESSAGES_DB
-from luna.ai_functions import get_gpt_response
-from luna.luna_command_extensions.command_router import GLOBAL_PARAMS, load_config
+from luna.luna_command_extensions.gpt_cache import cached_gpt
+from luna.luna_command_extensions.command_router import GLOBAL_PARAMS, get_cached_config
 from luna.luna_command_extensions.command_helpers import _keep_typing, _post_in_thread, _strip_html_tags
 
 logger = logging.getLogger(__name__)
 
+# Leading ```json / ``` and trailing ``` fences GPT sometimes wraps JSON in.
+_FENCE_OPEN_REGEX = re.compile(r"^```(?:json)?\s*")
+_FENCE_CLOSE_REGEX = re.compile(r"\s*```$")
+
+# Rows per summarizer chunk; the query result is also read from SQLite in
+# pages of this size, so each page becomes one chunk.
+_CHUNK_ROWS = 50
+
+# One read-only connection shared by every summarize run (bot_messages.db is
+# already in WAL mode, see bot_messages_store.load_messages, so these reads
+# never block the message writer). Read-only also means a GPT-written query
+# can't modify the DB even if it slips past the SELECT check.
+_read_conn: Optional[sqlite3.Connection] = None
+_read_conn_lock = threading.Lock()
+
 async def run_summarize_pipeline(
     bot_client: AsyncClient,
     room_id: str,
@@ -55,9 +74,8 @@ async def run_summarize_pipeline(
             qb_output_clean = qb_output.strip()
 
             # Remove ```json or ```
-            qb_output_clean = re.sub(r"^```json\s*", "", qb_output_clean)
-            qb_output_clean = re.sub(r"^```\s*", "", qb_output_clean)
-            qb_output_clean = re.sub(r"\s*```$", "", qb_output_clean)
+            qb_output_clean = _FENCE_OPEN_REGEX.sub("", qb_output_clean)
+            qb_output_clean = _FENCE_CLOSE_REGEX.sub("", qb_output_clean)
 
             qb_data = json.loads(qb_output_clean)
 
@@ -87,15 +105,27 @@ async def run_summarize_pipeline(
     )
 
 
-    # 4) Execute the query
-    rows = await _execute_query(query_sql)
+    # 4) Execute the query; its rows are read page by page while the
+    #    summarizer is already working on the earlier pages.
+    pages = await _execute_query(query_sql)
+
+    # A query error falls back to a simpler approach; a valid query that
+    # matched nothing is reported as such rather than widened.
+    if pages == []:
+        await _post_in_thread(
+            bot_client,
+            room_id,
+            event_id,
+            "SYSTEM: No messages to summarize."
+        )
+        typing_task.cancel()
+        return
 
-    # If no rows or error, fallback to simpler approach
-    if rows is None:
+    if pages is None:
         # Possibly fallback to a default “last 50 messages”
         fallback_sql = "SELECT * FROM bot_messages ORDER BY timestamp DESC LIMIT 50"
-        rows = await _execute_query(fallback_sql)
-        if not rows:
+        pages = await _execute_query(fallback_sql)
+        if not pages:
             # Then we have absolutely no data; can post a final note
             await _post_in_thread(
                 bot_client,
@@ -103,29 +133,16 @@ async def run_summarize_pipeline(
                 event_id,
                 "SYSTEM: No messages to summarize (or query error)."
             )
+            typing_task.cancel()
             return
 
-    # 5) GPT #2 => Summarizer with error handling
+    # 5) GPT #2 => Summarizer with error handling. Each GPT call covers at most
+    #    one page of rows, so the context length is bounded by the chunking.
     try:
-        summary_text = await _gpt_summarizer(rows, user_prompt_str)
+        summary_text = await _gpt_summarizer(pages, user_prompt_str)
     except Exception as e:
-        # Check if it's specifically a 'context_length_exceeded' or large context error
-        if "context_length_exceeded" in str(e) or "maximum context length" in str(e):
-            logger.warning("[SummarizePipeline] Summarizer exceeded context length. Retrying with fewer rows.")
-            # For simplicity, let’s just cut the rows in half; you can do more advanced chunking if desired.
-            half_len = len(rows) // 2
-            rows_subset = rows[:half_len]
-
-            # Attempt a second summarizer call with fewer rows
-            try:
-                summary_text = await _gpt_summarizer(rows_subset, user_prompt_str)
-            except Exception as second_e:
-                logger.exception("[SummarizePipeline] Second attempt also failed =>")
-                summary_text = f"SYSTEM: Summarization failed again. Error => {second_e}"
-        else:
-            # Some other error that is not related to context length
-            logger.exception("[SummarizePipeline] Summarizer error =>")
-            summary_text = f"SYSTEM: Summarization failed. Error => {e}"
+        logger.exception("[SummarizePipeline] Summarizer error =>")
+        summary_text = f"SYSTEM: Summarization failed. Error => {e}"
 
     # 6) Post final summary in the same thread
     if not summary_text.strip():
@@ -157,7 +174,7 @@ async def _gpt_query_builder(user_prompt: str, room_id) -> str:
     On failure or exception, returns an empty string.
     """
     # 1) Load instructions from config.yaml
-    cfg = load_config()
+    cfg = get_cached_config()
     qb_instructions = cfg.get("summarize_flow", {}).get("query_builder_instructions", "")
     if not qb_instructions:
         qb_instructions = (
@@ -170,13 +187,15 @@ async def _gpt_query_builder(user_prompt: str, room_id) -> str:
     # 2) Build the system + user messages
     system_prompt = qb_instructions
 
+    # Fixed text first, request- and room-specific text last, so repeated
+    # calls share a cacheable prompt prefix.
     user_content = (
-        f"User's request: {user_prompt}\n\n"
-        f"The relevant room is '#{room_id}:localhost'. If the user wants to filter to this room, "
-        f"remember to use: WHERE room_id = '{room_id}'.\n\n"
         "Note: There is a supervisor bot named 'Luna' in this channel. "
         "The user may want to exclude these messages or handle them specially.\n\n"
-        "Please respond with a valid JSON object per the system's instructions."
+        "Please respond with a valid JSON object per the system's instructions.\n\n"
+        f"The relevant room is '#{room_id}:localhost'. If the user wants to filter to this room, "
+        f"remember to use: WHERE room_id = '{room_id}'.\n\n"
+        f"User's request: {user_prompt}"
     )
 
     messages = [
@@ -186,7 +205,7 @@ async def _gpt_query_builder(user_prompt: str, room_id) -> str:
 
     # 3) Call GPT
     try:
-        resp_text = await get_gpt_response(
+        resp_text = await cached_gpt(
             messages=messages,
             temperature=0.7,
             model="gpt-4o"
@@ -199,77 +218,144 @@ async def _gpt_query_builder(user_prompt: str, room_id) -> str:
 # ----------------------------------------------------------------
 # Execute the SQL query
 # ----------------------------------------------------------------
-async def _execute_query(sql_str: str) -> Optional[list]:
+def _get_read_conn() -> sqlite3.Connection:
+    global _read_conn
+    with _read_conn_lock:
+        if _read_conn is None:
+            uri = "file:" + pathname2url(os.path.abspath(BOT_MESSAGES_DB)) + "?mode=ro"
+            # Queries are run and paged from asyncio.to_thread workers.
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            # The user might have done a custom SELECT, so rows are looked up by
+            # column name rather than position.
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+            conn.execute("PRAGMA cache_size=-65536")    # 64 MiB
+            _read_conn = conn
+        return _read_conn
+
+
+async def _execute_query(sql_str: str, page_size: int = _CHUNK_ROWS) -> Optional[Union[AsyncIterator[list], list]]:
     """
-    Runs the given SQL SELECT against the 'bot_messages.db' file, 
-    returning a list of rows as dicts. If an error occurs, returns None.
+    Runs the given SQL SELECT against the 'bot_messages.db' file and returns
+    an async iterator over pages of up to `page_size` sqlite3.Row objects
+    (mapping access by column name, no per-row dict built). Pages are fetched
+    with fetchmany on a worker thread only as the consumer asks for them, so
+    the whole result never sits in memory at once.
+    If the query matches no rows, returns an empty list; if it fails (or is
+    not a SELECT), returns None so the caller can fall back.
     """
-    import sqlite3
     if not sql_str.strip().upper().startswith("SELECT"):
         logger.warning("[_execute_query] Non-SELECT or empty SQL => fallback needed.")
         return None
 
-    try:
-        conn = sqlite3.connect(BOT_MESSAGES_DB)
-        c = conn.cursor()
-        rows = c.execute(sql_str).fetchall()
-        # We assume the columns are in order:
-        #   id, bot_localpart, room_id, event_id, sender, timestamp, body
-        # But the user might have done custom SELECT. So we do a quick approach:
-        columns = [desc[0] for desc in c.description]
-        results = []
-        for raw_row in rows:
-            row_dict = {}
-            for col, val in zip(columns, raw_row):
-                row_dict[col] = val
-            results.append(row_dict)
-
-        conn.close()
-        logger.debug(f"Query returned {len(results)} rows. First row => {results[0] if results else 'N/A'}")
-        return results
+    def _open():
+        cursor = _get_read_conn().execute(sql_str)
+        try:
+            return cursor, cursor.fetchmany(page_size)
+        except Exception:
+            cursor.close()
+            raise
 
+    try:
+        cursor, first_page = await asyncio.to_thread(_open)
     except Exception as e:
         logger.warning(f"Error executing user query => {e}")
         return None
 
+    if not first_page:
+        cursor.close()
+        logger.debug("Query returned 0 rows.")
+        return []
 
-async def _gpt_summarizer(rows: list, user_prompt: str) -> str:
+    logger.debug(f"Query returned rows. First row => {dict(first_page[0])}")
+    return _iter_pages(cursor, first_page, page_size)
+
+
+async def _iter_pages(cursor, page: list, page_size: int) -> AsyncIterator[list]:
     """
-    Takes the DB result rows (list of dicts) and calls GPT to produce a final summary.
-    Automatically chunks the logs if there are too many, creating partial summaries,
-    then merges them into one final summary pass to keep token usage manageable.
+    Yields `page`, then further fetchmany pages from `cursor` until the result
+    is exhausted. Closes the cursor when done or abandoned.
     """
-    from math import ceil
+    total = 0
+    try:
+        while page:
+            total += len(page)
+            yield page
+            if len(page) < page_size:
+                break
+            page = await asyncio.to_thread(cursor.fetchmany, page_size)
+        logger.debug(f"Query streamed {total} rows.")
+    finally:
+        cursor.close()
+
+
+async def _next_page(pages: AsyncIterator[list]) -> Optional[list]:
+    try:
+        return await pages.__anext__()
+    except StopAsyncIteration:
+        return None
 
-    cfg = load_config()
+
+async def _gpt_summarizer(pages: AsyncIterator[list], user_prompt: str) -> str:
+    """
+    Takes the DB result as pages of rows (see _execute_query) and calls GPT to
+    produce a final summary. A single page is summarized in one pass; with more,
+    each page is summarized as a partial summary as soon as it has been read
+    (while later pages are still coming from the DB), then the partials are
+    merged into one final summary pass to keep token usage manageable.
+    """
+    cfg = get_cached_config()
     sum_instructions = cfg.get("summarize_flow", {}).get("summarizer_instructions", "")
     if not sum_instructions:
         sum_instructions = (
             "You are a Summarizer AI. Produce a coherent summary from the user's instructions and logs."
         )
 
-    # Decide on a chunk size. Adjust as needed.
-    chunk_size = 50
+    first_page = await _next_page(pages)
+    if first_page is None:
+        return ""
+    second_page = await _next_page(pages)
 
     # ----------------------------------------------------------------
     # If rows fit comfortably in one chunk, just do a single pass
     # ----------------------------------------------------------------
-    if len(rows) <= chunk_size:
-        return await _summarize_chunk(rows, user_prompt, sum_instructions)
+    if second_page is None:
+        return await _summarize_chunk(first_page, user_prompt, sum_instructions)
 
     # ----------------------------------------------------------------
-    # Otherwise, chunk the rows and summarize each chunk
+    # Otherwise, summarize each page as a chunk, concurrently
     # ----------------------------------------------------------------
-    partial_summaries = []
-    total_chunks = ceil(len(rows) / chunk_size)
+    # Each chunk is one independent GPT round trip, so run several at once;
+    # the cap keeps a huge room from tripping OpenAI's rate limits.
+    max_concurrency = int(cfg.get("summarize_flow", {}).get("max_concurrency", 5))
+    chunk_slots = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def _bounded_chunk(chunk, chunk_index):
+        async with chunk_slots:
+            return await _summarize_chunk(
+                chunk, user_prompt, sum_instructions,
+                is_partial=True, chunk_index=chunk_index
+            )
 
-    logger.info(f"[_gpt_summarizer] Splitting {len(rows)} rows into {total_chunks} chunks of size {chunk_size}.")
+    tasks = [
+        asyncio.create_task(_bounded_chunk(first_page, 1)),
+        asyncio.create_task(_bounded_chunk(second_page, 2)),
+    ]
+    row_count = len(first_page) + len(second_page)
+    try:
+        async for page in pages:
+            row_count += len(page)
+            tasks.append(asyncio.create_task(_bounded_chunk(page, len(tasks) + 1)))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await pages.aclose()
+        raise
+
+    logger.info(f"[_gpt_summarizer] Split {row_count} rows into {len(tasks)} chunks of up to {_CHUNK_ROWS} (up to {max_concurrency} at once).")
 
-    for i in range(0, len(rows), chunk_size):
-        chunk = rows[i : i + chunk_size]
-        # Summarize this chunk
-        chunk_summary = await _summarize_chunk(chunk, user_prompt, sum_instructions, is_partial=True, chunk_index=(i // chunk_size) + 1)
-        partial_summaries.append(chunk_summary)
+    # gather keeps the input order, so partial summaries stay chronological
+    partial_summaries = await asyncio.gather(*tasks)
 
     # ----------------------------------------------------------------
     # If there's only 1 partial summary for some reason, return it
@@ -301,7 +387,7 @@ async def _gpt_summarizer(rows: list, user_prompt: str) -> str:
     ]
 
     try:
-        final_summary = await get_gpt_response(
+        final_summary = await cached_gpt(
             messages=messages,
             temperature=0.7,
             max_tokens=2000
@@ -316,36 +402,45 @@ async def _summarize_chunk(rows_chunk: list, user_prompt: str, sum_instructions:
     """
     Summarizes a single chunk of conversation logs with GPT.
     If is_partial=True, we'll label it a partial summary (helpful for logging).
+
+    The system prompt is sent verbatim and everything chunk-specific goes at
+    the end of the user message, so all chunk calls of one run share the same
+    leading tokens and OpenAI's automatic prompt caching can reuse them.
     """
-    # Convert rows into text lines
-    lines = []
-    for r in rows_chunk:
-        sender = str(r.get("sender", "unknown"))
-        body = str(r.get("body", ""))
-        lines.append(f"{sender}: {body}")
-    logs_text = "\n".join(lines)
-
-    # Build system & user messages
-    # If partial, you can tweak instructions for a more concise summary:
-    system_text = sum_instructions
+    # Convert rows into text lines. The SELECT was written by GPT, so sender
+    # or body may be missing from the columns (or NULL in a row).
+    columns = rows_chunk[0].keys() if rows_chunk else ()
+    has_sender = "sender" in columns
+    has_body = "body" in columns
+    logs_text = "\n".join(
+        f"{(r['sender'] or '') if has_sender else 'unknown'}: {(r['body'] or '') if has_body else ''}"
+        for r in rows_chunk
+    )
+
+    # Build system & user messages: stable text first, chunk-specific text last.
+    # If partial, ask for a more concise summary (in the user turn, so the
+    # system prompt stays identical across chunks):
+    partial_note = ""
     if is_partial:
-        system_text += (
-            "\n\nReturn a concise partial summary. We'll combine it with other chunks later."
+        partial_note = (
+            f"(This is partial chunk #{chunk_index}; return a concise "
+            "partial summary. We'll combine it with other chunks later.)\n"
         )
 
     user_text = (
-        f"Below are {len(rows_chunk)} logs from conversation.\n"
         f"User's summary instructions: {user_prompt}\n\n"
+        f"{partial_note}"
+        f"Below are {len(rows_chunk)} logs from conversation.\n"
         f"Conversation logs:\n{logs_text}"
     )
 
     messages = [
-        {"role": "system", "content": system_text},
+        {"role": "system", "content": sum_instructions},
         {"role": "user",   "content": user_text},
     ]
 
     try:
-        summary = await get_gpt_response(
+        summary = await cached_gpt(
             messages=messages,
             temperature=0.7,
             max_tokens=2000
@@ -28,13 +28,16 @@ import bleach
 import asyncio
 import json
 import time
-import requests
 import logging
 import json
 import time
 import html
 import aiohttp
 import re
+try:
+    import orjson as _json  # faster parse for GPT's JSON replies
+except ImportError:
+    _json = json
 from typing_extensions import TypedDict
 from typing import Annotated, Dict, List
 
@@ -46,8 +49,14 @@ from nio import AsyncClient, RoomMessageText, RoomSendResponse, RoomCreateRespon
 from langchain.schema import AIMessage, HumanMessage
 from langchain_openai import ChatOpenAI
 
-from luna.ai_functions import get_gpt_response
+from luna.ai_functions import get_gpt_response, generate_image
 from luna.luna_command_extensions.create_and_login_bot import create_and_login_bot
+from luna.luna_command_extensions.image_helpers import (
+    get_http_session,
+    download_to_file,
+    direct_upload_image,
+    ensure_images_dir,
+)
 from luna.luna_personas import update_bot
 import luna.GLOBALS as g
 
@@ -194,6 +203,11 @@ def build_router_graph():
                     "type": "string",
                     "desc": "A textual descriptor for the persona to be generated.",
                     "required": True
+                },
+                "fresh": {
+                    "type": "boolean",
+                    "desc": "Optional. True to ignore persona JSON cached from an earlier failed spawn of the same descriptor.",
+                    "required": False
                 }
             }
         }        
@@ -251,10 +265,24 @@ def build_router_graph():
     graph = builder.compile()
     return graph
 
+# Explicit "!command" prefixes that map straight to a node, skipping the GPT
+# routing call. draw_node parses its own prompt out of "!draw ...".
+_FAST_ROUTES = {
+    "draw": "draw_node",
+    "help": "help_node",
+}
+
 def gpt_router_node(state: dict) -> dict:
     """Uses GPT to determine the next node dynamically."""
     user_text = state["messages"][-1].content.strip()
 
+    if user_text.startswith("!"):
+        command_name, _, _ = user_text[1:].partition(" ")
+        fast_node = _FAST_ROUTES.get(command_name.lower())
+        if fast_node:
+            g.LOGGER.info(f"Routing to: {fast_node} (explicit !{command_name})")
+            return {"__next_node__": fast_node}
+
     router_prompt_template = g.CONFIG["router_prompt"]
     planner_node_list_str = _list_nodes_by_scope("planner")
     router_node_list_str = _list_nodes_by_scope("router")
@@ -361,7 +389,7 @@ async def help_node(state: RouterState) -> dict:
     # Append to the top-level messages
     updated_messages = state["messages"] + [help_ai_msg]
 
-    g.LOGGER.info(f"help_node: updated_messages => {updated_messages!r}")
+    g.LOGGER.debug("help_node: updated_messages => %r", updated_messages)
 
     # Return them as top-level "messages"
     return {
@@ -369,6 +397,10 @@ async def help_node(state: RouterState) -> dict:
         "__next_node__": END
     }
 
+# "draw <prompt>" / "!draw <prompt>" (a bare "draw" gives an empty prompt);
+# requires whitespace after the keyword so e.g. "drawing ..." isn't split.
+_DRAW_RE = re.compile(r"!?draw(?:\s+(.+))?\s*$", re.IGNORECASE | re.DOTALL)
+
 async def draw_node(state: RouterState) -> dict:
     """
     A node that:
@@ -394,7 +426,7 @@ async def draw_node(state: RouterState) -> dict:
     import luna.GLOBALS as g
     from langchain.schema import AIMessage
     from langgraph.graph import END
-    import os, time, requests
+    import os, time
     import asyncio
 
     g.LOGGER.info("draw_node: Invoked.")
@@ -406,8 +438,9 @@ async def draw_node(state: RouterState) -> dict:
         msgs = state.get("messages", [])
         if msgs and hasattr(msgs[-1], "content"):
             raw_text = msgs[-1].content.strip()
-            if raw_text.lower().startswith("draw"):
-                user_prompt = raw_text[4:].strip()
+            draw_match = _DRAW_RE.match(raw_text)
+            if draw_match:
+                user_prompt = (draw_match.group(1) or "").strip()
             else:
                 user_prompt = raw_text
         else:
@@ -437,10 +470,16 @@ async def draw_node(state: RouterState) -> dict:
     g.LOGGER.info(f"draw_node: calling DALL·E with prompt='{user_prompt}', size={size}")
 
     # 3) Call the DALL·E endpoint
+    session = get_http_session()
     try:
-        resp = requests.post(dall_e_url, headers=headers, json=data, timeout=90)
-        resp.raise_for_status()
-        response_data = resp.json()
+        async with session.post(
+            dall_e_url,
+            headers=headers,
+            json=data,
+            timeout=aiohttp.ClientTimeout(total=90),
+        ) as resp:
+            resp.raise_for_status()
+            response_data = await resp.json()
         image_url = response_data["data"][0]["url"]
     except Exception as e:
         g.LOGGER.exception("draw_node: Error generating image => %s", e)
@@ -453,14 +492,11 @@ async def draw_node(state: RouterState) -> dict:
 
     # 4) Download the image locally
     try:
-        os.makedirs("data/images", exist_ok=True)
+        await ensure_images_dir()
         timestamp = int(time.time())
         filename = f"data/images/dalle_{timestamp}.jpg"
 
-        dl_resp = requests.get(image_url, timeout=30)
-        dl_resp.raise_for_status()
-        with open(filename, "wb") as f:
-            f.write(dl_resp.content)
+        file_size = await download_to_file(image_url, filename, timeout=30)
 
         g.LOGGER.info(f"draw_node: image saved to {filename}")
     except Exception as e:
@@ -481,7 +517,7 @@ async def draw_node(state: RouterState) -> dict:
         g.LOGGER.warning("draw_node: missing client or room_id => skipping Matrix upload. (still returning image URL.)")
     else:
         try:
-            mxc_uri = await _direct_upload_image(client, filename, "image/jpeg")
+            mxc_uri = await direct_upload_image(client, filename, "image/jpeg")
             g.LOGGER.info(f"draw_node: direct_upload_image => {mxc_uri}")
         except Exception as e:
             g.LOGGER.exception(f"draw_node: Error uploading image to Matrix => {e}")
@@ -490,7 +526,6 @@ async def draw_node(state: RouterState) -> dict:
     if mxc_uri:
         final_text = f"Here is your image for prompt '{user_prompt}', uploaded to room => {mxc_uri}"
 
-        file_size = os.path.getsize(filename)
         matrix_msg_content = {
             "msgtype": "m.image",
             "body": os.path.basename(filename),
@@ -693,11 +728,8 @@ async def create_room3_node(state: Dict) -> Dict:
             g.LOGGER.info(f"Received image_url: {image_url}")
 
             filename = f"data/images/room_avatar_{int(time.time())}.jpg"
-            os.makedirs("data/images", exist_ok=True)
-            dl_resp = requests.get(image_url)
-            dl_resp.raise_for_status()
-            with open(filename, "wb") as f:
-                f.write(dl_resp.content)
+            await ensure_images_dir()
+            await download_to_file(image_url, filename)
 
             mxc_url = await direct_upload_image(bot_client, filename, "image/jpeg")
             await bot_client.room_put_state(
@@ -812,7 +844,7 @@ async def chatbot_node(state: RouterState) -> dict:
     g.LOGGER.info(f"chatbot_node: response_msg => {response_msg!r}")
 
     updated_messages = state["messages"] + [response_msg]
-    g.LOGGER.info(f"chatbot_node: updated_messages => {updated_messages!r}")
+    g.LOGGER.debug("chatbot_node: updated_messages => %r", updated_messages)
     g.LOGGER.info(f"chatbot_node: Exiting with updated messages, next => END")
 
     return {
@@ -949,7 +981,7 @@ def planner_node(state: RouterState) -> dict:
 
     # 4) Parse the JSON from GPT
     try:
-        plan_list = json.loads(response.content)
+        plan_list = _json.loads(response.content)
         if not isinstance(plan_list, list):
             raise ValueError("Planner output not a list.")
         g.LOGGER.info("planner_node: successfully parsed plan_list => %s", plan_list)
@@ -1098,13 +1130,25 @@ async def handle_luna_message(client: AsyncClient, localpart: str, room, event):
         g.LOGGER.info(f"Skipping duplicate event {event.event_id}")
         return  
 
-    g.PROCESSED_EVENTS.add(event.event_id)  
+    g.PROCESSED_EVENTS[event.event_id] = None
+    if len(g.PROCESSED_EVENTS) > g.PROCESSED_EVENTS_MAX:
+        g.PROCESSED_EVENTS.popitem(last=False)
     g.LOGGER.info(f"Adding {event.event_id} to PROCESSED_EVENTS")
     g.LOGGER.info("user_text => %r", user_text)
 
-    # Start typing indicator
-    await _start_typing(client, room.room_id)
+    # Keep the typing indicator alive in the background (graph runs such as
+    # draw can outlast a single typing timeout); cancelled once we're done.
+    typing_task = asyncio.create_task(_keep_typing(client, room.room_id, refresh_interval=20))
+    try:
+        await _run_graph_and_reply(client, room, event, user_text)
+    finally:
+        typing_task.cancel()
+        await asyncio.gather(typing_task, return_exceptions=True)
 
+async def _run_graph_and_reply(client: AsyncClient, room, event, user_text: str):
+    """
+    Runs the router graph for one user message and posts the final reply.
+    """
     # Log 
     g.LOGGER.debug(
         "handle_luna_message: Building initial state:\n%s",
@@ -1136,11 +1180,11 @@ async def handle_luna_message(client: AsyncClient, localpart: str, room, event):
 
     # Stream graph execution and log each step
     async for partial_state in g.ROUTER_GRAPH.astream(state):
-        g.LOGGER.info(f"next_state => {partial_state!r}")
+        g.LOGGER.debug("next_state => %r", partial_state)
         final_state = partial_state
 
     # After we've streamed the graph to final_state...
-    g.LOGGER.info(f"final_state => {final_state!r}")
+    g.LOGGER.debug("final_state => %r", final_state)
 
     if "macro_node" in final_state:
         g.LOGGER.info("Ending on macro_node, generating final summary with GPT.")
@@ -1176,12 +1220,6 @@ async def handle_luna_message(client: AsyncClient, localpart: str, room, event):
 
         except Exception as e:
             g.LOGGER.exception(f"Error sending message => {e}")
-        finally:
-            await _stop_typing(client, room.room_id)
-
-        # Ensure the processed events set doesn't grow infinitely
-        if len(g.PROCESSED_EVENTS) > 10000:
-            g.PROCESSED_EVENTS.clear()
 
     else:
     # 1) Attempt to read top-level "messages" first
@@ -1215,12 +1253,6 @@ async def handle_luna_message(client: AsyncClient, localpart: str, room, event):
             )
         except Exception as e:
             g.LOGGER.exception(f"Error sending message => {e}")
-        finally:
-            await _stop_typing(client, room.room_id)
-
-        # Ensure the processed events set doesn't grow infinitely
-        if len(g.PROCESSED_EVENTS) > 10000:  
-            g.PROCESSED_EVENTS.clear()
 
 def _convert_markdown_to_html(md_text: str) -> str:
     # 1) Convert to HTML with the official extensions you want
@@ -1308,51 +1340,6 @@ async def _stop_typing(bot_client: AsyncClient, room_id: str):
     except Exception as e:
         g.LOGGER.warning("Could not send typing stop => %s", e)
 
-async def _direct_upload_image(
-    client: AsyncClient,
-    file_path: str,
-    content_type: str = "image/jpeg"
-) -> str:
-    """
-    Manually upload a file to Synapse's media repository, explicitly setting
-    Content-Length (avoiding chunked requests).
-    
-    Returns the mxc:// URI if successful, or raises an exception on failure.
-    """
-    if not client.access_token or not client.homeserver:
-        raise RuntimeError("AsyncClient has no access_token or homeserver set.")
-
-    base_url = client.homeserver.rstrip("/")
-    filename = os.path.basename(file_path)
-    encoded_name = urllib.parse.quote(filename)
-    upload_url = f"{base_url}/_matrix/media/v3/upload?filename={encoded_name}"
-
-    file_size = os.path.getsize(file_path)
-    headers = {
-        "Authorization": f"Bearer {client.access_token}",
-        "Content-Type": content_type,
-        "Content-Length": str(file_size),
-    }
-
-    g.LOGGER.debug("[direct_upload_image] POST to %s, size=%d", upload_url, file_size)
-
-    async with aiohttp.ClientSession() as session:
-        with open(file_path, "rb") as f:
-            async with session.post(upload_url, headers=headers, data=f) as resp:
-                if resp.status == 200:
-                    body = await resp.json()
-                    content_uri = body.get("content_uri")
-                    if not content_uri:
-                        raise RuntimeError("No 'content_uri' in response JSON.")
-                    g.LOGGER.debug("[direct_upload_image] Uploaded. content_uri=%s", content_uri)
-                    return content_uri
-                else:
-                    err_text = await resp.text()
-                    raise RuntimeError(
-                        f"Upload failed (HTTP {resp.status}): {err_text}"
-                    )
-
-
 async def _post_in_thread(
     bot_client: AsyncClient,
     room_id: str,
@@ -1405,11 +1392,15 @@ async def _post_in_thread(
         g.LOGGER.exception(f"[command_helpers] Error posting in-thread => {e}")
 
 
+_HTML_TAG_RE = re.compile(r"<[^>]*>")
+
 def _strip_html_tags(text: str) -> str:
     """
     Removes all HTML tags from the given text string.
     """
-    return re.sub(r"<[^>]*>", "", text or "").strip()
+    if not text or "<" not in text:
+        return (text or "").strip()
+    return _HTML_TAG_RE.sub("", text).strip()
 
 
 async def _keep_typing(bot_client: AsyncClient, room_id: str, refresh_interval=3):
@@ -1461,100 +1452,10 @@ async def _set_power_level(bot_client: AsyncClient, room_id: str, user_id: str,
     except Exception as e:
         g.LOGGER.warning(f"Could not set power level {power} for {user_id} in {room_id} => {e}")
 
-async def direct_upload_image(
-    client: AsyncClient,
-    file_path: str,
-    content_type: str = "image/jpeg"
-) -> str:
-    """
-    Manually upload a file to Synapse's media repository, explicitly setting
-    Content-Length (avoiding chunked requests).
-    
-    Returns the mxc:// URI if successful, or raises an exception on failure.
-    """
-    if not client.access_token or not client.homeserver:
-        raise RuntimeError("AsyncClient has no access_token or homeserver set.")
-
-    base_url = client.homeserver.rstrip("/")
-    filename = os.path.basename(file_path)
-    encoded_name = urllib.parse.quote(filename)
-    upload_url = f"{base_url}/_matrix/media/v3/upload?filename={encoded_name}"
-
-    file_size = os.path.getsize(file_path)
-    headers = {
-        "Authorization": f"Bearer {client.access_token}",
-        "Content-Type": content_type,
-        "Content-Length": str(file_size),
-    }
-
-    g.LOGGER.info("[direct_upload_image] POST to %s, size=%d", upload_url, file_size)
-
-    async with aiohttp.ClientSession() as session:
-        with open(file_path, "rb") as f:
-            async with session.post(upload_url, headers=headers, data=f) as resp:
-                if resp.status == 200:
-                    body = await resp.json()
-                    content_uri = body.get("content_uri")
-                    if not content_uri:
-                        raise RuntimeError("No 'content_uri' in response JSON.")
-                    g.LOGGER.info("[direct_upload_image] Uploaded. content_uri=%s", content_uri)
-                    return content_uri
-                else:
-                    err_text = await resp.text()
-                    raise RuntimeError(
-                        f"Upload failed (HTTP {resp.status}): {err_text}"
-                    )
-
-async def generate_image(prompt: str, size: str = "1024x1024") -> str:
-    """
-    Generates an image using OpenAI's API and returns the URL of the generated image.
-    """
-    # -----------------------------------------------------------------
-    # 1) Merge the global style with the user's prompt
-    # -----------------------------------------------------------------
-    from luna.luna_command_extensions.command_router import GLOBAL_PARAMS
-    style = GLOBAL_PARAMS.get("global_draw_prompt_appendix", "").strip()
-    if style:
-        final_prompt = f"{prompt.strip()}. {style}"
-    else:
-        final_prompt = prompt.strip()
-
-    try:
-        url = "https://api.openai.com/v1/images/generations"
-        headers = {
-            "Authorization": f"Bearer {g.OPENAI_API_KEY}",
-            "Content-Type": "application/json",
-        }
-        data = {
-            "model": "dall-e-3",
-            "prompt": final_prompt,
-            "n": 1,
-            "size": size,
-        }
-
-        g.LOGGER.debug("Sending request to OpenAI: %s", data)
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        image_url = response.json()["data"][0]["url"]
-        g.LOGGER.info("Generated image URL: %s", image_url)
-        return image_url
-    except Exception as e:
-        g.LOGGER.exception("Failed to generate image.")
-        raise e
-
 import logging
-import json
-import time
-import os
-import html
-import requests
 
-from luna.ai_functions import get_gpt_response, generate_image
-from luna.luna_command_extensions.create_and_login_bot import create_and_login_bot
-from luna.luna_personas import update_bot
-from luna.luna_functions import getClient
-from luna.luna_command_extensions.image_helpers import direct_upload_image
 from luna.luna_command_extensions.command_helpers import _post_in_thread
+from luna.luna_command_extensions.spawn_persona import spawn_persona
 
 import luna.GLOBALS as g
 
@@ -1563,22 +1464,18 @@ logger = logging.getLogger(__name__)
 async def spawn_persona_node(state: dict) -> dict:
     """
     Node that creates a new persona (character) from a provided descriptor and posts
-    both the portrait (if generated) and a complete character card in-thread.
+    its character card (portrait included, if one was generated) in-thread.
 
     Expects in state:
       - descriptor: str, a text description for the persona.
       - room_id: (optional) str, the room where the command was invoked.
       - parent_event_id: (optional) str, the event ID for threading replies.
       - bot_client: (optional) the client to use for posting; defaults to g.LUNA_CLIENT.
+      - fresh: (optional) bool, True to skip cached persona JSON and ask GPT anew.
+
+    The spawn itself (persona JSON, registration, portrait, card) is
+    spawn_persona.spawn_persona, the same code path as the !spawn command.
 
-    The node will:
-      1) Call GPT to generate a persona JSON.
-      2) Parse the JSON and validate required fields.
-      3) Create and log in the new persona via create_and_login_bot.
-      4) Optionally generate and upload a portrait.
-      5) Build an HTML character card with persona details.
-      6) Post the portrait (if available) and the character card in thread.
-    
     Returns state updated with:
       - html: str, the final persona card HTML.
       - bot_id: str, the normalized bot ID.
@@ -1596,131 +1493,31 @@ async def spawn_persona_node(state: dict) -> dict:
     # Get the posting client (fallback to global client)
     bot_client = state.get("bot_client") or g.LUNA_CLIENT
 
-    # 2) Build GPT messages to generate persona JSON.
-    system_instructions = (
-        "You are an assistant that outputs ONLY valid JSON. "
-        "No markdown, no code fences, no extra commentary. "
-        "Generate a persona object which must have keys: localpart, displayname, biography, backstory, "
-        "system_prompt, password, traits. No other keys. "
-        "The 'traits' key is a JSON object with arbitrary key/values. "
-        "Be sure that the system prompt instructs the bot to behave in character."
-    )
-    user_message = (
-        f"Create a persona based on:\n{descriptor}\n\n"
-        "Return ONLY valid JSON with required keys."
-    )
-    messages = [
-        {"role": "system", "content": system_instructions},
-        {"role": "user", "content": user_message},
-    ]
-    logger.info("Requesting persona JSON from GPT with descriptor: %s", descriptor)
-    try:
-        gpt_response = await get_gpt_response(
-            messages=messages,
-            model="gpt-4",
-            temperature=0.7,
-            max_tokens=5000
-        )
-    except Exception as e:
-        logger.exception("GPT error in spawn_persona_node")
-        return {"error": f"GPT error: {e}", "__next_node__": "chatbot_node"}
-
-    # 3) Parse persona JSON and check for required fields.
+    # 2) Spawn the persona
     try:
-        persona_data = json.loads(gpt_response)
-    except json.JSONDecodeError as e:
-        logger.exception("JSON parse error in spawn_persona_node")
-        return {"error": f"Invalid JSON from GPT: {e}", "__next_node__": "chatbot_node"}
-
-    required_keys = ["localpart", "password", "displayname", "system_prompt", "traits"]
-    missing = [key for key in required_keys if key not in persona_data]
-    if missing:
-        err = f"Persona missing required fields: {missing}"
-        logger.error(err)
-        return {"error": err, "__next_node__": "chatbot_node"}
-
-    localpart     = persona_data["localpart"]
-    password      = persona_data["password"]
-    displayname   = persona_data["displayname"]
-    system_prompt = persona_data["system_prompt"]
-    traits        = persona_data.get("traits") or {}
-    biography     = persona_data.get("biography", "")
-    backstory     = persona_data.get("backstory", "")
-
-    # 4) Register & login the persona.
-    try:
-        bot_result = await create_and_login_bot(
-            bot_id=f"@{localpart}:localhost",
-            password=password,
-            displayname=displayname,
-            system_prompt=system_prompt,
-            traits=traits
-        )
+        result = await spawn_persona(descriptor, use_cache=not state.get("fresh", False))
     except Exception as e:
-        logger.exception("Error during create_and_login_bot in spawn_persona_node")
+        logger.exception("Error spawning persona in spawn_persona_node")
         return {"error": f"Persona creation failed: {e}", "__next_node__": "chatbot_node"}
 
-    if not bot_result.get("ok", False):
-        error_details = bot_result.get("error", "Unknown error")
-        err = f"Persona creation failed: {error_details}"
-        logger.error(err)
-        return {"error": err, "__next_node__": "chatbot_node"}
+    # spawn_persona returns a plain "SYSTEM: ..." string on GPT/JSON errors
+    if not isinstance(result, dict):
+        logger.error("spawn_persona_node => %s", result)
+        return {"error": str(result), "__next_node__": "chatbot_node"}
 
-    bot_id = bot_result.get("bot_id", "")
-    ephemeral_bot_client = bot_result.get("client")
-    # Normalize bot_id: remove '@' prefix and ':localhost' suffix.
-    if bot_id.startswith('@'):
-        bot_id = bot_id[1:]
-    if bot_id.endswith(':localhost'):
-        bot_id = bot_id[:-10]
-
-    # 5) Attempt to generate & upload a portrait using the descriptor as prompt.
-    final_prompt = descriptor  # EXACT prompt used
-    portrait_mxc = None
-    try:
-        portrait_url = await generate_image(final_prompt, size="1024x1024")
-        if portrait_url:
-            portrait_mxc = await _download_and_upload_portrait(
-                portrait_url,
-                localpart,
-                password,
-                system_prompt,
-                traits,
-                ephemeral_bot_client
-            )
-    except Exception as e:
-        logger.warning("Portrait generation/upload error: %s", e)
-
-    # 6) Build the final persona card HTML.
-    global_draw_appendix = g.GLOBAL_PARAMS.get("global_draw_prompt_appendix", "")
-    card_html = _build_persona_card(
-        localpart=localpart,
-        displayname=displayname,
-        biography=biography,
-        backstory=backstory,
-        system_prompt=system_prompt,
-        dall_e_prompt=final_prompt,
-        traits=traits,
-        portrait_mxc=portrait_mxc,
-        global_draw_appendix=global_draw_appendix
-    )
+    card_html = result["html"]
+    bot_id = result["bot_id"]
 
-    # 7) Post the portrait (if any) and the persona card in-thread.
+    # 3) Post the persona card in-thread.
     room_id = state.get("room_id")
     parent_event_id = state.get("parent_event_id", "")
     if room_id:
-        if portrait_mxc:
-            portrait_html = f"<p><strong>Portrait</strong></p><img src='{portrait_mxc}' alt='Portrait' width='300'/>"
-            try:
-                await _post_in_thread(bot_client, room_id, parent_event_id, portrait_html, is_html=True)
-            except Exception as e:
-                logger.warning("Error posting portrait in thread: %s", e)
         try:
             await _post_in_thread(bot_client, room_id, parent_event_id, card_html, is_html=True)
         except Exception as e:
             logger.warning("Error posting character card in thread: %s", e)
 
-    logger.info("Completed spawn_persona_node for persona %s", localpart)
+    logger.info("Completed spawn_persona_node for persona %s", bot_id)
     # Update state with the resulting HTML and bot ID, and set the next node.
     state.update({
         "html": card_html,
@@ -1728,665 +1525,3 @@ async def spawn_persona_node(state: dict) -> dict:
         "__next_node__": "chatbot_node"
     })
     return state
-
-# ----------------------------
-# Internal helper functions
-# ----------------------------
-
-async def _download_and_upload_portrait(
-    portrait_url: str,
-    localpart: str,
-    password: str,
-    system_prompt: str,
-    traits: dict,
-    ephemeral_bot_client
-) -> str:
-    """
-    Downloads the image from portrait_url, uploads it to Matrix,
-    updates the persona record, and sets the bot's avatar.
-    Returns the mxc:// URI or None on failure.
-    """
-    os.makedirs("data/images", exist_ok=True)
-    filename = f"data/images/portrait_{int(time.time())}.jpg"
-    dl_resp = requests.get(portrait_url)
-    dl_resp.raise_for_status()
-    with open(filename, "wb") as f:
-        f.write(dl_resp.content)
-
-    client = getClient()
-    if not client:
-        return None
-    portrait_mxc = await direct_upload_image(client, filename, "image/jpeg")
-    # Update persona record with portrait URL.
-    traits["portrait_url"] = portrait_mxc
-    update_bot(
-        f"@{localpart}:localhost",
-        {
-            "password": password,
-            "system_prompt": system_prompt,
-            "traits": traits
-        }
-    )
-    # Attempt to set the avatar on the ephemeral client.
-    if ephemeral_bot_client:
-        try:
-            await ephemeral_bot_client.set_avatar(portrait_mxc)
-        except Exception as e:
-            logger.warning("Error setting avatar: %s", e)
-    return portrait_mxc
-
-def _build_persona_card(
-    localpart: str,
-    displayname: str,
-    biography: str,
-    backstory: str,
-    system_prompt: str,
-    dall_e_prompt: str,
-    traits: dict,
-    portrait_mxc: str,
-    global_draw_appendix: str
-) -> str:
-    """
-    Builds and returns an HTML character card for the persona. The card includes:
-      - A title (localpart) and italicized displayname.
-      - An optional portrait.
-      - A table of details including biography, backstory, system prompt, DALL·E prompt,
-        draw prompt appendix, traits (as a nested table), and a version number.
-    """
-    def esc(text):
-        return html.escape(str(text))
-
-    # Build nested table for traits.
-    trait_rows = []
-    for k, v in traits.items():
-        trait_rows.append(
-            "<tr>"
-            f"<td style='padding:2px 6px;'><b>{esc(k)}</b></td>"
-            f"<td style='padding:2px 6px;'>{esc(v)}</td>"
-            "</tr>"
-        )
-    traits_subtable = (
-        "<table border='1' style='border-collapse:collapse; font-size:0.9em;'>"
-        "<thead><tr><th colspan='2'>Traits</th></tr></thead>"
-        f"<tbody>{''.join(trait_rows)}</tbody>"
-        "</table>"
-    )
-
-    def row(label, val):
-        return (
-            "<tr>"
-            f"<td style='padding:4px 8px; vertical-align:top;'><b>{esc(label)}</b></td>"
-            f"<td style='padding:4px 8px;'>{val}</td>"
-            "</tr>"
-        )
-
-    # Build portrait HTML if available.
-    portrait_html = ""
-    if portrait_mxc:
-        portrait_html = (
-            f"<div style='margin-bottom:8px;'>"
-            f"<img src='{esc(portrait_mxc)}' alt='Portrait' width='300'/>"
-            "</div>"
-        )
-
-    # Build rows for the main table.
-    table_rows = "".join([
-        row("Localpart", esc(localpart)),
-        row("DisplayName", esc(displayname)),
-        row("Biography", esc(biography)),
-        row("Backstory", esc(backstory)),
-        row("System Prompt", esc(system_prompt)),
-        row("DALL·E Prompt", esc(dall_e_prompt)),
-        row("Draw Prompt Appendix", esc(global_draw_appendix)),
-        row("Traits", traits_subtable),
-        row("Version", "1.0")
-    ])
-
-    table_html = (
-        "<table border='1' style='border-collapse:collapse;'>"
-        f"<tbody>{table_rows}</tbody>"
-        "</table>"
-    )
-
-    # Combine header, optional portrait, and table.
-    final_html = (
-        f"<h2 style='margin-bottom:2px;'>{esc(localpart)}</h2>"
-        f"<p style='margin-top:0; margin-bottom:10px;'><em>{esc(displayname)}</em></p>"
-        f"{portrait_html}"
-        f"{table_html}"
-        "<p><em>Persona creation complete!</em></p>"
-    )
-    return final_html
-
-async def spawn_persona_node_dep2(state: dict) -> dict:
-    """
-    Node that creates a new persona from a descriptor provided via JSON.
-    
-    Expects in state:
-      - descriptor: str, a textual description for the persona.
-      - room_id: str, the room where the command was invoked.
-      - parent_event_id: str, the event ID for threading.
-      - sender: str, the user's Matrix ID.
-    
-    The node will:
-      1) Call GPT to generate a persona JSON.
-      2) Parse the JSON and validate required fields.
-      3) Create and log in the new persona (bot) via create_and_login_bot.
-      4) Optionally generate and upload a portrait.
-      5) Build an HTML character card containing persona details.
-    
-    Returns state with additional keys:
-      - html: str, the final persona card HTML.
-      - bot_id: str, the normalized bot ID.
-      - __next_node__: str, e.g. "chatbot_node"
-    """
-    g.LOGGER.info("Entering spawn_persona_node...")
-    
-    # Retrieve required fields
-    descriptor = state.get("descriptor", "").strip()
-    room_id = state.get("room_id")
-    parent_event_id = state.get("parent_event_id", "")
-    sender = state.get("sender")
-    
-    # Use global bot client if not provided
-    bot_client = state.get("bot_client") or g.LUNA_CLIENT
-    if not bot_client:
-        err = "No bot client available."
-        g.LOGGER.error(err)
-        return {"error": err, "__next_node__": "chatbot_node"}
-
-    # Start keep-typing indicator (optional)
-    typing_task = asyncio.create_task(_keep_typing(bot_client, room_id))
-    
-    if not descriptor:
-        err = "Missing required 'descriptor' parameter."
-        g.LOGGER.error(err)
-        await _post_in_thread(
-            bot_client,
-            room_id,
-            parent_event_id,
-            f"<p><strong>Error:</strong> {err}</p>",
-            is_html=True
-        )
-        typing_task.cancel()
-        return {"error": err, "__next_node__": "chatbot_node"}
-
-    # Post initial status update
-    await _post_in_thread(
-        bot_client,
-        room_id,
-        parent_event_id,
-        "<p><strong>Starting persona creation...</strong></p>",
-        is_html=True
-    )
-
-    # Build GPT messages
-    system_instructions = (
-        "You are an assistant that outputs ONLY valid JSON. "
-        "No markdown, no code fences, no extra commentary. "
-        "Generate a persona object which must have keys: localpart, displayname, biography, backstory, "
-        "system_prompt, password, traits. No other keys. "
-        "The 'traits' key is a JSON object with arbitrary key/values. "
-        "Be sure that the system prompt instructs the bot to behave in character."
-    )
-    user_message = (
-        f"Create a persona based on:\n{descriptor}\n\n"
-        "Return ONLY valid JSON with required keys."
-    )
-    messages = [
-        {"role": "system", "content": system_instructions},
-        {"role": "user", "content": user_message},
-    ]
-
-    g.LOGGER.info("Requesting persona JSON from GPT with descriptor: %s", descriptor)
-    try:
-        gpt_response = await get_gpt_response(
-            messages=messages,
-            model="gpt-4",
-            temperature=0.7,
-            max_tokens=5000
-        )
-        await _post_in_thread(
-            bot_client,
-            room_id,
-            parent_event_id,
-            "<p>Received GPT response.</p>",
-            is_html=True
-        )
-    except Exception as e:
-        g.LOGGER.exception("GPT error in spawn_persona_node")
-        await _post_in_thread(
-            bot_client,
-            room_id,
-            parent_event_id,
-            f"<p><strong>Error:</strong> GPT error: {e}</p>",
-            is_html=True
-        )
-        typing_task.cancel()
-        return {"error": f"GPT error: {e}", "__next_node__": "chatbot_node"}
-
-    # Parse persona JSON
-    try:
-        persona_data = json.loads(gpt_response)
-    except json.JSONDecodeError as e:
-        g.LOGGER.exception("JSON parse error in spawn_persona_node")
-        await _post_in_thread(
-            bot_client,
-            room_id,
-            parent_event_id,
-            f"<p><strong>Error:</strong> Invalid JSON from GPT: {e}</p>",
-            is_html=True
-        )
-        typing_task.cancel()
-        return {"error": f"Invalid JSON from GPT: {e}", "__next_node__": "chatbot_node"}
-
-    required_keys = ["localpart", "password", "displayname", "system_prompt", "traits"]
-    missing = [key for key in required_keys if key not in persona_data]
-    if missing:
-        err = f"Persona missing required fields: {missing}"
-        g.LOGGER.error(err)
-        await _post_in_thread(
-            bot_client,
-            room_id,
-            parent_event_id,
-            f"<p><strong>Error:</strong> {err}</p>",
-            is_html=True
-        )
-        typing_task.cancel()
-        return {"error": err, "__next_node__": "chatbot_node"}
-
-    localpart     = persona_data["localpart"]
-    password      = persona_data["password"]
-    displayname   = persona_data["displayname"]
-    system_prompt = persona_data["system_prompt"]
-    traits        = persona_data.get("traits") or {}
-    biography     = persona_data.get("biography", "")
-    backstory     = persona_data.get("backstory", "")
-
-    await _post_in_thread(
-        bot_client,
-        room_id,
-        parent_event_id,
-        f"<p>Persona JSON received. Creating persona for '{localpart}'.</p>",
-        is_html=True
-    )
-
-    # Create and log in the persona
-    try:
-        bot_result = await create_and_login_bot(
-            bot_id=f"@{localpart}:localhost",
-            password=password,
-            displayname=displayname,
-            system_prompt=system_prompt,
-            traits=traits
-        )
-    except Exception as e:
-        g.LOGGER.exception("Error during create_and_login_bot in spawn_persona_node")
-        await _post_in_thread(
-            bot_client,
-            room_id,
-            parent_event_id,
-            f"<p><strong>Error:</strong> Persona creation failed: {e}</p>",
-            is_html=True
-        )
-        typing_task.cancel()
-        return {"error": f"Persona creation failed: {e}", "__next_node__": "chatbot_node"}
-
-    if not bot_result.get("ok", False):
-        error_details = bot_result.get("error", "Unknown error")
-        err = f"Persona creation failed: {error_details}"
-        g.LOGGER.error(err)
-        await _post_in_thread(
-            bot_client,
-            room_id,
-            parent_event_id,
-            f"<p><strong>Error:</strong> {err}</p>",
-            is_html=True
-        )
-        typing_task.cancel()
-        return {"error": err, "__next_node__": "chatbot_node"}
-
-    bot_id = bot_result.get("bot_id", "")
-    ephemeral_bot_client = bot_result.get("client")
-    if bot_id.startswith('@'):
-        bot_id = bot_id[1:]
-    if bot_id.endswith(':localhost'):
-        bot_id = bot_id[:-10]
-
-    await _post_in_thread(
-        bot_client,
-        room_id,
-        parent_event_id,
-        f"<p>Persona created successfully with bot ID: {bot_id}.</p>",
-        is_html=True
-    )
-
-    # Generate and upload a portrait
-    final_prompt = descriptor  
-    portrait_mxc = None
-    try:
-        portrait_url = await generate_image(final_prompt, size="1024x1024")
-        if portrait_url:
-            portrait_mxc = await _download_and_upload_portrait(
-                portrait_url,
-                localpart,
-                password,
-                system_prompt,
-                traits,
-                ephemeral_bot_client
-            )
-    except Exception as e:
-        g.LOGGER.warning("Portrait generation/upload error: %s", e)
-        await _post_in_thread(
-            bot_client,
-            room_id,
-            parent_event_id,
-            f"<p>Warning: Portrait generation/upload error: {e}</p>",
-            is_html=True
-        )
-
-    # Build the final persona card HTML
-    global_draw_appendix = g.GLOBAL_PARAMS.get("global_draw_prompt_appendix", "")
-    card_html = _build_persona_card(
-        localpart=localpart,
-        displayname=displayname,
-        biography=biography,
-        backstory=backstory,
-        system_prompt=system_prompt,
-        dall_e_prompt=final_prompt,   # EXACT prompt used
-        traits=traits,
-        portrait_mxc=portrait_mxc,
-        global_draw_appendix=global_draw_appendix 
-    )
-
-    await _post_in_thread(
-        bot_client,
-        room_id,
-        parent_event_id,
-        "<p>Persona creation complete!</p>",
-        is_html=True
-    )
-    
-    typing_task.cancel()
-    g.LOGGER.info("Completed spawn_persona_node for persona %s", localpart)
-    state.update({
-        "html": card_html,
-        "bot_id": bot_id,
-        "__next_node__": "chatbot_node"
-    })
-    return state
-
-async def spawn_persona_node_dep(state: dict) -> dict:
-    """
-    Node that creates a new persona from a descriptor provided via JSON.
-    
-    Expects in state:
-      - descriptor: str, a textual description for the persona.
-    
-    The node will:
-      1) Call GPT to generate a persona JSON.
-      2) Parse the JSON and validate required fields.
-      3) Create and log in the new persona (bot) via create_and_login_bot.
-      4) Optionally generate and upload a portrait.
-      5) Build an HTML character card containing persona details.
-    
-    Returns state with additional keys:
-      - html: str, the final persona card HTML.
-      - bot_id: str, the normalized bot ID.
-      - __next_node__: str, e.g. "chatbot_node"
-    """
-    g.LOGGER.info("Entering spawn_persona_node...")
-
-    # 1) Extract input from state
-    descriptor = state.get("descriptor", "").strip()
-    if not descriptor:
-        err = "Missing required 'descriptor' parameter."
-        g.LOGGER.error(err)
-        return {"error": err, "__next_node__": "chatbot_node"}
-
-    # Build GPT messages
-    system_instructions = (
-        "You are an assistant that outputs ONLY valid JSON. "
-        "No markdown, no code fences, no extra commentary. "
-        "Generate a persona object which must have keys: localpart, displayname, biography, backstory, "
-        "system_prompt, password, traits. No other keys. "
-        "The 'traits' key is a JSON object with arbitrary key/values. "
-        "Be sure that the system prompt instructs the bot to behave in character."
-    )
-    user_message = (
-        f"Create a persona based on:\n{descriptor}\n\n"
-        "Return ONLY valid JSON with required keys."
-    )
-    messages = [
-        {"role": "system", "content": system_instructions},
-        {"role": "user", "content": user_message},
-    ]
-
-    g.LOGGER.info("Requesting persona JSON from GPT with descriptor: %s", descriptor)
-    try:
-        gpt_response = await get_gpt_response(
-            messages=messages,
-            model="gpt-4",
-            temperature=0.7,
-            max_tokens=5000
-        )
-    except Exception as e:
-        g.LOGGER.exception("GPT error in spawn_persona_node")
-        return {"error": f"GPT error: {e}", "__next_node__": "chatbot_node"}
-
-    # 2) Parse persona JSON
-    try:
-        persona_data = json.loads(gpt_response)
-    except json.JSONDecodeError as e:
-        g.LOGGER.exception("JSON parse error in spawn_persona_node")
-        return {"error": f"Invalid JSON from GPT: {e}", "__next_node__": "chatbot_node"}
-
-    required_keys = ["localpart", "password", "displayname", "system_prompt", "traits"]
-    missing = [key for key in required_keys if key not in persona_data]
-    if missing:
-        err = f"Persona missing required fields: {missing}"
-        g.LOGGER.error(err)
-        return {"error": err, "__next_node__": "chatbot_node"}
-
-    localpart     = persona_data["localpart"]
-    password      = persona_data["password"]
-    displayname   = persona_data["displayname"]
-    system_prompt = persona_data["system_prompt"]
-    traits        = persona_data.get("traits") or {}
-    biography     = persona_data.get("biography", "")
-    backstory     = persona_data.get("backstory", "")
-
-    # 3) Register & login the persona
-    try:
-        bot_result = await create_and_login_bot(
-            bot_id=f"@{localpart}:localhost",
-            password=password,
-            displayname=displayname,
-            system_prompt=system_prompt,
-            traits=traits
-        )
-    except Exception as e:
-        g.LOGGER.exception("Error during create_and_login_bot in spawn_persona_node")
-        return {"error": f"Persona creation failed: {e}", "__next_node__": "chatbot_node"}
-
-    if not bot_result.get("ok", False):
-        error_details = bot_result.get("error", "Unknown error")
-        err = f"Persona creation failed: {error_details}"
-        g.LOGGER.error(err)
-        return {"error": err, "__next_node__": "chatbot_node"}
-
-    bot_id = bot_result.get("bot_id", "")
-    ephemeral_bot_client = bot_result.get("client")
-    # Normalize bot_id: remove '@' prefix and ':localhost' suffix.
-    if bot_id.startswith('@'):
-        bot_id = bot_id[1:]
-    if bot_id.endswith(':localhost'):
-        bot_id = bot_id[:-10]
-
-    # 4) Generate and upload a portrait
-    # We'll use the original descriptor as the prompt for the portrait.
-    final_prompt = descriptor  
-    portrait_mxc = None
-    try:
-        portrait_url = await generate_image(final_prompt, size="1024x1024")
-        if portrait_url:
-            portrait_mxc = await _download_and_upload_portrait(
-                portrait_url,
-                localpart,
-                password,
-                system_prompt,
-                traits,
-                ephemeral_bot_client
-            )
-    except Exception as e:
-        g.LOGGER.warning("Portrait generation/upload error: %s", e)
-
-    # 5) Build the final persona card HTML
-    global_draw_appendix = g.GLOBAL_PARAMS.get("global_draw_prompt_appendix", "")
-    card_html = _build_persona_card(
-        localpart=localpart,
-        displayname=displayname,
-        biography=biography,
-        backstory=backstory,
-        system_prompt=system_prompt,
-        dall_e_prompt=final_prompt,   # EXACT prompt used
-        traits=traits,
-        portrait_mxc=portrait_mxc,
-        global_draw_appendix=global_draw_appendix 
-    )
-
-    g.LOGGER.info("Completed spawn_persona_node for persona %s", localpart)
-    # Return the resulting HTML card and bot_id; move to the next node (e.g. chatbot_node)
-    state.update({
-        "html": card_html,
-        "bot_id": bot_id,
-        "__next_node__": "chatbot_node"
-    })
-    return state
-
-# ----------------------------
-# Internal helper functions
-# ----------------------------
-
-async def _download_and_upload_portrait(
-    portrait_url: str,
-    localpart: str,
-    password: str,
-    system_prompt: str,
-    traits: dict,
-    ephemeral_bot_client
-) -> str:
-    """
-    Downloads an image from portrait_url, uploads it to Matrix, updates the persona record,
-    and sets the bot's avatar. Returns the mxc:// URI or None on failure.
-    """
-    os.makedirs("data/images", exist_ok=True)
-    filename = f"data/images/portrait_{int(time.time())}.jpg"
-    dl_resp = requests.get(portrait_url)
-    dl_resp.raise_for_status()
-    with open(filename, "wb") as f:
-        f.write(dl_resp.content)
-
-    portrait_mxc = await direct_upload_image(ephemeral_bot_client, filename, "image/jpeg")
-    # Update persona record with portrait URL
-    traits["portrait_url"] = portrait_mxc
-    update_bot(
-        f"@{localpart}:localhost",
-        {
-            "password": password,
-            "system_prompt": system_prompt,
-            "traits": traits
-        }
-    )
-    # Attempt to set the avatar on the ephemeral client
-    if ephemeral_bot_client:
-        try:
-            await ephemeral_bot_client.set_avatar(portrait_mxc)
-        except Exception as e:
-            g.LOGGER.warning("Error setting avatar: %s", e)
-    return portrait_mxc
-
-def _build_persona_card(
-    localpart: str,
-    displayname: str,
-    biography: str,
-    backstory: str,
-    system_prompt: str,
-    dall_e_prompt: str,
-    traits: dict,
-    portrait_mxc: str,
-    global_draw_appendix: str
-) -> str:
-    """
-    Builds and returns an HTML character card for the persona.
-    The card includes:
-      1) A title (the localpart),
-      2) An italicized displayname,
-      3) An optional portrait image,
-      4) A table listing biography, backstory, system prompt, DALL·E prompt,
-         draw prompt appendix, traits (as a nested table), and a version number.
-    """
-    def esc(text):
-        return html.escape(str(text))
-
-    # Build a nested table for traits.
-    trait_rows = []
-    for k, v in traits.items():
-        trait_rows.append(
-            "<tr>"
-            f"<td style='padding:2px 6px;'><b>{esc(k)}</b></td>"
-            f"<td style='padding:2px 6px;'>{esc(v)}</td>"
-            "</tr>"
-        )
-    traits_subtable = (
-        "<table border='1' style='border-collapse:collapse; font-size:0.9em;'>"
-        "<thead><tr><th colspan='2'>Traits</th></tr></thead>"
-        f"<tbody>{''.join(trait_rows)}</tbody>"
-        "</table>"
-    )
-
-    def row(label, val):
-        return (
-            "<tr>"
-            f"<td style='padding:4px 8px; vertical-align:top;'><b>{esc(label)}</b></td>"
-            f"<td style='padding:4px 8px;'>{val}</td>"
-            "</tr>"
-        )
-
-    # Build portrait HTML if available.
-    portrait_html = ""
-    if portrait_mxc:
-        portrait_html = (
-            f"<div style='margin-bottom:8px;'>"
-            f"<img src='{esc(portrait_mxc)}' alt='Portrait' width='300'/>"
-            "</div>"
-        )
-
-    # Build rows for the main table.
-    table_rows = "".join([
-        row("Localpart", esc(localpart)),
-        row("DisplayName", esc(displayname)),
-        row("Biography", esc(biography)),
-        row("Backstory", esc(backstory)),
-        row("System Prompt", esc(system_prompt)),
-        row("DALL·E Prompt", esc(dall_e_prompt)),
-        row("Draw Prompt Appendix", esc(global_draw_appendix)),
-        row("Traits", traits_subtable),
-        row("Version", "1.0")
-    ])
-
-    table_html = (
-        "<table border='1' style='border-collapse:collapse;'>"
-        f"<tbody>{table_rows}</tbody>"
-        "</table>"
-    )
-
-    # Combine header, optional portrait, and table.
-    final_html = (
-        f"<h2 style='margin-bottom:2px;'>{esc(localpart)}</h2>"
-        f"<p style='margin-top:0; margin-bottom:10px;'><em>{esc(displayname)}</em></p>"
-        f"{portrait_html}"
-        f"{table_html}"
-        "<p><em>Persona creation complete!</em></p>"
-    )
-    return final_html
@@ -20,6 +20,7 @@ import yaml
 import json
 import asyncio
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from nio import (
     LoginResponse,
@@ -46,8 +47,9 @@ from luna.luna_lang_router import build_router_graph
 from luna.luna_lang_router import handle_luna_message  # new advanced version
 
 # Database & ASCII art
-from luna.bot_messages_store import load_messages
+from luna.bot_messages_store import load_messages, run_writer
 from luna.luna_command_extensions.ascii_art import show_ascii_banner
+from luna.luna_command_extensions.image_helpers import close_http_session
 
 import asyncio
 import logging
@@ -187,7 +189,8 @@ async def _login_all_bots(personalities_file, BOTS):
     for user_id, persona in personalities_data.items():
         localpart = user_id.split(":")[0].replace("@","")
         password = persona.get("password", "")
-        if not password:
+        if not password or localpart == g.LUNA_USERNAME:
+            # Luna is already logged in (with her own handler) by main()
             skipped_bots.append(user_id)
             continue
 
@@ -240,7 +243,7 @@ async def _console_loop():
     """
     parallel console loop
     """
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
     while not g.SHOULD_SHUT_DOWN:
         user_input = await loop.run_in_executor(None, input, "Enter command (or 'exit'): ")
         if user_input.strip().lower() == "exit":
@@ -255,7 +258,7 @@ async def _shutdown_all_bots():
     """
     close ephemeral bots
     """
-    for localpart, client in g.BOTS.items():
+    for localpart, client in list(g.BOTS.items()):
         try:
             await client.logout()
             await client.close()
@@ -264,13 +267,23 @@ async def _shutdown_all_bots():
         else:
             g.LOGGER.info(f"Logged out bot '{localpart}'.")
 
+# Bounded pool behind asyncio.to_thread / run_in_executor(None, ...). One
+# worker is permanently parked on the console's input() call; the rest serve
+# file I/O and context building.
+_IO_EXECUTOR_WORKERS = 5
+
 async def main():
     _check_existing_instance()
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=_IO_EXECUTOR_WORKERS, thread_name_prefix="luna-io")
+    )
     g.LOGGER = _configure_logging()
 
     g.LOGGER.info("----------------------------------------------------")
     g.LOGGER.info(f"Starting up Luna (version {g.LUNA_VERSION})")
     g.LOGGER.info("----------------------------------------------------")
+    # Confirms whether uvloop (see __main__) actually took effect
+    g.LOGGER.info(f"Event loop: {type(asyncio.get_running_loop()).__module__}")
 
     ########## LOAD ENV
     load_dotenv()
@@ -289,6 +302,8 @@ async def main():
 
     ########## LOAD messages
     load_messages()
+    # Background task that batches message-store writes off the event loop
+    writer_task = asyncio.create_task(run_writer())
 
     ########## LOGIN as Luna
     g.LUNA_CLIENT = await _login_matrix_client(
@@ -342,6 +357,9 @@ async def main():
     await g.LUNA_CLIENT.logout()
     await g.LUNA_CLIENT.close()
     await _shutdown_all_bots()
+    await close_http_session()
+    writer_task.cancel()
+    await asyncio.gather(writer_task, return_exceptions=True)
 
     g.LOGGER.info("Shutting down. Bye.")
 
@@ -375,4 +393,11 @@ def _cleanup_lock_file():
 
 
 if __name__ == "__main__":
+    # uvloop is optional; it makes the many small awaits per message cheaper
+    # and cuts syscalls on the sync / room_send / GPT sockets.
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     asyncio.run(main())